@@ -0,0 +1,179 @@
+""" Benchmarks for meltpack hot paths.
+
+Each benchmark is run on synthetic data at one or more sizes, recording the
+best wall time over several repeats, the peak traced memory of one further
+run, and throughput in work units (pixels, points, chips) per second.
+
+Usage:
+
+    python benchmarks/bench.py [-s small] [-k filter] [-r 3] [-o results.json]
+                               [--compare baseline.json]
+"""
+
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+SIZES = {"small": 0, "medium": 1, "large": 2}
+
+BENCHMARKS = []
+
+def benchmark(name, sizes):
+    """ Register a benchmark setup function. The setup function takes a size
+    parameter and returns *(func, nunits, unitname)*, where *func* is the
+    zero-argument callable to be timed. """
+    def decorator(setup):
+        BENCHMARKS.append((name, sizes, setup))
+        return setup
+    return decorator
+
+@benchmark("filt.smooth5", [256, 1024, 4096])
+def bench_smooth5(n):
+    from meltpack.filt import smooth5
+    h, _, _ = synthetic.flow_field(n, n)
+    return (lambda: smooth5(h, 4)), 4*n*n, "pixels"
+
+@benchmark("filt.medianfilt", [128, 512, 2048])
+def bench_medianfilt(n):
+    from meltpack.filt import medianfilt
+    h, _, _ = synthetic.flow_field(n, n)
+    return (lambda: medianfilt(h)), n*n, "pixels"
+
+@benchmark("divergence.divergence", [256, 1024, 4096])
+def bench_divergence(n):
+    from meltpack.divergence import divergence
+    h, u, v = synthetic.flow_field(n, n)
+    return (lambda: divergence(100.0, 100.0, h, u, v)), n*n, "pixels"
+
+@benchmark("gaussmarkov.predict", [500, 2000, 8000])
+def bench_gaussmarkov(n):
+    from meltpack.gaussmarkov import predict
+    x, y, z = synthetic.point_cloud(n)
+    xi, yi, _ = synthetic.point_cloud(n, seed=1)
+    model = lambda d: np.exp(-d**2/500.0**2)
+    def func():
+        return predict(model, np.c_[xi, yi], np.c_[x, y], z, maxdist=1500.0)
+    return func, n, "points"
+
+@benchmark("alphashapes.alpha_shape", [1000, 10000, 50000])
+def bench_alpha_shape(n):
+    from meltpack.alphashapes import alpha_shape
+    x, y, _ = synthetic.point_cloud(n)
+    return (lambda: alpha_shape(x, y, 1.0/500.0)), n, "points"
+
+@benchmark("correlate.correlate_scenes", [512, 1024, 2048])
+def bench_correlate_scenes(n):
+    from meltpack.correlate import correlate_scenes
+    scene1, scene2, uguess, vguess, dt = synthetic.scene_pair(n, n, gap_fraction=0.05)
+    resolution = (15.0*16, 15.0*16)
+    nchips = (n//16)**2
+    def func():
+        return correlate_scenes(scene1, scene2, uguess, vguess, dt,
+                                searchsize=(64, 64), refsize=(32, 32),
+                                resolution=resolution)
+    return func, nchips, "chips"
+
+@benchmark("bundle_adjust.compute_vertical_corrections", [(4, 256), (8, 512), (16, 1024)])
+def bench_vertical_corrections(size):
+    from meltpack.bundle_adjust import compute_vertical_corrections
+    n, npx = size
+    grids, _ = synthetic.dem_stack(n, npx, npx)
+    npairs = n*(n-1)//2
+    return (lambda: compute_vertical_corrections(grids)), npairs*npx*npx, "pixels"
+
+def run_one(func, repeat):
+    """ Return the best wall time over *repeat* runs and the peak traced
+    memory of a separate run. """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def run(sizes, pattern=None, repeat=3):
+    results = []
+    for name, params, setup in BENCHMARKS:
+        if pattern is not None and pattern not in name:
+            continue
+        for size in sizes:
+            param = params[SIZES[size]]
+            try:
+                func, nunits, unitname = setup(param)
+                wall, peak = run_one(func, repeat)
+            except ImportError as e:
+                print("{0:<45s} {1:<7s} skipped ({2})".format(name, size, e))
+                continue
+            except Exception as e:
+                print("{0:<45s} {1:<7s} failed ({2}: {3})".format(
+                        name, size, type(e).__name__, e))
+                continue
+            result = {"name": name, "size": size, "param": param,
+                      "wall_time": wall, "peak_memory": peak,
+                      "units": unitname, "throughput": nunits/wall}
+            results.append(result)
+            print("{0:<45s} {1:<7s} {2:10.4f} s {3:10.1f} MB {4:12.4g} {5}/s".format(
+                    name, size, wall, peak/1024.0**2, nunits/wall, unitname))
+    return results
+
+def compare(results, baseline):
+    """ Print the speed ratio of *results* against a previous run """
+    old = {(r["name"], r["size"]): r for r in baseline["results"]}
+    for r in results:
+        key = (r["name"], r["size"])
+        if key in old:
+            print("{0:<45s} {1:<7s} {2:6.2f}x time {3:6.2f}x memory".format(
+                    r["name"], r["size"], r["wall_time"]/old[key]["wall_time"],
+                    r["peak_memory"]/max(1, old[key]["peak_memory"])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-s", "--size", action="append", choices=list(SIZES),
+                        help="problem size(s) to run (default small)")
+    parser.add_argument("-k", "--filter", default=None,
+                        help="run only benchmarks whose name contains this")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", default=None,
+                        help="write results to a JSON file")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results from a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    results = run(args.size or ["small"], pattern=args.filter, repeat=args.repeat)
+
+    if args.output is not None:
+        import meltpack
+        with open(args.output, "w") as f:
+            json.dump({"meltpack_version": getattr(meltpack, "__version__", None),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "timestamp": time.time(),
+                       "results": results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+""" Synthetic data generators for benchmarking meltpack """
+
+import numpy as np
+
+def textured_image(ny, nx, corrlen=3.0, seed=0):
+    """ Return a (ny x nx) image of band-limited noise with correlation length
+    *corrlen* pixels, resembling surface texture on ice. """
+    rng = np.random.RandomState(seed)
+    noise = rng.randn(ny, nx)
+    ky = np.fft.fftfreq(ny)[:,np.newaxis]
+    kx = np.fft.rfftfreq(nx)[np.newaxis,:]
+    H = np.exp(-2*(np.pi*corrlen)**2 * (kx**2 + ky**2))
+    img = np.fft.irfft2(np.fft.rfft2(noise)*H, s=(ny, nx))
+    return (img-img.mean())/img.std()
+
+def shift_image(img, shift):
+    """ Shift *img* by *shift* = (sx, sy) pixels (may be fractional) using the
+    Fourier shift theorem. Content moves in the +x, +y index directions. """
+    ny, nx = img.shape
+    ky = np.fft.fftfreq(ny)[:,np.newaxis]
+    kx = np.fft.fftfreq(nx)[np.newaxis,:]
+    phase = np.exp(-2j*np.pi*(kx*shift[0] + ky*shift[1]))
+    return np.real(np.fft.ifft2(np.fft.fft2(img)*phase))
+
+def scene_pair(ny, nx, shift=(3.25, -2.5), resolution=(15.0, 15.0), dt=1.0,
+        gap_fraction=0.0, seed=0):
+    """ Return *(scene1, scene2, uguess, vguess, dt)* for correlate_scenes,
+    where scene2 is scene1 displaced by *shift* pixels. The velocity guess is
+    the true displacement rounded to whole pixels, in projected units per
+    *dt*. A fraction *gap_fraction* of square patches in each scene is set to
+    NaN to mimic data gaps. """
+    import karta
+    img1 = textured_image(ny, nx, seed=seed)
+    img2 = shift_image(img1, shift)
+    rng = np.random.RandomState(seed+1)
+    for img in (img1, img2):
+        npatch = int(gap_fraction*ny*nx/256)
+        for i, j in zip(rng.randint(0, ny-16, npatch), rng.randint(0, nx-16, npatch)):
+            img[i:i+16,j:j+16] = np.nan
+
+    dx, dy = resolution
+    T = (0.0, 0.0, dx, dy, 0.0, 0.0)
+    scene1 = karta.RegularGrid(T, values=img1, nodata_value=np.nan)
+    scene2 = karta.RegularGrid(T, values=img2, nodata_value=np.nan)
+
+    vy, vx = ny//8+2, nx//8+2
+    TV = (-dx*8, -dy*8, dx*8, dy*8, 0.0, 0.0)
+    u = np.round(shift[0])*dx/dt*np.ones([vy, vx])
+    v = np.round(shift[1])*dy/dt*np.ones([vy, vx])
+    uguess = karta.RegularGrid(TV, values=u, nodata_value=np.nan)
+    vguess = karta.RegularGrid(TV, values=v, nodata_value=np.nan)
+    return scene1, scene2, uguess, vguess, dt
+
+def dem_stack(n, ny, nx, resolution=(30.0, 30.0), noise=0.5, seed=0):
+    """ Return *(grids, offsets)*, where grids is a list of *n* DEMs of the
+    same surface with vertical offsets *offsets* (zero-mean), random noise,
+    and differing data footprints. """
+    import karta
+    rng = np.random.RandomState(seed)
+    surface = 100.0*textured_image(ny, nx, corrlen=20.0, seed=seed)
+    offsets = rng.randn(n)*5.0
+    offsets -= offsets.mean()
+
+    grids = []
+    T = (0.0, 0.0, resolution[0], resolution[1], 0.0, 0.0)
+    for k in range(n):
+        z = surface + offsets[k] + noise*rng.randn(ny, nx)
+        i0 = rng.randint(0, ny//3)
+        j0 = rng.randint(0, nx//3)
+        z[:i0,:] = np.nan
+        z[:,:j0] = np.nan
+        grids.append(karta.RegularGrid(T, values=z, nodata_value=np.nan))
+    return grids, offsets
+
+def point_cloud(n, extent=(0.0, 10000.0, 0.0, 10000.0), seed=0):
+    """ Return random points *(x, y, z)* with a smooth field *z* """
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(extent[0], extent[1], n)
+    y = rng.uniform(extent[2], extent[3], n)
+    z = np.sin(x/1000.0) + np.cos(y/1500.0) + 0.1*rng.randn(n)
+    return x, y, z
+
+def flow_field(ny, nx, nan_fraction=0.01, seed=0):
+    """ Return thickness and velocity arrays *(h, u, v)* with a small
+    fraction of NaN pixels """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:ny,0:nx] / float(max(ny, nx))
+    h = 500.0 + 100.0*np.sin(3*x)*np.cos(2*y)
+    u = 800.0*x**2 + 50.0*rng.randn(ny, nx)
+    v = 300.0*x*y + 50.0*rng.randn(ny, nx)
+    h[rng.rand(ny, nx) < nan_fraction] = np.nan
+    return h, u, v
@@ -17,4 +17,5 @@ setup(
         packages=find_packages("src"),
         package_dir={"": "src"},
         ext_modules = cythonize(extensions),
+        entry_points={"console_scripts": ["meltpack = meltpack.batch:main"]},
     )
@@ -1,8 +1,20 @@
-from . import divergence
-from . import filt
-from . import correlate
-from . import gaussmarkov
-from . import alphashapes
-from . import dhdt
-from . import notify
-from . import bundle_adjust
+""" Tools for measuring glacier change from remotely sensed imagery and
+elevation models.
+
+Submodules are imported on first access (e.g. `meltpack.filt`), so that
+`import meltpack` stays cheap for processes that use only part of the package.
+"""
+
+import importlib
+
+__all__ = ["accel", "alphashapes", "batch", "bundle_adjust", "correlate",
+           "dhdt", "divergence", "filt", "gaussmarkov", "instrument", "notify",
+           "sampling", "tiles", "utilities", "vectorfield"]
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,21 +1,18 @@
 import numpy as np
 cimport numpy as np
+cimport cython
+from cython cimport floating
+from libc.math cimport NAN
 
-DTYPE = np.float64
-ctypedef np.float64_t DTYPE_t
-
-def divergence(DTYPE_t dx, DTYPE_t dy,
-               np.ndarray[DTYPE_t, ndim=2] h,
-               np.ndarray[DTYPE_t, ndim=2] u,
-               np.ndarray[DTYPE_t, ndim=2] v):
+def divergence(double dx, double dy, h, u, v):
     """ Return the divergence of a vector field using upwind finite volumes.
 
     Computes
-    
+
         div(h . <u,v>)
 
         == h * (du/dx + dv/dy) + u*dh/dx + v*dh/dy
-    
+
     Arguments
     ---------
     dx: float
@@ -23,19 +20,99 @@ def divergence(DTYPE_t dx, DTYPE_t dy,
     h: np.ndarray
     u: np.ndarray
     v: np.ndarray
+
+    If *h*, *u*, and *v* are all np.float32, the computation is carried out
+    and returned in single precision; otherwise in double precision.
     """
-    cdef unsigned int ny, nx
-    cdef unsigned int i, j
-    cdef DTYPE_t u_, v_
-    cdef np.ndarray[DTYPE_t, ndim=2] div
-    cdef np.ndarray[DTYPE_t, ndim=2] xfluxes, yfluxes
+    h = np.asarray(h)
+    u = np.asarray(u)
+    v = np.asarray(v)
+    if h.dtype == u.dtype == v.dtype == np.float32:
+        return _divergence[float](dx, dy, h, u, v)
+    return _divergence[double](dx, dy,
+                               h.astype(np.float64, copy=False),
+                               u.astype(np.float64, copy=False),
+                               v.astype(np.float64, copy=False))
+
+def divergence_stack(double dx, double dy, h, u, v, out):
+    """ Compute the divergence of each epoch of (nt, ny, nx) arrays *h*, *u*,
+    and *v* into the (nt, ny-2, nx-2) array *out*, reusing one set of flux
+    buffers for all epochs. All arrays must have the floating point type of
+    *out*. """
+    if out.dtype == np.float32:
+        _divergence_stack[float](dx, dy, h, u, v, out)
+    else:
+        _divergence_stack[double](dx, dy, h, u, v, out)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _divergence(double dx, double dy,
+                 const floating[:,:] h,
+                 const floating[:,:] u,
+                 const floating[:,:] v):
+    cdef Py_ssize_t ny, nx
 
     # Allocate intermediate and output arrays
     ny = h.shape[0]
     nx = h.shape[1]
-    xfluxes = np.zeros([ny, nx-1], dtype=DTYPE)
-    yfluxes = np.zeros([ny-1, nx], dtype=DTYPE)
-    div = np.nan*np.zeros([ny-2, nx-2], dtype=DTYPE)
+    if floating is float:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    xfluxes_ = np.zeros([ny, nx-1], dtype=dtype)
+    yfluxes_ = np.zeros([ny-1, nx], dtype=dtype)
+    div_ = np.full([ny-2, nx-2], np.nan, dtype=dtype)
+    cdef floating[:,:] xfluxes = xfluxes_
+    cdef floating[:,:] yfluxes = yfluxes_
+    cdef floating[:,:] div = div_
+
+    with nogil:
+        _divergence_into(dx, dy, h, u, v, xfluxes, yfluxes, div)
+    return div_
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _divergence_stack(double dx, double dy,
+                       const floating[:,:,:] h,
+                       const floating[:,:,:] u,
+                       const floating[:,:,:] v,
+                       floating[:,:,:] out):
+    cdef Py_ssize_t nt, ny, nx, t
+
+    nt = u.shape[0]
+    ny = u.shape[1]
+    nx = u.shape[2]
+    if floating is float:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    xfluxes_ = np.zeros([ny, nx-1], dtype=dtype)
+    yfluxes_ = np.zeros([ny-1, nx], dtype=dtype)
+    cdef floating[:,:] xfluxes = xfluxes_
+    cdef floating[:,:] yfluxes = yfluxes_
+
+    with nogil:
+        for t in range(nt):
+            _divergence_into(dx, dy, h[t], u[t], v[t], xfluxes, yfluxes, out[t])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _divergence_into(double dx, double dy,
+                           const floating[:,:] h,
+                           const floating[:,:] u,
+                           const floating[:,:] v,
+                           floating[:,:] xfluxes,
+                           floating[:,:] yfluxes,
+                           floating[:,:] div) noexcept nogil:
+    cdef Py_ssize_t ny, nx
+    cdef Py_ssize_t i, j
+    cdef floating u_, v_
+
+    ny = h.shape[0]
+    nx = h.shape[1]
+    if (ny < 3) or (nx < 3):
+        return
 
     # Compute fluxes in x direction
     for i in range(ny):
@@ -59,11 +136,17 @@ def divergence(DTYPE_t dx, DTYPE_t dy,
             else:
                 yfluxes[i,j] = 0.5*(h[i,j]*v[i,j] + h[i+1,j]*v[i+1,j])
 
+    # Outer rows and columns are left undefined
+    for j in range(nx-2):
+        div[0,j] = NAN
+        div[ny-3,j] = NAN
+    for i in range(ny-2):
+        div[i,0] = NAN
+        div[i,nx-3] = NAN
+
     # Apply fluxes
     for i in range(1, ny-2):
         for j in range(1, nx-2):
 
             div[i,j] = (-xfluxes[i+1,j] + xfluxes[i+1,j+1])/dx \
                      + (-yfluxes[i,j+1] + yfluxes[i+1,j+1])/dy
-
-    return div
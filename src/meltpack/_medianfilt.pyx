@@ -1,70 +1,96 @@
 import numpy as np
 cimport numpy as np
-from libc.math cimport isnan
+from libc.math cimport isnan, NAN
 cimport cython
+from cython cimport floating
 
-DTYPE = np.float64
-ctypedef np.float64_t DTYPE_t
+def medianfilt(img):
+    """ Perform a nodata-aware median filtering operation on a numpy grid.
+
+    *img* may be np.float32 or np.float64 (other types are converted to
+    np.float64), and the result has the same type. """
+    img = np.asarray(img)
+    if img.dtype == np.float32:
+        return _medianfilt[float](img)
+    return _medianfilt[double](img.astype(np.float64, copy=False))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline floating _median(floating *buf, int count) nogil:
+    """ Return the median of the first *count* values of *buf*, sorting them
+    in place (insertion sort; count <= 9) """
+    cdef int i, k
+    cdef floating a
+    for i in range(1, count):
+        a = buf[i]
+        k = i-1
+        while k >= 0 and buf[k] > a:
+            buf[k+1] = buf[k]
+            k -= 1
+        buf[k+1] = a
+    if count % 2 == 1:
+        return buf[count//2]
+    else:
+        return 0.5*(buf[count//2-1] + buf[count//2])
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def medianfilt(DTYPE_t[:,:] img):
-    """ Perform a nodata-aware median filtering operation on a numpy grid. """
+cdef _medianfilt(const floating[:,:] img):
 
     cdef int nx, ny
     cdef int i, j
     cdef int count
-    cdef np.ndarray[DTYPE_t, ndim=2] out
+    cdef floating buf[9]
 
     ny = img.shape[0]
     nx = img.shape[1]
-    out = np.zeros([ny, nx], dtype=DTYPE)
-    cdef DTYPE_t [:,:] out_view = out
+    if floating is float:
+        out = np.empty([ny, nx], dtype=np.float32)
+    else:
+        out = np.empty([ny, nx], dtype=np.float64)
+    cdef floating [:,:] out_view = out
 
-    arr = np.zeros(9, dtype=DTYPE)
-    cdef DTYPE_t [:] buf = arr
+    with nogil:
+        for i in range(1, ny-1):
+            for j in range(1, nx-1):
+                count = 0
 
-    for i in range(1, ny-1):
-        for j in range(1, nx-1):
-            count = 0
-
-            if not isnan(img[i,j]):
-                count += 1
-                buf[0] = img[i,j]
-
-                if not isnan(img[i-1,j-1]):
-                    buf[count] = img[i-1,j-1]
-                    count += 1
-                if not isnan(img[i-1,j]):
-                    buf[count] = img[i-1,j]
-                    count += 1
-                if not isnan(img[i-1,j+1]):
-                    buf[count] = img[i-1,j+1]
-                    count += 1
-                if not isnan(img[i,j-1]):
-                    buf[count] = img[i,j-1]
-                    count += 1
-                if not isnan(img[i,j+1]):
-                    buf[count] = img[i,j+1]
-                    count += 1
-                if not isnan(img[i+1,j-1]):
-                    buf[count] = img[i+1,j-1]
-                    count += 1
-                if not isnan(img[i+1,j]):
-                    buf[count] = img[i+1,j]
-                    count += 1
-                if not isnan(img[i+1,j+1]):
-                    buf[count] = img[i+1,j+1]
+                if not isnan(img[i,j]):
                     count += 1
+                    buf[0] = img[i,j]
+
+                    if not isnan(img[i-1,j-1]):
+                        buf[count] = img[i-1,j-1]
+                        count += 1
+                    if not isnan(img[i-1,j]):
+                        buf[count] = img[i-1,j]
+                        count += 1
+                    if not isnan(img[i-1,j+1]):
+                        buf[count] = img[i-1,j+1]
+                        count += 1
+                    if not isnan(img[i,j-1]):
+                        buf[count] = img[i,j-1]
+                        count += 1
+                    if not isnan(img[i,j+1]):
+                        buf[count] = img[i,j+1]
+                        count += 1
+                    if not isnan(img[i+1,j-1]):
+                        buf[count] = img[i+1,j-1]
+                        count += 1
+                    if not isnan(img[i+1,j]):
+                        buf[count] = img[i+1,j]
+                        count += 1
+                    if not isnan(img[i+1,j+1]):
+                        buf[count] = img[i+1,j+1]
+                        count += 1
 
-            if count == 0:
-                out_view[i,j] = np.nan
-            else:
-                out_view[i,j] = np.median(arr[:count])
+                if count == 0:
+                    out_view[i,j] = NAN
+                else:
+                    out_view[i,j] = _median(buf, count)
 
     out_view[0,:] = img[0,:]
     out_view[ny-1,:] = img[ny-1,:]
     out_view[:,0] = img[:,0]
     out_view[:,nx-1] = img[:,nx-1]
     return out
-
@@ -1,7 +1,8 @@
 import numpy as np
 cimport numpy as np
-from libc.math cimport isnan
+from libc.math cimport isnan, NAN
 cimport cython
+from cython cimport floating
 
 DOUBLE = np.float64
 ctypedef np.float64_t DOUBLE_t
@@ -22,15 +23,24 @@ def smooth5_int(np.ndarray[INT_t, ndim=2] img, int niter=1, int nodata=-1):
         img = _smooth5_int(img, nodata)
     return img
 
-def smooth5(np.ndarray[DOUBLE_t, ndim=2] img, int niter=1):
+def smooth5(img, int niter=1):
     """ Apply a five-point smoothing kernel to *img* *niter* times.
     Arguments:
-    img: np.ndarray[np.float64]
+    img: np.ndarray[np.float32] or np.ndarray[np.float64]; other types are
+         converted to np.float64
     niter: int
+
+    The result has the same floating point type as *img*.
     """
     cdef int i
+    img = np.asarray(img)
+    if img.dtype != np.float32:
+        img = img.astype(np.float64, copy=False)
     for i in range(niter):
-        img = _smooth5_double(img)
+        if img.dtype == np.float32:
+            img = _smooth5_floating[float](img)
+        else:
+            img = _smooth5_floating[double](img)
     return img
 
 @cython.boundscheck(False)
@@ -89,49 +99,51 @@ cdef int round_int(double a):
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef _smooth5_double(DOUBLE_t [:,:] img):
+cdef _smooth5_floating(const floating [:,:] img):
 
     cdef int nx, ny
     cdef int i, j
     cdef double runsum
     cdef int count
-    cdef np.ndarray[DOUBLE_t, ndim=2] out
 
     ny = img.shape[0]
     nx = img.shape[1]
-    out = np.zeros([ny, nx], dtype=DOUBLE)
-    cdef DOUBLE_t [:,:] out_view = out
-
-    for i in range(1, ny-1):
-        for j in range(1, nx-1):
-            count = 0
-            runsum = 0.0
+    if floating is float:
+        out = np.empty([ny, nx], dtype=np.float32)
+    else:
+        out = np.empty([ny, nx], dtype=np.float64)
+    cdef floating [:,:] out_view = out
 
-            if not isnan(img[i,j]):
-                runsum += img[i,j]
-                count += 1
+    with nogil:
+        for i in range(1, ny-1):
+            for j in range(1, nx-1):
+                count = 0
+                runsum = 0.0
 
-                if not isnan(img[i-1,j]):
-                    runsum += img[i-1,j]
-                    count += 1
-                if not isnan(img[i,j-1]):
-                    runsum += img[i,j-1]
-                    count += 1
-                if not isnan(img[i,j+1]):
-                    runsum += img[i,j+1]
-                    count += 1
-                if not isnan(img[i+1,j]):
-                    runsum += img[i+1,j]
+                if not isnan(img[i,j]):
+                    runsum += img[i,j]
                     count += 1
 
-            if count == 0:
-                out_view[i,j] = np.nan
-            else:
-                out_view[i,j] = runsum/count
-
-    out_view[0,:] = np.nan
-    out_view[ny-1,:] = np.nan
-    out_view[:,0] = np.nan
-    out_view[:,nx-1] = np.nan
+                    if not isnan(img[i-1,j]):
+                        runsum += img[i-1,j]
+                        count += 1
+                    if not isnan(img[i,j-1]):
+                        runsum += img[i,j-1]
+                        count += 1
+                    if not isnan(img[i,j+1]):
+                        runsum += img[i,j+1]
+                        count += 1
+                    if not isnan(img[i+1,j]):
+                        runsum += img[i+1,j]
+                        count += 1
+
+                if count == 0:
+                    out_view[i,j] = NAN
+                else:
+                    out_view[i,j] = runsum/count
+
+    out_view[0,:] = NAN
+    out_view[ny-1,:] = NAN
+    out_view[:,0] = NAN
+    out_view[:,nx-1] = NAN
     return out
-
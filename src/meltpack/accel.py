@@ -0,0 +1,177 @@
+""" Selectable implementations of inner loops that are not compiled with Cython.
+
+Two backends are available:
+
+- "numpy" (always available): vectorized NumPy implementations
+- "numba" (if Numba is installed): loops compiled with `numba.njit`
+
+By default ("auto") Numba is used when it can be imported. The backend can
+be chosen with `set_backend`, or with the MELTPACK_BACKEND environment
+variable. Numba is only imported, and its kernels only compiled, on first
+use.
+
+Functions with accelerated implementations are `correlate.findpeak_subpixel`,
+`correlate._normalize_chip`, and the triangle filtering in
+`alphashapes.alpha_shape`.
+"""
+
+import os
+import threading
+
+BACKENDS = ("numpy", "numba")
+
+_implementations = {}
+_lock = threading.Lock()
+_backend = None
+
+def register(name, backend):
+    """ Decorator registering a function as the *backend* implementation of
+    *name* """
+    def decorator(func):
+        _implementations[(name, backend)] = func
+        return func
+    return decorator
+
+def numba_available():
+    try:
+        import numba
+    except ImportError:
+        return False
+    return True
+
+def set_backend(name="auto"):
+    """ Select the backend used by accelerated functions: "numpy", "numba",
+    or "auto". Raises ImportError if "numba" is requested but unavailable.
+    """
+    global _backend
+    if name == "auto":
+        name = "numba" if numba_available() else "numpy"
+    if name not in BACKENDS:
+        raise ValueError("backend must be one of {0}".format(BACKENDS + ("auto",)))
+    with _lock:
+        if name == "numba":
+            _load_numba()
+        _backend = name
+
+def get_backend():
+    """ Return the name of the selected backend """
+    if _backend is None:
+        set_backend(os.environ.get("MELTPACK_BACKEND", "auto"))
+    return _backend
+
+def implementation(name, backend=None):
+    """ Return the implementation of *name* for *backend* (by default, the
+    selected backend), falling back to the NumPy implementation """
+    if backend is None:
+        backend = _backend if _backend is not None else get_backend()
+    elif backend == "numba":
+        with _lock:
+            _load_numba()
+    func = _implementations.get((name, backend))
+    if func is None:
+        func = _implementations[(name, "numpy")]
+    return func
+
+_numba_loaded = False
+
+def _load_numba():
+    """ Define and register the Numba kernels """
+    global _numba_loaded
+    if _numba_loaded:
+        return
+    import numba
+    import numpy as np
+
+    @numba.njit(cache=True, nogil=True)
+    def _subpixel(c):
+        ny, nx = c.shape
+        imax = 0
+        jmax = 0
+        cmax = c[0,0]
+        cmin = c[0,0]
+        for i in range(ny):
+            for j in range(nx):
+                if c[i,j] > cmax:
+                    cmax = c[i,j]
+                    imax = i
+                    jmax = j
+                if c[i,j] < cmin:
+                    cmin = c[i,j]
+        if (imax == 0) or (imax == ny-1) or (jmax == 0) or (jmax == nx-1):
+            return imax, jmax, 0.0, 0.0, True
+        cmin = cmin - 1e-8
+        cij = np.log(c[imax,jmax]-cmin)
+        cw = np.log(c[imax,jmax-1]-cmin)
+        ce = np.log(c[imax,jmax+1]-cmin)
+        cs = np.log(c[imax-1,jmax]-cmin)
+        cn = np.log(c[imax+1,jmax]-cmin)
+        den = 2*ce - 4*cij + 2*cw
+        dx = (cw - ce)/den if den != 0.0 else 0.0
+        den = 2*cn - 4*cij + 2*cs
+        dy = (cs - cn)/den if den != 0.0 else 0.0
+        return imax, jmax, dy, dx, False
+
+    @register("findpeak_subpixel", "numba")
+    def findpeak_subpixel(c):
+        i, j, dy, dx, edge = _subpixel(np.asarray(c))
+        if edge:
+            return i, j
+        return i+dy, j+dx
+
+    @numba.njit(cache=True, nogil=True)
+    def _normalize(chip, out):
+        n = 0
+        s = 0.0
+        for v in chip.flat:
+            if not np.isnan(v):
+                n += 1
+                s += v
+        if n == 0:
+            out[:] = 0.0
+            return
+        mean = s/n
+        ss = 0.0
+        for v in chip.flat:
+            if not np.isnan(v):
+                ss += (v-mean)**2
+        std = np.sqrt(ss/n)
+        if not (std > 0.0):
+            out[:] = 0.0
+            return
+        o = out.ravel()
+        k = 0
+        for v in chip.flat:
+            o[k] = 0.0 if np.isnan(v) else (v-mean)/std
+            k += 1
+
+    @register("normalize_chip", "numba")
+    def normalize_chip(chip):
+        chip = np.asarray(chip)
+        # integer chips are normalized in double precision, as with NumPy
+        dtype = chip.dtype if chip.dtype.kind == "f" else np.float64
+        chip = chip.astype(dtype, copy=False)
+        out = np.empty(chip.shape, dtype=dtype)
+        _normalize(chip, out)
+        return out
+
+    @numba.njit(cache=True, nogil=True)
+    def _circumradii(coords, simplices):
+        out = np.empty(len(simplices))
+        for k in range(len(simplices)):
+            ia = simplices[k,0]
+            ib = simplices[k,1]
+            ic = simplices[k,2]
+            ab = np.sqrt((coords[ia,0]-coords[ib,0])**2 + (coords[ia,1]-coords[ib,1])**2)
+            bc = np.sqrt((coords[ib,0]-coords[ic,0])**2 + (coords[ib,1]-coords[ic,1])**2)
+            ac = np.sqrt((coords[ia,0]-coords[ic,0])**2 + (coords[ia,1]-coords[ic,1])**2)
+            s = 0.5*(ab+bc+ac)
+            area = np.sqrt(max(s*(s-ab)*(s-bc)*(s-ac), 0.0))
+            out[k] = 0.25*ab*bc*ac/area if area > 0.0 else np.inf
+        return out
+
+    @register("circumradii", "numba")
+    def circumradii(coords, simplices):
+        return _circumradii(np.ascontiguousarray(coords, dtype=np.float64),
+                            np.ascontiguousarray(simplices, dtype=np.int64))
+
+    _numba_loaded = True
@@ -1,38 +1,46 @@
 """ From a set of point data, compute bounding alpha shapes. """
 
-import math
-import karta
-from shapely.geometry import MultiLineString
-from shapely.ops import polygonize, cascaded_union
-import scipy.spatial
 import numpy as np
 
+from . import accel
+
+# karta, shapely, and scipy.spatial are imported where needed, because they are
+# slow to import and unused by much of meltpack
+
+@accel.register("circumradii", "numpy")
+def _circumradii(coords, simplices):
+    """ Return the circumradius of each triangle in *simplices*, or inf for
+    degenerate triangles """
+    a = coords[simplices[:,0]]
+    b = coords[simplices[:,1]]
+    c = coords[simplices[:,2]]
+    ab = np.hypot(a[:,0]-b[:,0], a[:,1]-b[:,1])
+    bc = np.hypot(b[:,0]-c[:,0], b[:,1]-c[:,1])
+    ac = np.hypot(a[:,0]-c[:,0], a[:,1]-c[:,1])
+
+    semiperim = 0.5*(ab+bc+ac)
+    area = np.sqrt(np.maximum(semiperim*(semiperim-ab)*(semiperim-bc)*(semiperim-ac), 0.0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        radius = np.where(area > 0, 0.25*ab*bc*ac/area, np.inf)
+    return radius
+
 def alpha_shape(x, y, alpha):
+    import scipy.spatial
+    from shapely.geometry import MultiLineString
+    from shapely.ops import polygonize, unary_union
+
     coords = np.c_[x, y]
     tri = scipy.spatial.Delaunay(coords)
-    
-    # edges = []
-    edge_coords = []
-    for ia, ib, ic in tri.vertices:
-        ab = math.sqrt((coords[ia,0]-coords[ib,0])**2 + (coords[ia,1]-coords[ib,1])**2)
-        bc = math.sqrt((coords[ib,0]-coords[ic,0])**2 + (coords[ib,1]-coords[ic,1])**2)
-        ac = math.sqrt((coords[ia,0]-coords[ic,0])**2 + (coords[ia,1]-coords[ic,1])**2)
-        
-        semiperim = 0.5*(ab+bc+ac)
-        area = math.sqrt(semiperim*(semiperim-ab)*(semiperim-bc)*(semiperim-ac))
-        radius = 0.25*ab*bc*ac/area
-        
-        if radius < 1.0/alpha:
-            # edges.append((tuple(coords[ia]), tuple(coords[ib])))
-            # edges.append((tuple(coords[ib]), tuple(coords[ic])))
-            # edges.append((tuple(coords[ia]), tuple(coords[ic])))
-            edge_coords.append(coords[[ia, ib]])
-            edge_coords.append(coords[[ib, ic]])
-            edge_coords.append(coords[[ia, ic]])
-            
-    # edges = set(edges)
+
+    radius = accel.implementation("circumradii")(coords, tri.simplices)
+    ia, ib, ic = tri.simplices[radius < 1.0/alpha].T
+
+    # edges ab, bc, and ac of each retained triangle
+    edges = np.stack([np.c_[ia, ib], np.c_[ib, ic], np.c_[ia, ic]], axis=1).reshape(-1, 2)
+    edge_coords = list(coords[edges])
+
     m = MultiLineString(edge_coords)
-    return cascaded_union(list(polygonize(m))), edge_coords
+    return unary_union(list(polygonize(m))), edge_coords
 
 def restrict_grid(grid, x_obs, y_obs, alpha):
     """ Mask out grid beyond the (concave) region bounded by x_obs, y_obs
@@ -42,6 +50,7 @@ def restrict_grid(grid, x_obs, y_obs, alpha):
     the largest is used. Extending to use all should be easy, if it's ever
     wanted.
     """
+    import karta
     p, _ = alpha_shape(x_obs, y_obs, alpha)
     try:
         areas = [_p.area for _p in p]
@@ -0,0 +1,281 @@
+""" Resumable batch feature tracking of scene pairs.
+
+A manifest is a JSON file listing scene pairs and the `correlate_scenes`
+parameters used for them:
+
+    {
+        "defaults": {"uguess": "vx.tif", "vguess": "vy.tif",
+                     "searchsize": [128, 128], "refsize": [32, 32],
+                     "resolution": [100.0, 100.0]},
+        "pairs": [
+            {"name": "a_b", "scene1": "a.tif", "scene2": "b.tif", "dt": 0.1},
+            {"name": "b_c", "scene1": "b.tif", "scene2": "c.tif", "dt": 0.2,
+             "method": "phase"}
+        ]
+    }
+
+Entries in "defaults" apply to every pair unless the pair overrides them.
+Relative paths are taken relative to the manifest. A pair may give a
+"memory" estimate in bytes (or a string such as "6G"); otherwise it is
+estimated from the sizes of the scene files.
+
+Each pair is written to *outdir*/<name>.npz, containing the gridded *u*,
+*v*, and *strength* and the grid *transform*, alongside <name>.json with its
+timings. Outputs are written to a temporary file and renamed into place, so
+an interrupted run leaves no partial results, and running the manifest again
+skips the pairs that are already complete.
+
+From the command line:
+
+    meltpack track manifest.json -o results/ --workers 8 --pairs 2 --memory 16G
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from . import instrument
+
+logger = logging.getLogger(__name__)
+
+# correlate_scenes arguments that may be given in a manifest
+PARAMETERS = ("searchsize", "refsize", "resolution", "max_nan_fraction",
+              "method", "dtype", "adaptive", "uncertainty", "rel_uncertainty")
+
+# Multiple of the scene file sizes used as the memory estimate for a pair
+MEMORY_FACTOR = 4
+
+def parse_bytes(s):
+    """ Parse a number of bytes, optionally with a K, M, G, or T suffix """
+    if isinstance(s, (int, float)):
+        return int(s)
+    s = s.strip().upper().rstrip("B")
+    for i, suffix in enumerate("KMGT"):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * 1024**(i+1))
+    return int(float(s))
+
+def load_manifest(path):
+    """ Read a manifest and return a list of job dictionaries with keys
+    "name", "scene1", "scene2", "uguess", "vguess", "dt", "memory", and
+    "params" (keyword arguments for `correlate_scenes`). """
+    with open(path) as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+
+    def resolve(p):
+        return p if os.path.isabs(p) else os.path.join(root, p)
+
+    jobs = []
+    names = set()
+    for k, pair in enumerate(manifest["pairs"]):
+        entry = dict(defaults)
+        entry.update(pair)
+        missing = [key for key in ("scene1", "scene2", "uguess", "vguess", "dt")
+                   if key not in entry]
+        if missing:
+            raise ValueError("pair {0} is missing {1}".format(k, ", ".join(missing)))
+        name = entry.get("name")
+        if name is None:
+            name = "{0}_{1}".format(*[os.path.splitext(os.path.basename(entry[key]))[0]
+                                      for key in ("scene1", "scene2")])
+        if name in names:
+            raise ValueError("duplicate pair name '{0}'".format(name))
+        names.add(name)
+
+        job = {"name": name, "dt": float(entry["dt"])}
+        for key in ("scene1", "scene2", "uguess", "vguess"):
+            job[key] = resolve(entry[key])
+        if isinstance(entry.get("uncertainty"), str):
+            entry["uncertainty"] = resolve(entry["uncertainty"])
+        if "memory" in entry:
+            job["memory"] = parse_bytes(entry["memory"])
+        else:
+            job["memory"] = MEMORY_FACTOR * sum(os.path.getsize(job[key])
+                for key in ("scene1", "scene2") if os.path.isfile(job[key]))
+        job["params"] = {key: entry[key] for key in PARAMETERS if key in entry}
+        unknown = set(entry) - set(PARAMETERS) - \
+                  {"name", "scene1", "scene2", "uguess", "vguess", "dt", "memory"}
+        if unknown:
+            raise ValueError("unknown manifest keys: {0}".format(", ".join(sorted(unknown))))
+        jobs.append(job)
+    return jobs
+
+def output_path(outdir, name):
+    return os.path.join(outdir, name + ".npz")
+
+def is_complete(outdir, name):
+    return os.path.isfile(output_path(outdir, name))
+
+def _write_atomic(path, write):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def run_pair(job, outdir, nprocs=1):
+    """ Correlate the scenes of one manifest *job* and write the results to
+    *outdir*. Returns the `instrument.Stats` of the run. """
+    from .correlate import correlate_scenes, _read_scene
+
+    stats = instrument.Stats()
+    with stats.timer("read"):
+        scene1, scene2, uguess, vguess = [_read_scene(job[key])
+            for key in ("scene1", "scene2", "uguess", "vguess")]
+        params = dict(job["params"])
+        for key in ("searchsize", "refsize", "resolution"):
+            if key in params:
+                params[key] = tuple(params[key])
+        if isinstance(params.get("uncertainty"), str):
+            params["uncertainty"] = _read_scene(params["uncertainty"])
+
+    u, v, s = correlate_scenes(scene1, scene2, uguess, vguess, job["dt"],
+                               nprocs=nprocs, grid=True, stats=stats, **params)
+
+    with stats.timer("write"):
+        _write_atomic(output_path(outdir, job["name"]),
+                      lambda f: np.savez(f, u=u.values, v=v.values,
+                                         strength=s.values,
+                                         transform=np.array(u.transform)))
+    return stats
+
+class MemoryBudget(object):
+    """ Blocking accountant that limits the summed memory estimates of the
+    jobs running at once to *limit* bytes. A job larger than the whole
+    budget is allowed to run when nothing else is running. """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            while self.limit is not None and self.in_use > 0 and \
+                    self.in_use + nbytes > self.limit:
+                self._cond.wait()
+            self.in_use += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.in_use -= nbytes
+            self._cond.notify_all()
+
+def run_manifest(jobs, outdir, workers=1, pairs=1, memory_budget=None,
+        force=False, func=run_pair):
+    """ Run each job in *jobs* (see `load_manifest`) that does not already
+    have a result in *outdir*.
+
+    Arguments:
+    ----------
+    jobs: list of job dictionaries
+    outdir: str, output directory, created if necessary
+    workers: int, total number of correlation threads
+    pairs: int, number of pairs to process at once; each gets
+           max(1, workers // pairs) threads
+    memory_budget: int, optional, limit on the summed memory estimates of
+           the pairs running at once, in bytes
+    force: bool, recompute pairs that are already complete
+    func: function *f(job, outdir, nprocs) -> instrument.Stats* that
+          processes one job (default `run_pair`)
+
+    Returns:
+    --------
+    dict mapping each job name to "done", "skipped", or "failed"
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    nprocs = max(1, workers // max(1, pairs))
+    budget = MemoryBudget(memory_budget)
+    status = {}
+
+    todo = []
+    for job in jobs:
+        if not force and is_complete(outdir, job["name"]):
+            logger.info("%s: already complete, skipping", job["name"])
+            status[job["name"]] = "skipped"
+        else:
+            todo.append(job)
+
+    def process(job):
+        budget.acquire(job["memory"])
+        try:
+            logger.info("%s: started", job["name"])
+            t0 = time.perf_counter()
+            stats = func(job, outdir, nprocs)
+            elapsed = time.perf_counter() - t0
+        finally:
+            budget.release(job["memory"])
+
+        report = {"name": job["name"], "elapsed": elapsed, "nprocs": nprocs}
+        if stats is not None:
+            report.update(stats.as_dict())
+        _write_atomic(os.path.join(outdir, job["name"] + ".json"),
+                      lambda f: f.write(json.dumps(report, indent=2).encode()))
+        logger.info("%s: finished in %.1f s", job["name"], elapsed)
+        return elapsed
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max(1, pairs)) as executor:
+        futures = {executor.submit(process, job): job["name"] for job in todo}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                fut.result()
+                status[name] = "done"
+            except Exception:
+                logger.exception("%s: failed", name)
+                status[name] = "failed"
+
+    counts = {k: sum(1 for s in status.values() if s == k)
+              for k in ("done", "skipped", "failed")}
+    logger.info("%d pairs done, %d skipped, %d failed in %.1f s",
+                counts["done"], counts["skipped"], counts["failed"],
+                time.perf_counter()-t0)
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="meltpack",
+                                     description="meltpack batch processing")
+    subparsers = parser.add_subparsers(dest="command")
+    track = subparsers.add_parser("track",
+            help="correlate the scene pairs listed in a manifest")
+    track.add_argument("manifest", help="JSON manifest of scene pairs")
+    track.add_argument("-o", "--outdir", required=True,
+                       help="directory for results and checkpoints")
+    track.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                       help="total number of correlation threads (default: all CPUs)")
+    track.add_argument("-p", "--pairs", type=int, default=1,
+                       help="number of pairs to process at once (default 1)")
+    track.add_argument("-m", "--memory", default=None,
+                       help="memory budget for pairs in flight, e.g. 16G")
+    track.add_argument("-f", "--force", action="store_true",
+                       help="recompute pairs that are already complete")
+    track.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    jobs = load_manifest(args.manifest)
+    memory = None if args.memory is None else parse_bytes(args.memory)
+    status = run_manifest(jobs, args.outdir, workers=args.workers,
+                          pairs=args.pairs, memory_budget=memory,
+                          force=args.force)
+    return 1 if "failed" in status.values() else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,12 +20,10 @@ Method:
 """
 
 import itertools
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import karta
-from karta.raster.band import SimpleBand
 
-from . import correlate
+from . import instrument
+from . import utilities
 
 def _comparison_matrix(n):
     """ Returns a list of 2-combinations of *n* items, and a sparse m×n matrix
@@ -41,7 +39,7 @@ def _comparison_matrix(n):
     return c, C
 
 def compute_vertical_corrections(grids, min_pixel_overlap=100,
-    weighting_func=None, polymasks=()):
+    weighting_func=None, polymasks=(), stats=None):
     """ Perform pairwaise comparisons of a list of DEMs and return a dictionary
     of {index -> vertical correction} that minimizes the misfit between
     overlapping DEMs, subject to weights from *weighting_func(fnm1, fnm2)*.
@@ -63,7 +61,14 @@ def compute_vertical_corrections(grids, min_pixel_overlap=100,
         example to restrict grid correction to comparisons between stable
         bedrock polygons. If empty (default), all data pixels are considered
         valid for comparison.
+    stats : instrument.Stats, optional
+        Recorder for stage timings ("read", "mask", "compare", "solve") and
+        counts ("pairs_compared", "pairs_insufficient_overlap").
     """
+    import karta
+    from karta.raster.band import SimpleBand
+
+    stats = instrument.get_stats(stats)
     if isinstance(grids[0], str):
         gridnames = True
     else:
@@ -78,10 +83,11 @@ def compute_vertical_corrections(grids, min_pixel_overlap=100,
     CD = []
     for i, j in c:
         if gridnames:
-            dem0 = karta.read_gtiff(grids[i], bandclass=SimpleBand)
-            dem1 = karta.read_gtiff(grids[j], bandclass=SimpleBand)
-            dem0.values[dem0.values<-1000000] = np.nan
-            dem1.values[dem1.values<-1000000] = np.nan
+            with stats.timer("read"):
+                dem0 = karta.read_gtiff(grids[i], bandclass=SimpleBand)
+                dem1 = karta.read_gtiff(grids[j], bandclass=SimpleBand)
+                dem0.values[dem0.values<-1000000] = np.nan
+                dem1.values[dem1.values<-1000000] = np.nan
         else:
             dem0 = grids[i]
             dem1 = grids[j]
@@ -92,30 +98,38 @@ def compute_vertical_corrections(grids, min_pixel_overlap=100,
         # least one polygon in the *mask_count* array variables.
         # Then, set all DEM pixel where *mask_count* is zero to NODATA
         if polymasks is not None and len(polymasks)!=0:
-            mask_count0 = np.zeros(dem0.size, dtype=np.int16)
-            mask_count1 = np.zeros(dem1.size, dtype=np.int16)
-            for poly in polymasks:
-
-                x = [a[0] for a in poly.get_vertices(dem0.crs)]
-                y = [a[1] for a in poly.get_vertices(dem0.crs)]
-
-                ny, nx = dem0.size
-                msk0 = karta.raster.grid.mask_poly(x, y, nx, ny, dem0.transform)
-                ny, nx = dem1.size
-                msk1 = karta.raster.grid.mask_poly(x, y, nx, ny, dem1.transform)
-
-                mask_count0[msk0] += 1
-                mask_count1[msk1] += 1
-
-            dem0.values[mask_count0==0] = dem0.nodata
-            dem1.values[mask_count1==0] = dem1.nodata
-
-        msk = dem0.data_mask & dem1.data_mask
-        if msk.sum() >= min_pixel_overlap:
-            CD.append(np.mean(dem0[msk] - dem1[msk]))
+            with stats.timer("mask"):
+                mask_count0 = np.zeros(dem0.size, dtype=np.int16)
+                mask_count1 = np.zeros(dem1.size, dtype=np.int16)
+                for poly in polymasks:
+
+                    x = [a[0] for a in poly.get_vertices(dem0.crs)]
+                    y = [a[1] for a in poly.get_vertices(dem0.crs)]
+
+                    ny, nx = dem0.size
+                    msk0 = karta.raster.grid.mask_poly(x, y, nx, ny, dem0.transform)
+                    ny, nx = dem1.size
+                    msk1 = karta.raster.grid.mask_poly(x, y, nx, ny, dem1.transform)
+
+                    mask_count0[msk0] += 1
+                    mask_count1[msk1] += 1
+
+                dem0.values[mask_count0==0] = dem0.nodata
+                dem1.values[mask_count1==0] = dem1.nodata
+
+        with stats.timer("compare"):
+            # compare every pixel with data in both grids, without the
+            # extra passes needed to find their data extents
+            diffstats = utilities.shared_pixel_stats(dem0, dem1,
+                    bbox1=utilities.centre_bbox(dem0),
+                    bbox2=utilities.centre_bbox(dem1))
+        stats.count("pairs_compared")
+        if diffstats.count >= min_pixel_overlap:
+            CD.append(diffstats.mean)
         else:
+            stats.count("pairs_insufficient_overlap")
             CD.append(np.nan)
-        del dem0, dem1, msk
+        del dem0, dem1, diffstats
 
     # Augment C by removing rows where there is no appreciable overlap
     Ca = C[~np.isnan(CD),:]             # Drop non-ovelapping relations
@@ -138,16 +152,17 @@ def compute_vertical_corrections(grids, min_pixel_overlap=100,
     #dz = np.linalg.solve(np.dot(np.dot(Ca.T, Winv), Ca),
     #                     np.dot(np.dot(Ca.T, Winv), -CaD))
 
-    A = np.dot(np.dot(Ca.T, Winv), Ca)
-    RHS = np.dot(np.dot(Ca.T, Winv), -CaD)
+    with stats.timer("solve"):
+        A = np.dot(np.dot(Ca.T, Winv), Ca)
+        RHS = np.dot(np.dot(Ca.T, Winv), -CaD)
 
-    # Append a constraint to ensure that the mean of dz is zero
-    n = A.shape[0]
-    A = np.r_[np.c_[A, np.zeros(n)], np.ones([1,n+1])]
-    RHS = np.r_[RHS, 0.0]
+        # Append a constraint to ensure that the mean of dz is zero
+        n = A.shape[0]
+        A = np.r_[np.c_[A, np.zeros(n)], np.ones([1,n+1])]
+        RHS = np.r_[RHS, 0.0]
 
-    # A^T.A may be singular, so solve system with the pseudoinverse
-    dz = np.dot(np.linalg.pinv(A), RHS)[:-1]
+        # A^T.A may be singular, so solve system with the pseudoinverse
+        dz = np.dot(np.linalg.pinv(A), RHS)[:-1]
     return {i: _dz for i, _dz in zip(corrected_grids, dz)}
 
 def compute_horizontal_corrections(grid_fnms, min_pixel_overlap=100,
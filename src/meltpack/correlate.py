@@ -1,22 +1,144 @@
 from __future__ import division
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from multiprocessing import cpu_count
+from functools import lru_cache
 from math import log
+import time
 import numpy as np
-from scipy import signal
+from scipy import fft as fftpack
 
+from . import accel
+from . import instrument
+from . import sampling
 from . import utilities
 
 def _normalize_chip(chip):
+    """ Return *chip* scaled to zero mean and unit variance, with NaN gaps set
+    to zero (the mean) """
+    return accel.implementation("normalize_chip")(chip)
+
+@accel.register("normalize_chip", "numpy")
+def _normalize_chip_numpy(chip):
+    nans = np.isnan(chip)
+    if nans.any():
+        # normalize data pixels and treat gaps as the mean value
+        s = np.nanstd(chip)
+        if not (s > 0.0):
+            return np.zeros_like(chip)
+        out = (chip-np.nanmean(chip))/s
+        out[nans] = 0.0
+        return out
     s = chip.std()
     if s == 0.0:
         return np.zeros_like(chip)
     else:
         return (chip-chip.mean())/s
 
+def nan_integral(values, bandwidth=1024):
+    """ Return the summed-area table (integral image) of the NaN mask of a 2D
+    array, with a leading row and column of zeros, so that the number of NaNs
+    in values[i0:i1,j0:j1] is
+
+        S[i1,j1] - S[i0,j1] - S[i1,j0] + S[i0,j0]
+
+    Rows are processed *bandwidth* at a time, so *values* may be a memory
+    map. """
+    ny, nx = values.shape
+    dtype = np.int32 if ny*nx < 2**31 else np.int64
+    sat = np.zeros((ny+1, nx+1), dtype=dtype)
+    for i in range(0, ny, bandwidth):
+        inext = min(ny, i+bandwidth)
+        block = np.cumsum(np.isnan(values[i:inext,:]), axis=1, dtype=dtype)
+        np.cumsum(block, axis=0, out=block)
+        sat[i+1:inext+1,1:] = block + sat[i,1:]
+    return sat
+
+def window_nan_counts(sat, i0, i1, j0, j1):
+    """ Count NaNs in the windows [i0:i1,j0:j1] (vectorized) given a summed
+    area table from `nan_integral`. Window bounds are clipped to the table. """
+    ny = sat.shape[0]-1
+    nx = sat.shape[1]-1
+    i0 = np.clip(i0, 0, ny)
+    j0 = np.clip(j0, 0, nx)
+    i1 = np.clip(i1, i0, ny)
+    j1 = np.clip(j1, j0, nx)
+    return sat[i1,j1] - sat[i0,j1] - sat[i1,j0] + sat[i0,j0]
+
 def _autocorrelate(search_chip, ref_chip, mode="valid"):
+    from scipy import signal
     return signal.fftconvolve(search_chip, ref_chip[::-1,::-1], mode=mode)
 
+def _crop_full(c, sshape, rshape, mode):
+    """ Crop a 'full' correlation surface over the last two axes in the same
+    way as `scipy.signal.fftconvolve` """
+    if mode == "full":
+        return c
+    elif mode == "same":
+        newshape = sshape
+    elif mode == "valid":
+        newshape = (sshape[0]-rshape[0]+1, sshape[1]-rshape[1]+1)
+    else:
+        raise ValueError("mode must be one of 'full', 'same', 'valid'")
+    i0 = (c.shape[-2]-newshape[0])//2
+    j0 = (c.shape[-1]-newshape[1])//2
+    return c[...,i0:i0+newshape[0],j0:j0+newshape[1]]
+
+def _window_sums(a, rshape):
+    """ Sums of *a* over every (rh x rw) window overlapping it (zero padded),
+    computed over the last two axes with integral images. The result has the
+    'full' correlation shape. """
+    rh, rw = rshape
+    pad = [(0, 0)]*(a.ndim-2) + [(rh, rh-1), (rw, rw-1)]
+    sat = np.pad(a, pad, mode="constant")
+    np.cumsum(sat, axis=-2, out=sat)
+    np.cumsum(sat, axis=-1, out=sat)
+    return sat[...,rh:,rw:] - sat[...,:-rh,rw:] - sat[...,rh:,:-rw] + sat[...,:-rh,:-rw]
+
+def fast_ncc(search_chips, ref_chips, mode="valid"):
+    """ Compute locally normalized cross-correlation surfaces following Lewis
+    (1995), "Fast normalized cross-correlation".
+
+    The numerator is a single FFT correlation of the search chip with the
+    zero-mean reference chip. The search chip's local means and energies under
+    each reference window position come from integral images, so every value
+    of the surface is a true correlation coefficient in [-1, 1].
+
+    Arguments may be single 2D chips or stacks of equally sized chips with
+    shape (n, ny, nx), in which case a stack of surfaces is returned.
+    Single-precision chips are processed in single precision.
+    *mode* has the same meaning as for `scipy.signal.fftconvolve`; in the
+    "same" and "full" modes, pixels beyond the search chip edges are taken to
+    equal the search chip mean.
+    """
+    f = np.asarray(search_chips)
+    t = np.asarray(ref_chips)
+    dtype = np.result_type(f.dtype, t.dtype, np.float32)
+    f = f.astype(dtype, copy=False)
+    t = t.astype(dtype, copy=False)
+    sshape = f.shape[-2:]
+    rshape = t.shape[-2:]
+    n = rshape[0]*rshape[1]
+
+    # condition the search chips; NCC is invariant to this
+    f = f - f.mean(axis=(-2,-1), keepdims=True)
+    t = t - t.mean(axis=(-2,-1), keepdims=True)
+    tenergy = np.sqrt((t**2).sum(axis=(-2,-1)))[...,np.newaxis,np.newaxis]
+
+    fshape = (sshape[0]+rshape[0]-1, sshape[1]+rshape[1]-1)
+    fftshape = [fftpack.next_fast_len(int(d)) for d in fshape]
+    F = fftpack.rfftn(f, fftshape, axes=(-2,-1))
+    T = fftpack.rfftn(t[...,::-1,::-1], fftshape, axes=(-2,-1))
+    num = fftpack.irfftn(F*T, fftshape, axes=(-2,-1))[...,:fshape[0],:fshape[1]]
+
+    s1 = _window_sums(f, rshape)
+    s2 = _window_sums(f**2, rshape)
+    fenergy = np.sqrt(np.maximum(s2 - s1**2/n, 0.0))
+
+    denom = fenergy*tenergy
+    tol = 1e-8*denom.max(axis=(-2,-1), keepdims=True)
+    c = np.where(denom > tol, num/np.where(denom > tol, denom, 1.0), 0.0)
+    return _crop_full(c, sshape, rshape, mode)
+
 def findpeak(c):
     """ Return in the integer row, column indices of the largest value in array
     *c*. """
@@ -32,6 +154,10 @@ def findpeak_subpixel(c):
     Based on formulae in Debella-Gilo and Kaab (2011), "Sub-pixel precision
     image matching for measuring surface displacements on mass movements using
     normalized cross-correlation." """
+    return accel.implementation("findpeak_subpixel")(c)
+
+@accel.register("findpeak_subpixel", "numpy")
+def _findpeak_subpixel_numpy(c):
     size = c.shape
     idx = np.argmax(c)
     i = idx//size[1]
@@ -60,7 +186,92 @@ def findoffset(size, peak):
     x = peak[1] - size[1]/2
     return x, y
 
-def correlate_chips(search_chip, ref_chip, mode="valid"):
+@lru_cache(maxsize=32)
+def apodization_window(shape, kind="hann", alpha=0.25, dtype=np.float64):
+    """ Return a 2D apodization window of *shape* and *dtype*, either "hann"
+    or "tukey" (with taper fraction *alpha*). Windows are cached per shape, so
+    repeated calls for the same chip size reuse one array; do not modify the
+    result. """
+    from scipy import signal
+    if kind == "hann":
+        wy = signal.windows.hann(shape[0], sym=False)
+        wx = signal.windows.hann(shape[1], sym=False)
+    elif kind == "tukey":
+        wy = signal.windows.tukey(shape[0], alpha, sym=False)
+        wx = signal.windows.tukey(shape[1], alpha, sym=False)
+    else:
+        raise ValueError("window kind must be 'hann' or 'tukey'")
+    w = np.outer(wy, wx).astype(dtype)
+    w.flags.writeable = False
+    return w
+
+def phase_correlate(search_chip, ref_chip, mode="same", window="hann",
+        regularization=1e-3):
+    """ Return the phase correlation surface (inverse transform of the
+    normalized cross-power spectrum) between two equal-size chips.
+
+    Both chips are apodized with a cached window (see `apodization_window`).
+    The cross-power spectrum is divided by its magnitude plus
+    *regularization* times the maximum magnitude, which keeps noise in
+    frequencies without signal from biasing subpixel peaks toward zero.
+
+    The surface is shifted so that zero offset is at its centre, like
+    `correlate_chips` with `mode="same"`, which is the only supported mode.
+    """
+    if mode != "same":
+        raise ValueError("phase correlation supports only mode='same'")
+    if search_chip.shape != ref_chip.shape:
+        raise ValueError("phase correlation requires equal-size chips")
+
+    w = apodization_window(search_chip.shape, window,
+                           dtype=np.result_type(search_chip.dtype, np.float32))
+    cps = fftpack.rfft2(search_chip*w) * np.conj(fftpack.rfft2(ref_chip*w))
+    mag = np.abs(cps)
+    mmax = mag.max()
+    if mmax == 0.0:
+        return np.zeros(search_chip.shape, dtype=w.dtype)
+    cps /= mag + regularization*mmax
+    c = fftpack.irfft2(cps, s=search_chip.shape)
+    return np.fft.fftshift(c)
+
+# correlators that compare chips of the same size set this attribute, so that
+# correlate_scenes extracts reference chips at the search chip size
+phase_correlate.equal_size_chips = True
+
+CORRELATORS = {
+        "ncc": _autocorrelate,
+        "fast_ncc": fast_ncc,
+        "phase": phase_correlate,
+        }
+
+def register_correlator(name, func):
+    """ Register a correlator *func(search_chip, ref_chip, mode) -> ndarray*
+    under *name* for use as the *method* argument of `correlate_chips` and
+    `correlate_scenes`. The returned surface must follow the offset
+    convention of `scipy.signal.fftconvolve` with a flipped reference chip.
+    Correlators that require reference chips the size of the search chip
+    should have an `equal_size_chips = True` attribute. """
+    CORRELATORS[name] = func
+
+def get_correlator(method):
+    """ Return the correlator function for *method*, which may be a
+    registered name or a callable """
+    if callable(method):
+        return method
+    try:
+        return CORRELATORS[method]
+    except KeyError:
+        raise ValueError("unknown correlation method '{0}', expected one of "
+                         "{1}".format(method, sorted(CORRELATORS)))
+
+def _strength(c, i, j):
+    cstd = c.std()
+    cmean = c.mean()
+    if cstd == 0.0:
+        cstd = 1e9
+    return (c[int(round(i)),int(round(j))]-cmean)/cstd
+
+def correlate_chips(search_chip, ref_chip, mode="valid", method="ncc", stats=None):
     """ Given two images, compute offsets using normalized cross-correlation.
     This is intended to be useful for image co-registration for feature
     tracking.
@@ -68,35 +279,186 @@ def correlate_chips(search_chip, ref_chip, mode="valid"):
     Set `mode="same"` for image co-registration. Use `mode="valid"` for feature
     tracking.
 
+    *method* selects the correlator: "ncc" to normalize each chip globally
+    before correlating, "fast_ncc" for locally normalized cross-correlation
+    (see `fast_ncc`), which is more robust to brightness variation within the
+    search chip, "phase" for phase correlation (see `phase_correlate`, which
+    requires equal-size chips and `mode="same"`), or any name added with
+    `register_correlator`, or a callable with the same signature.
+
     Returns pixel offsets (tuple) and correlation strength relative to
     correlation standard deviation (float).
-    """
-    c = _autocorrelate(_normalize_chip(search_chip), _normalize_chip(ref_chip), mode=mode)
-    i, j = findpeak_subpixel(c)
-    #i, j = findpeak(c)
-    cstd = c.std()
-    cmean = c.mean()
-    if cstd == 0.0:
-        cstd = 1e9
-    return findoffset(search_chip.shape, (i, j)), \
-           (c[int(round(i)),int(round(j))]-cmean)/cstd
 
-def _do_correlation(searchimage, refimage, refcenter, ox, oy, dx, dy):
+    *stats* is an optional `instrument.Stats` for timing the normalization,
+    FFT, and peak-finding stages.
+    """
+    stats = instrument.get_stats(stats)
+    correlator = get_correlator(method)
+    with stats.timer("normalize"):
+        search_chip = _normalize_chip(search_chip)
+        ref_chip = _normalize_chip(ref_chip)
+    with stats.timer("fft"):
+        c = correlator(search_chip, ref_chip, mode=mode)
+    with stats.timer("peak"):
+        i, j = findpeak_subpixel(c)
+        #i, j = findpeak(c)
+        strength = _strength(c, i, j)
+    return findoffset(search_chip.shape, (i, j)), strength
+
+def correlate_chip_batch(search_chips, ref_chips, mode="valid"):
+    """ Batched form of `correlate_chips` using `fast_ncc` on stacks of
+    equally sized chips with shapes (n, ny, nx).
+
+    Returns an (n x 2) array of pixel offsets and an array of n correlation
+    strengths.
+    """
+    search_chips = np.asarray(search_chips)
+    c = fast_ncc(search_chips, ref_chips, mode=mode)
+    offsets = np.empty([len(c), 2])
+    strengths = np.empty(len(c))
+    for k in range(len(c)):
+        i, j = findpeak_subpixel(c[k])
+        offsets[k] = findoffset(search_chips.shape[-2:], (i, j))
+        strengths[k] = _strength(c[k], i, j)
+    return offsets, strengths
+
+def _do_correlation(searchimage, refimage, refcenter, ox, oy, dx, dy,
+        stats=instrument.NULL_STATS, max_nan_fraction=0.0, method="ncc"):
     """
     searchimage and refimage are numpy arrays
     refcenter is a tuple indicating the physical center of refimage
     ox and oy are offsets applied to the search image in physical units, which are added to the final displacements
     dx and dy are floating point grid spacings
+    stats is an instrument.Stats or NullStats
+    max_nan_fraction is the largest fraction of NaN pixels tolerated in either chip
+    method is the correlation method passed to correlate_chips
     """
-    if np.any(np.isnan(searchimage)) or np.any(np.isnan(refimage)):
+    if max_nan_fraction == 0.0:
+        skip = np.any(np.isnan(searchimage)) or np.any(np.isnan(refimage))
+    else:
+        skip = (np.isnan(searchimage).mean() > max_nan_fraction) or \
+               (np.isnan(refimage).mean() > max_nan_fraction)
+    if skip:
+        stats.count("chips_nan_skipped")
         return refcenter, (np.nan, np.nan), np.nan
-    (x, y), strength = correlate_chips(searchimage, refimage, mode="same")
+    (x, y), strength = correlate_chips(searchimage, refimage, mode="same",
+                                       method=method, stats=stats)
     x_displ = x*dx + ox
     y_displ = y*dy + oy
     return refcenter, (x_displ, y_displ), strength
 
+def _timed_worker(func, stats):
+    """ Wrap a worker function to record its busy time in *stats* """
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.add_time("worker_busy", time.perf_counter()-t0)
+    return wrapper
+
+def _chip_windows(I, J, offi, offj, size, ny, nx):
+    """ Return row and column bounds *(i0, i1, j0, j1)* of chips of *size*
+    (columns, rows) centred at pixels (*I*+*offi*, *J*+*offj*), truncated at
+    the grid edges """
+    I = np.asarray(I, dtype=np.int64) + offi
+    J = np.asarray(J, dtype=np.int64) + offj
+    hx = size[0]//2
+    hy = size[1]//2
+    return (np.maximum(0, I-hy), np.minimum(ny-1, I+hy),
+            np.maximum(0, J-hx), np.minimum(nx-1, J+hx))
+
+def search_size_levels(refsize, searchsize, nlevels=4):
+    """ Return up to *nlevels* FFT-friendly search chip sizes along one axis,
+    spaced geometrically between twice *refsize* and *searchsize*. Sizes are
+    even and fast lengths for `scipy.fft`, except *searchsize* itself, which
+    is always the largest level. """
+    lo = min(2*refsize, searchsize)
+    levels = set([searchsize])
+    for n in np.geomspace(lo, searchsize, nlevels)[:-1]:
+        n = int(np.ceil(n))
+        n += n % 2
+        while fftpack.next_fast_len(n) != n:
+            n += 2
+        if n < searchsize:
+            levels.add(n)
+    return np.array(sorted(levels))
+
+def adaptive_searchsize(uref, vref, dt, dx, dy, refsize, searchsize,
+        uncertainty=None, rel_uncertainty=0.25, ugrad=None, vgrad=None,
+        margin=4, nlevels=4):
+    """ Choose a search chip size for each point from the expected error in
+    the velocity guess.
+
+    The error in each displacement component is taken to be
+
+        (*uncertainty* + *rel_uncertainty* * speed + gradient) * *dt*
+
+    where *uncertainty* is a scalar or per-point array in the units of
+    *uref* and *vref* (default 0), and the optional *ugrad* and *vgrad* are
+    the variation of the guess over one velocity grid cell, which bounds the
+    interpolation error of the guess. The search chip must extend beyond the
+    reference chip by this error plus *margin* pixels on each side. Sizes
+    are rounded up to the levels from `search_size_levels`, so that chips
+    fall into a few groups of equal FFT size, and are never larger than
+    *searchsize*.
+
+    Returns *(sx, sy)*, integer arrays of search chip sizes along each axis,
+    in the same order as *refsize* and *searchsize*.
+    """
+    uref = np.asarray(uref, dtype=np.float64)
+    vref = np.asarray(vref, dtype=np.float64)
+    speed = np.hypot(uref, vref)
+    err = rel_uncertainty*speed
+    if uncertainty is not None:
+        err = err + uncertainty
+    erru = err if ugrad is None else err + np.abs(ugrad)
+    errv = err if vgrad is None else err + np.abs(vgrad)
+
+    pad = np.maximum(np.abs(erru*dt/dx), np.abs(errv*dt/dy))
+    pad = np.ceil(np.nan_to_num(pad, nan=np.inf, posinf=np.inf)) + margin
+
+    sizes = []
+    for axis in (0, 1):
+        levels = search_size_levels(refsize[axis], searchsize[axis], nlevels)
+        need = refsize[axis] + 2*pad
+        k = np.minimum(np.searchsorted(levels, need), len(levels)-1)
+        sizes.append(levels[k])
+    return tuple(sizes)
+
+def _clip_to_overlap(scene1, scene2):
+    bboxc = utilities.overlap_bbox(scene1.data_bbox, scene2.data_bbox)
+    scene1c = scene1.clip(bboxc[0], bboxc[2], bboxc[1], bboxc[3])
+    scene2c = scene2.clip(bboxc[0], bboxc[2], bboxc[1], bboxc[3])
+    return scene1c, scene2c
+
+def _lattice_coords(scene1c, scene2c, resolution):
+    xmin1, xmax1, ymin1, ymax1 = scene1c.extent
+    xmin2, xmax2, ymin2, ymax2 = scene2c.extent
+    xmin = max(xmin1, xmin2)
+    xmax = min(xmax1, xmax2)
+    ymin = max(ymin1, ymin2)
+    ymax = min(ymax1, ymax2)
+    x = np.arange(xmin, xmax, resolution[0])
+    y = np.arange(ymin, ymax, resolution[1])
+    return x, y
+
+def _lattice_transform(x, y, resolution):
+    return (x[0]-0.5*resolution[0], y[0]-0.5*resolution[1],
+            resolution[0], resolution[1], 0.0, 0.0)
+
+def reference_lattice(scene1, scene2, resolution=(50.0, 50.0)):
+    """ Return the *(transform, size)* of the grid whose cell centres are the
+    reference chip locations used by `correlate_scenes` for *scene1*,
+    *scene2*, and *resolution*. """
+    scene1c, scene2c = _clip_to_overlap(scene1, scene2)
+    x, y = _lattice_coords(scene1c, scene2c, resolution)
+    return _lattice_transform(x, y, resolution), (len(y), len(x))
+
 def correlate_scenes(scene1, scene2, uguess, vguess, dt, searchsize=(128, 128),
-        refsize=(32, 32), resolution=(50.0, 50.0), nprocs=None):
+        refsize=(32, 32), resolution=(50.0, 50.0), nprocs=None,
+        max_nan_fraction=0.0, method="ncc", dtype=None, grid=False,
+        adaptive=False, uncertainty=None, rel_uncertainty=0.25, stats=None):
     """ Compute apparent offsets between two scenes at grid points.
 
     scene1 : karta.RegularGrid, earlier scene with features to match
@@ -123,10 +485,60 @@ def correlate_scenes(scene1, scene2, uguess, vguess, dt, searchsize=(128, 128),
         units.
 
     nprocs : number of worker threads to launch
+
+    max_nan_fraction : float, largest fraction of NaN pixels tolerated in a
+        reference or search chip. Chips exceeding this are discarded before
+        any correlation task is created, using integral images of each
+        scene's NaN mask. Tolerated gaps are filled with the chip mean.
+        (default 0.0)
+
+    method : str or callable, correlator used for each chip pair: "ncc"
+        (default) for globally normalized chips, "fast_ncc" for locally
+        normalized cross-correlation, "phase" for phase correlation, or a
+        registered or custom correlator (see `correlate_chips`). Phase
+        correlation compares reference chips of size *searchsize* and
+        ignores *refsize*.
+
+    dtype : numpy dtype, optional, floating point type in which chips are
+        normalized and correlated. By default chips keep the type of the
+        scene values, so float32 scenes are processed in single precision
+        without conversion copies.
+
+    grid : bool, if True, return *(u, v, strength)* as karta.RegularGrids on
+        the lattice of reference chip centres (see `reference_lattice`)
+        rather than arrays of points, with NaN where no offset was found.
+        Displacements are written directly into the grids as chips complete.
+        (default False)
+
+    adaptive : bool, if True, choose the search chip size at each point from
+        the expected error of the velocity guess (see `adaptive_searchsize`)
+        instead of using *searchsize* everywhere, which then becomes the
+        largest size used. Sizes are quantized to a few FFT-friendly levels
+        and chips are dispatched grouped by size. (default False)
+
+    uncertainty : float or karta.RegularGrid, optional, absolute uncertainty
+        of the velocity guess in the units of uguess/vguess, used when
+        *adaptive* is True
+
+    rel_uncertainty : float, uncertainty of the velocity guess as a fraction
+        of the guessed speed, used when *adaptive* is True (default 0.25)
+
+    stats : instrument.Stats, optional recorder for per-stage timings
+        ("clip", "sample", "prescreen", "correlate", and the
+        per-chip "normalize", "fft", "peak", "worker_busy"), chip counts
+        ("chips_attempted", "chips_rejected_shape", "chips_rejected_nan",
+        "chips_nan_skipped", "tasks_completed", and "chips_search_<ny>x<nx>"
+        for each adaptive search size), and gauges ("queue_depth", the
+        largest number of chips submitted to the workers but not yet
+        finished, and "worker_utilisation")
     """
-    bboxc = utilities.overlap_bbox(scene1.data_bbox, scene2.data_bbox)
-    scene1c = scene1.clip(bboxc[0], bboxc[2], bboxc[1], bboxc[3])
-    scene2c = scene2.clip(bboxc[0], bboxc[2], bboxc[1], bboxc[3])
+    stats = instrument.get_stats(stats)
+    equal_size = getattr(get_correlator(method), "equal_size_chips", False)
+    if equal_size and not adaptive:
+        refsize = searchsize
+
+    with stats.timer("clip"):
+        scene1c, scene2c = _clip_to_overlap(scene1, scene2)
     dx, dy = scene2c.resolution
     ny, nx = scene2c.size
 
@@ -137,30 +549,20 @@ def correlate_scenes(scene1, scene2, uguess, vguess, dt, searchsize=(128, 128),
     if nprocs is None:
         nprocs = cpu_count()
 
-    rhx = refsize[0]//2
-    rhy = refsize[1]//2
-    shx = searchsize[0]//2
-    shy = searchsize[1]//2
-
     # compute reference chip centers
-    xmin1, xmax1, ymin1, ymax1 = scene1c.extent
-    xmin2, xmax2, ymin2, ymax2 = scene2c.extent
-    xmin = max(xmin1, xmin2)
-    xmax = min(xmax1, xmax2)
-    ymin = max(ymin1, ymin2)
-    ymax = min(ymax1, ymax2)
-    x = np.arange(xmin, xmax, resolution[0])
-    y = np.arange(ymin, ymax, resolution[1])
+    x, y = _lattice_coords(scene1c, scene2c, resolution)
     Xref, Yref = np.meshgrid(x, y)
     Xref = Xref.ravel()
     Yref = Yref.ravel()
+    cells = np.arange(Xref.size)
 
     # filter out nan locations
-    v1 = scene1c.sample(Xref, Yref)
-    v2 = scene2c.sample(Xref, Yref)
+    with stats.timer("sample"):
+        v1, v2 = sampling.sample_grids([scene1c, scene2c], Xref, Yref)
     mask = np.isnan(v1) | np.isnan(v2)
     Xref = Xref[~mask]
     Yref = Yref[~mask]
+    cells = cells[~mask]
 
     # filter out locations beyond the velocity grid
     vdx, vdy = uguess.resolution
@@ -168,57 +570,311 @@ def correlate_scenes(scene1, scene2, uguess, vguess, dt, searchsize=(128, 128),
     mask = (Xref<xmin+vdx) | (Xref>xmax-vdx) | (Yref<ymin+vdy) | (Yref>ymax-vdy)
     Xref = Xref[~mask]
     Yref = Yref[~mask]
+    cells = cells[~mask]
 
     # get indices for ref centers
     Iref, Jref = scene1c.get_indices(Xref, Yref)
 
-    # compute the *actual* gridded reference chip centers
+    # compute the *actual* gridded reference chip centers. Chips span rows
+    # [I-h, I+h) and columns [J-h, J+h) (see `_chip_windows`), so the centre
+    # of an even-sized chip is the upper-left corner of pixel (I, J), and the
+    # velocity guesses are sampled there
     T = scene1c.transform
     Xref = T[0] + Jref*T[2] + Iref*T[4]
     Yref = T[1] + Iref*T[3] + Jref*T[5]
 
     # compute velocity guesses
-    uref = uguess.sample(Xref, Yref)
-    vref = vguess.sample(Xref, Yref)
+    with stats.timer("sample"):
+        uref, vref = sampling.sample_grids([uguess, vguess], Xref, Yref)
 
     # compute expected offsets
     offx = np.round(uref*dt/dx).astype(np.int16)
     offy = np.round(vref*dt/dy).astype(np.int16)
 
-    # extract chips
-    searchchips = []
-    refchips = []
+    # choose search chip sizes
+    if adaptive:
+        with stats.timer("sample"):
+            if hasattr(uncertainty, "transform"):
+                uncertainty = sampling.sample_grids([uncertainty], Xref, Yref)[0]
+            ue, ve = sampling.sample_grids([uguess, vguess], Xref+vdx, Yref)
+            uw, vw = sampling.sample_grids([uguess, vguess], Xref-vdx, Yref)
+            un, vn = sampling.sample_grids([uguess, vguess], Xref, Yref+vdy)
+            us, vs = sampling.sample_grids([uguess, vguess], Xref, Yref-vdy)
+        ugrad = 0.5*np.maximum(np.abs(ue-uw), np.abs(un-us))
+        vgrad = 0.5*np.maximum(np.abs(ve-vw), np.abs(vn-vs))
+        ssize = adaptive_searchsize(uref, vref, dt, dx, dy, refsize, searchsize,
+                                    uncertainty=uncertainty,
+                                    rel_uncertainty=rel_uncertainty,
+                                    ugrad=ugrad, vgrad=vgrad)
+    else:
+        ssize = (np.full(len(Xref), searchsize[0]), np.full(len(Xref), searchsize[1]))
+    rsize = ssize if equal_size else refsize
+
     val1 = scene1c.values
     val2 = scene2c.values
 
-    for ir, jr, ox, oy in zip(Iref, Jref, offx, offy):
-
-        refchip = val1[max(0, ir-rhy):min(ny-1, ir+rhy),
-                       max(0, jr-rhx):min(nx-1, jr+rhx)]
-        searchchip = val2[max(0, ir+oy-shy):min(ny-1, ir+oy+shy),
-                          max(0, jr+ox-shx):min(nx-1, jr+ox+shx)]
-        refchips.append(refchip)
-        searchchips.append(searchchip)
+    # compute chip windows, and discard chips that are truncated at the scene
+    # edges or contain too many NaNs before any work is dispatched
+    with stats.timer("prescreen"):
+        ri0, ri1, rj0, rj1 = _chip_windows(Iref, Jref, 0, 0, rsize, ny, nx)
+        si0, si1, sj0, sj1 = _chip_windows(Iref, Jref, offy, offx, ssize, ny, nx)
+
+        keep = (ri1-ri0 == rsize[1]) & (rj1-rj0 == rsize[0]) & \
+               (si1-si0 == ssize[1]) & (sj1-sj0 == ssize[0])
+        stats.count("chips_rejected_shape", int(np.count_nonzero(~keep)))
+
+        nan1 = window_nan_counts(nan_integral(val1), ri0, ri1, rj0, rj1)
+        nan2 = window_nan_counts(nan_integral(val2), si0, si1, sj0, sj1)
+        nanok = (nan1 <= max_nan_fraction*rsize[0]*rsize[1]) & \
+                (nan2 <= max_nan_fraction*ssize[0]*ssize[1])
+        stats.count("chips_rejected_nan", int(np.count_nonzero(keep & ~nanok)))
+        keep &= nanok
+
+    # dispatch chips grouped by search size, so that consecutive tasks reuse
+    # the same FFT plans and windows
+    tasks = np.nonzero(keep)[0]
+    tasks = tasks[np.lexsort((ssize[1][tasks], ssize[0][tasks]))]
+    if adaptive and stats.enabled:
+        sizes, counts = np.unique(np.c_[ssize[0][tasks], ssize[1][tasks]],
+                                  axis=0, return_counts=True)
+        for (sx, sy), n in zip(sizes, counts):
+            stats.count("chips_search_{0}x{1}".format(sy, sx), int(n))
+
+    if grid:
+        ugrid = np.full([len(y), len(x)], np.nan)
+        vgrid = np.full([len(y), len(x)], np.nan)
+        sgrid = np.full([len(y), len(x)], np.nan)
+
+    if stats.enabled:
+        worker = _timed_worker(_do_correlation, stats)
+        busy0 = stats.as_dict()["timers"].get("worker_busy", 0.0)
+    else:
+        worker = _do_correlation
 
     # extract chips and farm out to threadpool
-    with ThreadPoolExecutor(nprocs) as executor:
-
-        futures = []
-        for xr, yr, schip, rchip, ox, oy in zip(Xref, Yref, searchchips, refchips, offx, offy):
-
-            if (schip.shape == searchsize) and (rchip.shape == refsize):
-                fut = executor.submit(_do_correlation, schip, rchip,
-                                      (xr, yr), ox*dx, oy*dy, dx, dy)
-                futures.append(fut)
+    with stats.timer("correlate"), ThreadPoolExecutor(nprocs) as executor:
+
+        t0 = time.perf_counter()
+        futures = {}
+        finished = []
+        for k in tasks:
+            rchip = val1[ri0[k]:ri1[k], rj0[k]:rj1[k]]
+            schip = val2[si0[k]:si1[k], sj0[k]:sj1[k]]
+            if dtype is not None:
+                rchip = rchip.astype(dtype, copy=False)
+                schip = schip.astype(dtype, copy=False)
+            fut = executor.submit(worker, schip, rchip, (Xref[k], Yref[k]),
+                                  offx[k]*dx, offy[k]*dy, dx, dy,
+                                  stats=stats, max_nan_fraction=max_nan_fraction,
+                                  method=method)
+            futures[fut] = cells[k]
+            stats.count("chips_attempted")
+            if stats.enabled:
+                # chips submitted but not yet finished
+                fut.add_done_callback(finished.append)
+                stats.gauge("queue_depth", len(futures)-len(finished), peak=True)
 
         for fut in as_completed(futures):
             ref_center, displ, strength = fut.result()
+            stats.count("tasks_completed")
+
+            if grid:
+                ugrid.flat[futures[fut]] = displ[0]
+                vgrid.flat[futures[fut]] = displ[1]
+                sgrid.flat[futures[fut]] = strength
+            else:
+                points.append(ref_center)
+                displs.append(displ)
+                strengths.append(strength)
+
+    if stats.enabled:
+        elapsed = time.perf_counter() - t0
+        busy = stats.as_dict()["timers"].get("worker_busy", 0.0) - busy0
+        stats.gauge("worker_utilisation", busy/(elapsed*nprocs) if elapsed > 0 else 0.0)
+
+    if grid:
+        import karta
+        T = _lattice_transform(x, y, resolution)
+        return tuple(karta.RegularGrid(T, values=a, nodata_value=np.nan)
+                     for a in (ugrid, vgrid, sgrid))
+    return np.array(points), np.array(displs), np.array(strengths)
 
-            points.append(ref_center)
-            displs.append(displ)
-            strengths.append(strength)
+def baseline_pairs(times, min_baseline=0.0, max_baseline=np.inf):
+    """ Return a list of index pairs *(i, j)* such that times[i] < times[j]
+    and min_baseline <= times[j]-times[i] <= max_baseline, ordered by the
+    earlier scene. """
+    order = np.argsort(times, kind="stable")
+    pairs = []
+    for a in range(len(order)):
+        for b in range(a+1, len(order)):
+            i, j = order[a], order[b]
+            baseline = times[j] - times[i]
+            if baseline > max_baseline:
+                break
+            if baseline > 0 and baseline >= min_baseline:
+                pairs.append((int(i), int(j)))
+    return pairs
+
+def _read_scene(scene):
+    if isinstance(scene, str):
+        import karta
+        return karta.read_gtiff(scene)
+    return scene
+
+def correlate_stack(scenes, times, pairs, uguess, vguess, searchsize=(128, 128),
+        refsize=(32, 32), resolution=(50.0, 50.0), nprocs=None,
+        max_nan_fraction=0.0, method="ncc", dtype=None, stats=None):
+    """ Compute apparent offsets for many pairs of scenes from a stack.
+
+    All scenes must share one grid (transform and size). Chip centres,
+    velocity guesses, chip windows, and NaN masks are computed once for the
+    stack or once per scene rather than once per pair, each scene is read
+    once, and chips from all pairs are scheduled on a single pool of
+    *nprocs* worker threads. A scene is released once the last pair that
+    uses it has been scheduled, so pairs sorted by their first scene (as
+    returned by `baseline_pairs`) keep few scenes in memory.
+
+    scenes : list of karta.RegularGrids or GeoTIFF filenames
+
+    times : list of scene acquisition times, in the same time units as
+        uguess/vguess
+
+    pairs : list of (i, j) index pairs of scenes to correlate, with scene i
+        earlier than scene j (see `baseline_pairs`)
+
+    Remaining arguments are as for `correlate_scenes`. *stats* additionally
+    records a "read" timer and a "scenes_loaded" count.
+
+    Returns *(u, v, strength, transform)*, where *u*, *v*, and *strength* are
+    (npairs, ny, nx) arrays of displacements and correlation strengths on the
+    lattice of reference chip centres with the grid *transform*, with NaN
+    where no offset was found.
+    """
+    stats = instrument.get_stats(stats)
+    if getattr(get_correlator(method), "equal_size_chips", False):
+        refsize = searchsize
+    if nprocs is None:
+        nprocs = cpu_count()
+    pairs = [(int(i), int(j)) for i, j in pairs]
+
+    last_use = {}
+    for k, (i, j) in enumerate(pairs):
+        last_use[i] = k
+        last_use[j] = k
+
+    first = pairs[0][0] if len(pairs) != 0 else 0
+    with stats.timer("read"):
+        grid0 = _read_scene(scenes[first])
+    dx, dy = grid0.resolution
+    ny, nx = grid0.size
+
+    # chip centres shared by all pairs
+    x, y = _lattice_coords(grid0, grid0, resolution)
+    transform = _lattice_transform(x, y, resolution)
+    Xlat, Ylat = np.meshgrid(x, y)
+    Xlat = Xlat.ravel()
+    Ylat = Ylat.ravel()
+    cells = np.arange(Xlat.size)
 
-    return np.array(points), np.array(displs), np.array(strengths)
+    vdx, vdy = uguess.resolution
+    xmin, xmax, ymin, ymax = uguess.extent
+    mask = (Xlat<xmin+vdx) | (Xlat>xmax-vdx) | (Ylat<ymin+vdy) | (Ylat>ymax-vdy)
+    Xlat = Xlat[~mask]
+    Ylat = Ylat[~mask]
+    cells = cells[~mask]
+
+    Iref, Jref = grid0.get_indices(Xlat, Ylat)
+    T = grid0.transform
+    Xref = T[0] + Jref*T[2] + Iref*T[4]
+    Yref = T[1] + Iref*T[3] + Jref*T[5]
+
+    with stats.timer("sample"):
+        plan = sampling.SamplingPlan(grid0.transform, grid0.size, Xlat, Ylat)
+        uref, vref = sampling.sample_grids([uguess, vguess], Xref, Yref)
+        ri0, ri1, rj0, rj1 = _chip_windows(Iref, Jref, 0, 0, refsize, ny, nx)
+        refshape = (ri1-ri0 == refsize[1]) & (rj1-rj0 == refsize[0])
+
+    # the first scene has already been read to define the geometry
+    unread = {first: grid0}
+    loaded = {}
+
+    def load(i):
+        """ Return the values, NaN integral image, and valid chip centres of
+        scene *i*, reading it if necessary """
+        if i not in loaded:
+            grid = unread.pop(i, None)
+            if grid is None:
+                with stats.timer("read"):
+                    grid = _read_scene(scenes[i])
+            if (tuple(grid.size) != (ny, nx)) or \
+                    not np.allclose(grid.transform, T):
+                raise ValueError("scenes in a stack must share a grid")
+            with stats.timer("prescreen"):
+                values = grid.values
+                if dtype is not None:
+                    values = values.astype(dtype, copy=False)
+                centres = ~np.isnan(plan.sample_array(values))
+                sat = nan_integral(values)
+            loaded[i] = (values, sat, centres)
+            stats.count("scenes_loaded")
+        return loaded[i]
+
+    def chips():
+        for k, (i, j) in enumerate(pairs):
+            val1, sat1, ok1 = load(i)
+            val2, sat2, ok2 = load(j)
+            dt = times[j] - times[i]
+
+            with stats.timer("prescreen"):
+                offx = np.round(uref*dt/dx).astype(np.int16)
+                offy = np.round(vref*dt/dy).astype(np.int16)
+                si0, si1, sj0, sj1 = _chip_windows(Iref, Jref, offy, offx,
+                                                   searchsize, ny, nx)
+                keep = refshape & (si1-si0 == searchsize[1]) & (sj1-sj0 == searchsize[0])
+                stats.count("chips_rejected_shape", int(np.count_nonzero(~keep)))
+                keep &= ok1 & ok2
+
+                nan1 = window_nan_counts(sat1, ri0, ri1, rj0, rj1)
+                nan2 = window_nan_counts(sat2, si0, si1, sj0, sj1)
+                nanok = (nan1 <= max_nan_fraction*refsize[0]*refsize[1]) & \
+                        (nan2 <= max_nan_fraction*searchsize[0]*searchsize[1])
+                stats.count("chips_rejected_nan", int(np.count_nonzero(keep & ~nanok)))
+                keep &= nanok
+
+            for c in np.nonzero(keep)[0]:
+                stats.count("chips_attempted")
+                yield (k, cells[c],
+                       val2[si0[c]:si1[c], sj0[c]:sj1[c]],
+                       val1[ri0[c]:ri1[c], rj0[c]:rj1[c]],
+                       (Xref[c], Yref[c]), offx[c]*dx, offy[c]*dy)
+
+            for scene in (i, j):
+                if last_use[scene] == k:
+                    loaded.pop(scene, None)
+
+    if stats.enabled:
+        worker = _timed_worker(_do_correlation, stats)
+    else:
+        worker = _do_correlation
+
+    def func(chip):
+        k, cell, schip, rchip, center, ox, oy = chip
+        _, displ, strength = worker(schip, rchip, center, ox, oy, dx, dy,
+                                    stats=stats, max_nan_fraction=max_nan_fraction,
+                                    method=method)
+        return k, cell, displ, strength
+
+    shape = (len(pairs), len(y), len(x))
+    u = np.full(shape, np.nan)
+    v = np.full(shape, np.nan)
+    strength = np.full(shape, np.nan)
+    with stats.timer("correlate"):
+        for k, cell, displ, s in utilities.imap_bounded(func, chips(), nprocs=nprocs):
+            stats.count("tasks_completed")
+            u[k].flat[cell] = displ[0]
+            v[k].flat[cell] = displ[1]
+            strength[k].flat[cell] = s
+    return u, v, strength, transform
 
 def correlate_scenes_at_points(scene1, scene2, uguess, vguess, dt, corrpoints,
         searchsize=(128, 128), refsize=(32, 32), nprocs=None):
@@ -272,8 +928,7 @@ def correlate_scenes_at_points(scene1, scene2, uguess, vguess, dt, corrpoints,
     Yref = np.array([pt.y for pt in corrpoints])
 
     # filter out nan locations
-    v1 = scene1c.sample(Xref, Yref)
-    v2 = scene2c.sample(Xref, Yref)
+    v1, v2 = sampling.sample_grids([scene1c, scene2c], Xref, Yref)
     mask = np.isnan(v1) | np.isnan(v2)
     Xref = Xref[~mask]
     Yref = Yref[~mask]
@@ -294,8 +949,7 @@ def correlate_scenes_at_points(scene1, scene2, uguess, vguess, dt, corrpoints,
     Yref = T[1] + Iref*T[3] + Jref*T[5]
 
     # compute velocity guesses
-    uref = uguess.sample(Xref, Yref)
-    vref = vguess.sample(Xref, Yref)
+    uref, vref = sampling.sample_grids([uguess, vguess], Xref, Yref)
 
     # compute expected offsets
     offx = np.round(uref*dt/dx).astype(np.int16)
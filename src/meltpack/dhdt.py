@@ -1,56 +1,69 @@
 """ Functions for computing time derivatives on grids """
 
 import datetime
-import karta
+import io
 import numpy as np
 
 from . import correlate
+from . import sampling
+from . import utilities
 
-def lagrangian_dhdt(g1, g2, uvel, vvel, timespan=datetime.timedelta(days=1)):
-    """ Compute the Lagrangian time derivative of change between two grids.
+def _advect(x, y, sampler, years, nsteps=1, method="euler"):
+    """ Integrate particle trajectories through a steady velocity field and
+    return the total displacements *(dx, dy)*.
 
     Arguments:
     ----------
-    g1: RegularGrid
-    g2: RegularGrid
-    uvel: RegularGrid, horizontal velocity component
-    vvel: RegularGrid, vertical velocity component
-    timespan: datetime.timedelta [optional], temporal baseline, default 1 day
+    x, y: ndarray, initial particle positions
+    sampler: function *f(x, y) -> (u, v)*
+    years: float, integration time
+    nsteps: int, number of substeps
+    method: str, one of "euler", "rk2" (midpoint), or "rk4"
 
-    Returns:
-    --------
-    ndarray with positions, displacements, and lagrangian elevation change
-
-        [x_0, x_1 .....
-         y_0, y_1 .....
-         dx_0, dx_1 ...
-         dy_0, dy_1 ...
-         z1_0, z1_1 ...
-         z2_0, z2_1 ...]
+    Particles that leave the velocity field get NaN displacements.
     """
+    if method not in ("euler", "rk2", "rk4"):
+        raise ValueError("method must be one of 'euler', 'rk2', 'rk4'")
+    h = years/nsteps
+    xp = x.copy()
+    yp = y.copy()
+    for _ in range(nsteps):
+        u1, v1 = sampler(xp, yp)
+        if method == "euler":
+            xp += h*u1
+            yp += h*v1
+        elif method == "rk2":
+            u2, v2 = sampler(xp+0.5*h*u1, yp+0.5*h*v1)
+            xp += h*u2
+            yp += h*v2
+        else:
+            u2, v2 = sampler(xp+0.5*h*u1, yp+0.5*h*v1)
+            u3, v3 = sampler(xp+0.5*h*u2, yp+0.5*h*v2)
+            u4, v4 = sampler(xp+h*u3, yp+h*v3)
+            xp += h/6.0*(u1 + 2*u2 + 2*u3 + u4)
+            yp += h/6.0*(v1 + 2*v2 + 2*v3 + v4)
+    return xp-x, yp-y
 
-    # create a grid of points that are valid data in g1
-    _ind = np.indices(g1.size)
-    ind = _ind[:,~np.isnan(g1.values)]
-    t1 = g1.transform
-    x = t1[0] + t1[2]*ind[1]
-    y = t1[1] + t1[3]*ind[0]
+def _within_bbox(x, y, bbox, margin):
+    return (x > bbox[0]+margin[0]) & (x < bbox[2]-margin[0]) & \
+           (y > bbox[1]+margin[1]) & (y < bbox[3]-margin[1])
 
-    # sample velocity at every point on the grid (one-sided eulerian integration)
-    u = uvel.sample(x, y)
-    v = vvel.sample(x, y)
+def _dhdt_block(g1, g2, sampler, years, i0, i1, nsteps=1, method="euler"):
+    """ Compute the Lagrangian columns for rows *i0:i1* of *g1*. Positions are
+    kept in double precision regardless of the output type. """
+    # create a grid of points that are valid data in this block of g1
+    I, J = np.nonzero(~np.isnan(g1.values[i0:i1,:]))
+    t1 = g1.transform
+    x = t1[0] + t1[2]*J
+    y = t1[1] + t1[3]*(I+i0)
+    del I, J
 
-    # compute displacements
-    dx = u*timespan.days/365.0 
-    dy = v*timespan.days/365.0 
+    # integrate trajectories from every point on the grid
+    dx, dy = _advect(x, y, sampler, years, nsteps=nsteps, method=method)
 
     # mask out points that aren't within both grids
-    def within_bbox(x, y, bbox, margin):
-        return (x > bbox[0]+margin[0]) & (x < bbox[2]-margin[0]) & \
-               (y > bbox[1]+margin[1]) & (y < bbox[3]-margin[1])
-    
-    mask = within_bbox(x, y, g1.bbox, g1.transform[2:4]) & \
-           within_bbox(x+dx, y+dx, g2.bbox, g2.transform[2:4])
+    mask = _within_bbox(x, y, g1.bbox, g1.transform[2:4]) & \
+           _within_bbox(x+dx, y+dy, g2.bbox, g2.transform[2:4])
 
     x = x[mask]
     y = y[mask]
@@ -66,3 +79,118 @@ def lagrangian_dhdt(g1, g2, uvel, vvel, timespan=datetime.timedelta(days=1)):
     m = ~np.isnan(z1) & ~np.isnan(z2)
     return np.vstack([x[m], y[m], dx[m], dy[m], z1[m], z2[m]])
 
+def _row_blocks(ny, chunksize):
+    return [(i, min(ny, i+chunksize)) for i in range(0, ny, chunksize)]
+
+def iter_lagrangian_dhdt(g1, g2, uvel, vvel, timespan=datetime.timedelta(days=1),
+        nsteps=1, method="euler", chunksize=512, dtype=np.float64, nprocs=1):
+    """ Generator version of `lagrangian_dhdt` that walks *chunksize* rows of
+    *g1* at a time and yields a (6 x n) array for each block, in row order.
+    Memory use is bounded by the block size. With *nprocs* > 1, blocks are
+    computed concurrently in a thread pool.
+    """
+    years = timespan.days/365.0
+    sampler = lambda x, y: sampling.sample_grids([uvel, vvel], x, y)
+    blocks = _row_blocks(g1.size[0], chunksize)
+
+    def func(block):
+        cols = _dhdt_block(g1, g2, sampler, years, block[0], block[1],
+                           nsteps=nsteps, method=method)
+        return cols.astype(dtype, copy=False)
+
+    for cols in utilities.imap_bounded(func, blocks, nprocs=nprocs):
+        yield cols
+
+def lagrangian_dhdt(g1, g2, uvel, vvel, timespan=datetime.timedelta(days=1),
+        nsteps=1, method="euler", chunksize=512, dtype=np.float64, out=None,
+        nprocs=1):
+    """ Compute the Lagrangian time derivative of change between two grids.
+
+    Arguments:
+    ----------
+    g1: RegularGrid
+    g2: RegularGrid
+    uvel: RegularGrid, horizontal velocity component
+    vvel: RegularGrid, vertical velocity component
+    timespan: datetime.timedelta [optional], temporal baseline, default 1 day
+    nsteps: int [optional], number of substeps used to integrate particle
+            trajectories over *timespan* (default 1)
+    method: str [optional], trajectory integrator, one of "euler" (default),
+            "rk2", or "rk4". A single Euler step reproduces the one-sided
+            eulerian estimate; use more steps or a higher-order method for
+            long baselines over fast-flowing ice.
+    chunksize: int [optional], number of rows of g1 processed at a time
+    dtype: output type [optional], e.g. np.float32 to halve output size
+    out: ndarray or str [optional], preallocated (6 x n) output array with
+         enough columns for the result, or a filename to which a
+         memory-mapped .npy output is streamed. Unused trailing columns of an
+         array are filled with NaN.
+    nprocs: int [optional], number of row blocks to process concurrently
+
+    Returns:
+    --------
+    ndarray with positions, displacements, and lagrangian elevation change
+
+        [x_0, x_1 .....
+         y_0, y_1 .....
+         dx_0, dx_1 ...
+         dy_0, dy_1 ...
+         z1_0, z1_1 ...
+         z2_0, z2_1 ...]
+
+    When *out* is an array, the returned array is a view into it. The number
+    of output columns is not known in advance, so without *out* the blocks
+    are concatenated at the end, and a file output is written column by
+    column in Fortran order, with its header updated once all blocks are
+    done.
+    """
+    if isinstance(out, np.ndarray):
+        dtype = out.dtype
+    blocks = iter_lagrangian_dhdt(g1, g2, uvel, vvel, timespan=timespan,
+                                  nsteps=nsteps, method=method,
+                                  chunksize=chunksize, dtype=dtype,
+                                  nprocs=nprocs)
+    if out is None:
+        parts = list(blocks)
+        if len(parts) == 0:
+            return np.empty([6, 0], dtype=dtype)
+        return np.concatenate(parts, axis=1)
+    elif isinstance(out, str):
+        return _stream_npy(out, blocks, dtype)
+    elif out.ndim != 2 or out.shape[0] != 6:
+        raise ValueError("out must have shape (6, n)")
+
+    n = 0
+    for cols in blocks:
+        if n+cols.shape[1] > out.shape[1]:
+            raise ValueError("out has too few columns for the result")
+        out[:,n:n+cols.shape[1]] = cols
+        n += cols.shape[1]
+    out[:,n:] = np.nan
+    return out[:,:n]
+
+def _stream_npy(path, blocks, dtype):
+    """ Write (6 x k) *blocks* to a Fortran-ordered .npy file at *path* as they
+    arrive and return the result as a memory map. NumPy pads .npy headers so
+    that the length along the growth axis can be rewritten in place. """
+    descr = np.lib.format.dtype_to_descr(np.dtype(dtype))
+
+    def header(n):
+        buf = io.BytesIO()
+        np.lib.format.write_array_header_1_0(buf, {"descr": descr,
+                                                   "fortran_order": True,
+                                                   "shape": (6, n)})
+        return buf.getvalue()
+
+    n = 0
+    with open(path, "wb") as f:
+        f.write(header(0))
+        for cols in blocks:
+            np.ascontiguousarray(cols.T, dtype=dtype).tofile(f)
+            n += cols.shape[1]
+        hdr = header(n)
+        if len(hdr) != len(header(0)):
+            raise RuntimeError("cannot update .npy header in place")
+        f.seek(0)
+        f.write(hdr)
+    return np.lib.format.open_memmap(path, mode="r+")
@@ -1,89 +1,378 @@
 """ Use optimization techniques to compute flux or velocity divergence from data.
+
+`divergence` evaluates the upwind finite-volume divergence of gridded fields
+directly. `solve_fluxdiv` and `solve_veldiv` instead estimate smooth fields
+consistent with noisy data by minimizing a regularized misfit functional.
 """
 
-from ._divergence import divergence
-
-# import karta
-# import numpy as np
-# import meltfuncs
-# import scipy.optimize as scopt
-
-# def _devec_grid(grid):
-#     return grid.values.ravel(order='F').astype(np.float64)
-# 
-# def solve_fluxdiv(h, u, v, alpha, options):
-#     """
-#     Arguments:
-#     ----------
-#     h, u, v: karta.RegularGrid, thickness and velocity components
-#     alpha: float, smoothing parameter
-#     options: dict, solver-specific options
-#     """
-# 
-#     ny, nx = h.size
-#     dx, dy = h.transform[2:4]
-#     h_ = _devec_grid(h)
-#     u_ = _devec_grid(u)
-#     v_ = _devec_grid(v)
-#     mask_ = (~np.isnan(h_) & ~np.isnan(u_) & ~np.isnan(v_)).astype(np.int32)
-#     epsh_ = 5*np.ones_like(h)
-#     epsu_ = 1*np.ones_like(h)
-#     epsv_ = 1*np.ones_like(h)
-# 
-#     def f(v):
-#         hg_ = v[:nx*ny]
-#         ug_ = v[nx*ny:2*nx*ny]
-#         vg_ = v[2*nx*ny:]
-#         return meltfuncs.functional(nx, ny, dx, dy, mask_, h_, u_, v_,
-#                                     epsh_, epsu_, epsv_, hg_, ug_, vg_, alpha)
-# 
-#     def g(v):
-#         hg_ = v[:nx*ny]
-#         ug_ = v[nx*ny:2*nx*ny]
-#         vg_ = v[2*nx*ny:]
-#         dJ = meltfuncs.gradient(nx, ny, dx, dy, mask_, h_, u_, v_,
-#                                 epsh_, epsu_, epsv_, hg_, ug_, vg_, alpha)
-#         return np.hstack(dJ)
-# 
-#     guess = np.hstack([h_, u_, v_])
-#     result = scopt.minimize(f, jac=g, method="Newton-CG", **options)
-#     return result
-# 
-# def solve_veldiv(h, u, v, alpha, options):
-#     """
-#     Arguments:
-#     ----------
-#     h, u, v: karta.RegularGrid, thickness and velocity components
-#     alpha: float, smoothing parameter
-#     options: dict, solver-specific options
-#     """
-# 
-#     ny, nx = h.size
-#     dx, dy = h.transform[2:4]
-#     h_ = _devec_grid(h)
-#     u_ = _devec_grid(u)
-#     v_ = _devec_grid(v)
-#     mask_ = (~np.isnan(h_) & ~np.isnan(u_) & ~np.isnan(v_)).astype(np.int32)
-#     epsh_ = 5*np.ones_like(h)
-#     epsu_ = 1*np.ones_like(h)
-#     epsv_ = 1*np.ones_like(h)
-# 
-#     def f(v):
-#         hg_ = v[:nx*ny]
-#         ug_ = v[nx*ny:2*nx*ny]
-#         vg_ = v[2*nx*ny:]
-#         return meltfuncs.functional_veldiv(nx, ny, dx, dy, mask_, h_, u_, v_,
-#                                            epsh_, epsu_, epsv_, hg_, ug_, vg_, alpha)
-# 
-#     def g(v):
-#         hg_ = v[:nx*ny]
-#         ug_ = v[nx*ny:2*nx*ny]
-#         vg_ = v[2*nx*ny:]
-#         dJ = meltfuncs.gradient_veldiv(nx, ny, dx, dy, mask_, h_, u_, v_,
-#                                        epsh_, epsu_, epsv_, hg_, ug_, vg_, alpha)
-#         return np.hstack(dJ)
-# 
-#     guess = np.hstack([h_, u_, v_])
-#     result = scopt.minimize(f, jac=g, method="Newton-CG", **options)
-#     return result
+import numpy as np
+
+from ._divergence import divergence as _divergence
+from ._divergence import divergence_stack as _divergence_stack
+from .tiles import TILE_BYTES, apply_row_tiled, default_tilesize, row_tiles
+from .tiles import is_dask_array, map_overlap_dask
+from .utilities import imap_bounded
+
+def divergence(dx, dy, h, u, v, out=None, tilesize=None, nprocs=1):
+    """ Return the divergence of a vector field using upwind finite volumes.
+
+    Computes
+
+        div(h . <u,v>)
+
+        == h * (du/dx + dv/dy) + u*dh/dx + v*dh/dy
+
+    Arguments
+    ---------
+    dx: float
+    dy: float
+    h: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    out: np.ndarray, optional, (ny-2, nx-2) array (e.g. np.memmap) to write
+         the result into
+    tilesize: int, optional, number of rows to compute at a time
+    nprocs: int, optional, number of row tiles to compute concurrently
+
+    If *h*, *u*, and *v* are all np.float32, the computation is carried out
+    and returned in single precision; otherwise in double precision. When
+    *out* or *tilesize* are given, or any input is memory mapped, the grids
+    are processed in overlapping bands of rows. If any input is a dask
+    array, a lazy (ny-2, nx-2) dask array is returned and *out*,
+    *tilesize*, and *nprocs* are ignored.
+    """
+    if any(is_dask_array(a) for a in (h, u, v)):
+        dtype = np.float32 if all(a.dtype == np.float32 for a in (h, u, v)) \
+                else np.float64
+        return map_overlap_dask(lambda h_, u_, v_: _divergence(dx, dy, h_, u_, v_),
+                                [h, u, v], halo=2, shrink=1, dtype=dtype)
+    if out is None and tilesize is None and \
+            not any(isinstance(a, np.memmap) for a in (h, u, v)):
+        return _divergence(dx, dy, h, u, v)
+    return apply_row_tiled(lambda h_, u_, v_: _divergence(dx, dy, h_, u_, v_),
+                           [h, u, v], halo=2, shrink=1, out=out,
+                           tilesize=tilesize, nprocs=nprocs)
+
+def divergence_stack(dx, dy, h, u, v, out=None, reduce=None, times=None,
+        tilesize=None, nprocs=1):
+    """ Return the divergence (see `divergence`) of every epoch of a time
+    series of grids.
+
+    Arguments
+    ---------
+    dx: float
+    dy: float
+    h: (nt, ny, nx) array, or (ny, nx) array if thickness is constant
+    u: (nt, ny, nx) array
+    v: (nt, ny, nx) array
+    out: np.ndarray, optional, array (e.g. np.memmap) to write the result
+         into, shaped like the return value
+    reduce: None, "mean", or "trend", optional. If "mean" or "trend", return
+            the (ny-2, nx-2) NaN-ignoring mean or least-squares rate of change
+            of the divergence along time rather than the full
+            (nt, ny-2, nx-2) cube, which is then never stored.
+    times: (nt,) array, epoch times, required for reduce="trend"
+    tilesize: int, optional, number of rows to compute at a time
+    nprocs: int, optional, number of blocks to compute concurrently
+
+    Inputs may be np.memmaps. The stack is processed in blocks of epochs and
+    overlapping bands of rows, each computed by one compiled call that reuses
+    its flux buffers for every epoch. Results are identical to calling
+    `divergence` on each epoch.
+    """
+    nt, ny, nx = u.shape
+    if v.shape != u.shape or h.shape[-2:] != u.shape[1:] or \
+            (h.ndim == 3 and h.shape[0] != nt):
+        raise ValueError("h, u, and v must have matching shapes")
+    if reduce not in (None, "mean", "trend"):
+        raise ValueError("reduce must be None, 'mean', or 'trend'")
+    if reduce == "trend":
+        if times is None or len(times) != nt:
+            raise ValueError("reduce='trend' requires one time per epoch")
+        times = np.asarray(times, dtype=np.float64)
+        times = times - times.mean()
+
+    dtype = np.float32 if h.dtype == u.dtype == v.dtype == np.float32 \
+            else np.float64
+    nyout, nxout = ny-2, nx-2
+    if tilesize is None:
+        # size row tiles from one epoch of each input
+        planes = [u[0], v[0]] if h.ndim == 2 else [h[0], u[0], v[0]]
+        tilesize = default_tilesize(planes, halo=2, tile_bytes=TILE_BYTES)
+    bandbytes = (tilesize+4)*nx*np.dtype(dtype).itemsize*3
+    nepochs = int(max(1, min(nt, TILE_BYTES // bandbytes)))
+
+    def func(block):
+        t0, t1, (o0, o1, a, b) = block
+        hb = h[a:b] if h.ndim == 2 else h[t0:t1,a:b]
+        hb = np.asarray(hb, dtype=dtype)
+        if hb.ndim == 2:
+            hb = np.broadcast_to(hb, (t1-t0,)+hb.shape)
+        if direct and (a, b) == (0, ny):
+            # the band spans the grid, so write into the output in place
+            _divergence_stack(dx, dy, hb,
+                              np.asarray(u[t0:t1], dtype=dtype),
+                              np.asarray(v[t0:t1], dtype=dtype), out[t0:t1])
+            return t0, t1, o0, o1, None
+        result = np.empty((t1-t0, b-a-2, nxout), dtype=dtype)
+        _divergence_stack(dx, dy, hb,
+                          np.asarray(u[t0:t1,a:b], dtype=dtype),
+                          np.asarray(v[t0:t1,a:b], dtype=dtype), result)
+        return t0, t1, o0, o1, result[:,o0-a:o1-a]
+
+    blocks = ((t0, min(nt, t0+nepochs), bounds)
+              for bounds in row_tiles(nyout, ny, tilesize, halo=2, shrink=1)
+              for t0 in range(0, nt, nepochs))
+
+    if reduce is None:
+        if out is None:
+            out = np.empty((nt, nyout, nxout), dtype=dtype)
+        direct = (out.dtype == dtype)
+        for t0, t1, o0, o1, result in imap_bounded(func, blocks, nprocs=nprocs):
+            if result is not None:
+                out[t0:t1,o0:o1] = result
+        return out
+
+    direct = False
+
+    # accumulate sums along time for each pixel
+    n = np.zeros((nyout, nxout))
+    sy = np.zeros((nyout, nxout))
+    if reduce == "trend":
+        st = np.zeros((nyout, nxout))
+        stt = np.zeros((nyout, nxout))
+        sty = np.zeros((nyout, nxout))
+    for t0, t1, o0, o1, result in imap_bounded(func, blocks, nprocs=nprocs):
+        valid = ~np.isnan(result)
+        values = np.where(valid, result, 0.0)
+        n[o0:o1] += valid.sum(axis=0)
+        sy[o0:o1] += values.sum(axis=0)
+        if reduce == "trend":
+            t = times[t0:t1,np.newaxis,np.newaxis]
+            st[o0:o1] += (valid*t).sum(axis=0)
+            stt[o0:o1] += (valid*t**2).sum(axis=0)
+            sty[o0:o1] += (values*t).sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if reduce == "mean":
+            result = sy/n
+        else:
+            result = (n*sty - st*sy)/(n*stt - st**2)
+            result[n < 2] = np.nan
+    if out is None:
+        out = np.empty((nyout, nxout), dtype=dtype)
+    out[...] = result
+    return out
+
+def _difference_operators(ny, nx, dx, dy):
+    """ Return sparse centred first-difference operators *(Dx, Dy)* mapping a
+    row-major (ny, nx) grid to its (ny-2, nx-2) interior, and the five-point
+    Laplacian *L* mapping that interior to its own interior. """
+    from scipy import sparse
+
+    def d1(n, h):
+        return sparse.diags([-0.5/h, 0.5/h], [0, 2], shape=(n-2, n))
+
+    def d2(n, h):
+        return sparse.diags([1.0/h**2, -2.0/h**2, 1.0/h**2], [0, 1, 2], shape=(n-2, n))
+
+    def interior(n):
+        return sparse.eye(n-2, n, k=1)
+
+    Dx = sparse.kron(interior(ny), d1(nx, dx), format="csr")
+    Dy = sparse.kron(d1(ny, dy), interior(nx), format="csr")
+    L = (sparse.kron(interior(ny-2), d2(nx-2, dx)) +
+         sparse.kron(d2(ny-2, dy), interior(nx-2))).tocsr()
+    return Dx, Dy, L
+
+def _restrict(A, cols):
+    """ Restrict operator *A* to the columns selected by boolean *cols*,
+    keeping only rows whose stencil lies entirely within those columns.
+    Returns the restricted operator and the boolean row selection. """
+    outside = abs(A).dot((~cols).astype(np.float64))
+    rows = (outside == 0) & (abs(A).dot(np.ones(A.shape[1])) != 0)
+    return A[rows][:,cols], rows
+
+def _operators(ny, nx, dx, dy, domain):
+    """ Assemble difference operators restricted to the unknowns in *domain*
+    (a flattened boolean grid). Returns *(Dx, Dy, L, qcells)*, where
+    *qcells* are the flat grid indices at which the divergence is defined. """
+    Dx, Dy, L = _difference_operators(ny, nx, dx, dy)
+    Dx, qx = _restrict(Dx, domain)
+    Dy, qy = _restrict(Dy, domain)
+    iy, ix = np.mgrid[1:ny-1,1:nx-1]
+    interior = (iy*nx + ix).ravel()
+
+    # the divergence is defined at cells in the domain whose stencils are
+    # entirely within the domain
+    q = qx & qy & domain[interior]
+    Dx = Dx[q[qx]]
+    Dy = Dy[q[qy]]
+    L, _ = _restrict(L, q)
+    return Dx, Dy, L, interior[q]
+
+def _grid_arrays(*grids):
+    return [np.asarray(g.values, dtype=np.float64) for g in grids]
+
+def _as_field(value, domain, shape):
+    return np.broadcast_to(np.asarray(value, dtype=np.float64), shape).ravel()[domain]
+
+def _minimize(func, x0, method, options):
+    import scipy.optimize as scopt
+    return scopt.minimize(func, x0, jac=True, method=method,
+                          options={} if options is None else options)
+
+def _unflatten(x, cells, shape):
+    out = np.full(shape[0]*shape[1], np.nan)
+    out[cells] = x
+    return out.reshape(shape)
+
+def _fluxdiv_functional(Dx, Dy, L, h0, u0, v0, wh, wu, wv, alpha):
+    """ Return a function of the stacked unknowns [h, u, v] returning the
+    flux divergence functional and its gradient """
+    n = len(h0)
+
+    def func(x):
+        hg, ug, vg = x[:n], x[n:2*n], x[2*n:]
+        rh = hg - h0
+        ru = ug - u0
+        rv = vg - v0
+        r = L.dot(Dx.dot(hg*ug) + Dy.dot(hg*vg))
+        J = 0.5*(np.dot(wh*rh, rh) + np.dot(wu*ru, ru) + np.dot(wv*rv, rv)
+                 + alpha*np.dot(r, r))
+
+        g = L.T.dot(r)
+        gx = alpha*Dx.T.dot(g)
+        gy = alpha*Dy.T.dot(g)
+        grad = np.concatenate([wh*rh + ug*gx + vg*gy,
+                               wu*ru + hg*gx,
+                               wv*rv + hg*gy])
+        return J, grad
+    return func
+
+def _veldiv_functional(Dx, Dy, L, u0, v0, wu, wv, alpha):
+    """ Return a function of the stacked unknowns [u, v] returning the
+    velocity divergence functional and its gradient """
+    n = len(u0)
+
+    def func(x):
+        ug, vg = x[:n], x[n:]
+        ru = ug - u0
+        rv = vg - v0
+        r = L.dot(Dx.dot(ug) + Dy.dot(vg))
+        J = 0.5*(np.dot(wu*ru, ru) + np.dot(wv*rv, rv) + alpha*np.dot(r, r))
+        g = alpha*L.T.dot(r)
+        grad = np.concatenate([wu*ru + Dx.T.dot(g), wv*rv + Dy.T.dot(g)])
+        return J, grad
+    return func
+
+def solve_fluxdiv(h, u, v, alpha, epsh=5.0, epsu=1.0, epsv=1.0, mask=None,
+        method="L-BFGS-B", options=None):
+    """ Estimate a smooth ice flux divergence from noisy thickness and velocity.
+
+    Finds thickness and velocity fields *hg*, *ug*, *vg* minimizing
+
+        J = 1/2 sum ((hg-h)/epsh)^2 + ((ug-u)/epsu)^2 + ((vg-v)/epsv)^2
+          + alpha/2 sum (L div(hg . <ug,vg>))^2
+
+    where L is the five-point Laplacian, so that *alpha* trades misfit to the
+    data against roughness of the flux divergence. Difference operators are
+    assembled once as sparse matrices, and the functional and its analytical
+    gradient are evaluated with sparse products. Unknowns are restricted to
+    cells where *h*, *u*, and *v* all have data (and *mask*, if given, is
+    True).
+
+    Arguments:
+    ----------
+    h, u, v: karta.RegularGrid, thickness and velocity components
+    alpha: float, smoothing parameter
+    epsh, epsu, epsv: float or array, data uncertainties (default 5, 1, 1)
+    mask: boolean array, optional, additional restriction of the solution
+    method: str, scipy.optimize.minimize method using a gradient, e.g.
+            "L-BFGS-B" (default) or "CG"
+    options: dict, solver-specific options
+
+    Returns:
+    --------
+    hg, ug, vg, div: karta.RegularGrids of the solution fields and their flux
+                     divergence, NaN outside the solution domain
+    result: scipy.optimize.OptimizeResult
+    """
+    import karta
+
+    ny, nx = h.size
+    dx, dy = h.transform[2:4]
+    h_, u_, v_ = _grid_arrays(h, u, v)
+    domain = ~np.isnan(h_) & ~np.isnan(u_) & ~np.isnan(v_)
+    if mask is not None:
+        domain &= np.asarray(mask, dtype=bool)
+    domain = domain.ravel()
+
+    Dx, Dy, L, qcells = _operators(ny, nx, dx, dy, domain)
+    n = np.count_nonzero(domain)
+    h0 = h_.ravel()[domain]
+    u0 = u_.ravel()[domain]
+    v0 = v_.ravel()[domain]
+    wh = 1.0/_as_field(epsh, domain, (ny, nx))**2
+    wu = 1.0/_as_field(epsu, domain, (ny, nx))**2
+    wv = 1.0/_as_field(epsv, domain, (ny, nx))**2
+
+    func = _fluxdiv_functional(Dx, Dy, L, h0, u0, v0, wh, wu, wv, alpha)
+    result = _minimize(func, np.concatenate([h0, u0, v0]), method, options)
+    hg, ug, vg = result.x[:n], result.x[n:2*n], result.x[2*n:]
+    div = Dx.dot(hg*ug) + Dy.dot(hg*vg)
+
+    cells = np.nonzero(domain)[0]
+    T = h.transform
+    grids = [karta.RegularGrid(T, values=_unflatten(a, cells, (ny, nx)), nodata_value=np.nan)
+             for a in (hg, ug, vg)]
+    grids.append(karta.RegularGrid(T, values=_unflatten(div, qcells, (ny, nx)),
+                                   nodata_value=np.nan))
+    return tuple(grids) + (result,)
+
+def solve_veldiv(u, v, alpha, epsu=1.0, epsv=1.0, mask=None,
+        method="L-BFGS-B", options=None):
+    """ Estimate a smooth velocity divergence from noisy velocity components.
+
+    Finds velocity fields *ug*, *vg* minimizing
+
+        J = 1/2 sum ((ug-u)/epsu)^2 + ((vg-v)/epsv)^2
+          + alpha/2 sum (L div(<ug,vg>))^2
+
+    See `solve_fluxdiv` for the meaning of the arguments.
+
+    Returns:
+    --------
+    ug, vg, div: karta.RegularGrids of the solution fields and their
+                 divergence, NaN outside the solution domain
+    result: scipy.optimize.OptimizeResult
+    """
+    import karta
+
+    ny, nx = u.size
+    dx, dy = u.transform[2:4]
+    u_, v_ = _grid_arrays(u, v)
+    domain = ~np.isnan(u_) & ~np.isnan(v_)
+    if mask is not None:
+        domain &= np.asarray(mask, dtype=bool)
+    domain = domain.ravel()
+
+    Dx, Dy, L, qcells = _operators(ny, nx, dx, dy, domain)
+    n = np.count_nonzero(domain)
+    u0 = u_.ravel()[domain]
+    v0 = v_.ravel()[domain]
+    wu = 1.0/_as_field(epsu, domain, (ny, nx))**2
+    wv = 1.0/_as_field(epsv, domain, (ny, nx))**2
+
+    func = _veldiv_functional(Dx, Dy, L, u0, v0, wu, wv, alpha)
+    result = _minimize(func, np.concatenate([u0, v0]), method, options)
+    ug, vg = result.x[:n], result.x[n:]
+    div = Dx.dot(ug) + Dy.dot(vg)
 
+    cells = np.nonzero(domain)[0]
+    T = u.transform
+    grids = [karta.RegularGrid(T, values=_unflatten(a, cells, (ny, nx)), nodata_value=np.nan)
+             for a in (ug, vg)]
+    grids.append(karta.RegularGrid(T, values=_unflatten(div, qcells, (ny, nx)),
+                                   nodata_value=np.nan))
+    return tuple(grids) + (result,)
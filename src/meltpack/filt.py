@@ -1,2 +1,131 @@
-from ._smooth import smooth5, smooth5_int
-from ._medianfilt import medianfilt
+""" Nodata-aware smoothing and median filters for gridded data.
+
+`smooth5` and `medianfilt` accept np.memmap inputs and outputs. When *out* or
+*tilesize* is given (or the input is memory mapped), the grid is filtered in
+bands of rows with enough overlap that the result is identical to filtering
+it in one piece.
+
+`filter_pipeline` applies a sequence of filters in a single tiled pass, so
+each band of rows is read and written once for the whole sequence rather
+than once per filter.
+
+All three also accept `dask.array` inputs, and then return lazy dask arrays
+computed block by block with overlapping halos (see
+`tiles.map_overlap_dask`).
+"""
+
+import numpy as np
+
+from ._smooth import smooth5 as _smooth5
+from ._smooth import smooth5_int
+from ._medianfilt import medianfilt as _medianfilt
+from .tiles import apply_row_tiled, is_dask_array, map_overlap_dask
+
+def _float_type(dtype):
+    return np.float32 if dtype == np.float32 else np.float64
+
+def _tiled(img, out, tilesize):
+    return (out is not None) or (tilesize is not None) or isinstance(img, np.memmap)
+
+def smooth5(img, niter=1, out=None, tilesize=None, nprocs=1):
+    """ Apply a five-point smoothing kernel to *img* *niter* times.
+    Arguments:
+    img: np.ndarray[np.float32] or np.ndarray[np.float64]; other types are
+         converted to np.float64
+    niter: int
+    out: ndarray, optional, array (e.g. np.memmap) to write the result into
+    tilesize: int, optional, number of rows to filter at a time
+    nprocs: int, optional, number of row tiles to filter concurrently
+
+    The result has the same floating point type as *img*. If *img* is a dask
+    array, a lazy dask array is returned and *out*, *tilesize*, and *nprocs*
+    are ignored.
+    """
+    if is_dask_array(img):
+        return map_overlap_dask(lambda block: _smooth5(block, niter), [img],
+                                halo=max(niter, 1), dtype=_float_type(img.dtype))
+    if not _tiled(img, out, tilesize):
+        return _smooth5(img, niter)
+    return apply_row_tiled(lambda tile: _smooth5(tile, niter), [img],
+                           halo=max(niter, 1), out=out, tilesize=tilesize,
+                           nprocs=nprocs)
+
+def medianfilt(img, out=None, tilesize=None, nprocs=1):
+    """ Perform a nodata-aware 3x3 median filtering operation on *img*.
+    Arguments:
+    img: np.ndarray[np.float32] or np.ndarray[np.float64]; other types are
+         converted to np.float64
+    out: ndarray, optional, array (e.g. np.memmap) to write the result into
+    tilesize: int, optional, number of rows to filter at a time
+    nprocs: int, optional, number of row tiles to filter concurrently
+
+    The result has the same floating point type as *img*. If *img* is a dask
+    array, a lazy dask array is returned and *out*, *tilesize*, and *nprocs*
+    are ignored.
+    """
+    if is_dask_array(img):
+        return map_overlap_dask(_medianfilt, [img], halo=1,
+                                dtype=_float_type(img.dtype))
+    if not _tiled(img, out, tilesize):
+        return _medianfilt(img)
+    return apply_row_tiled(_medianfilt, [img], halo=1, out=out,
+                           tilesize=tilesize, nprocs=nprocs)
+
+def _threshold(img, vmin=None, vmax=None):
+    img = np.array(img, copy=True)
+    with np.errstate(invalid="ignore"):
+        if vmin is not None:
+            img[img < vmin] = np.nan
+        if vmax is not None:
+            img[img > vmax] = np.nan
+    return img
+
+def _pipeline_stage(stage):
+    """ Return *(func, reach)* for a pipeline stage specification """
+    if isinstance(stage, str):
+        stage = (stage,)
+    name, args = stage[0], tuple(stage[1:])
+    if name == "median":
+        return _medianfilt, 1
+    elif name == "smooth":
+        niter = args[0] if len(args) != 0 else 1
+        return (lambda img: _smooth5(img, niter)), niter
+    elif name == "threshold":
+        return (lambda img: _threshold(img, *args)), 0
+    raise ValueError("unknown filter stage '{0}'".format(name))
+
+def filter_pipeline(img, stages, out=None, tilesize=None, nprocs=1):
+    """ Apply a sequence of nodata-aware filters to *img* in one tiled pass.
+
+    Arguments:
+    img: np.ndarray[np.float32] or np.ndarray[np.float64]
+    stages: sequence of stages, each one of
+            "median" - 3x3 median filter (see `medianfilt`)
+            ("smooth", niter) - *niter* five-point smoothing passes (see `smooth5`)
+            ("threshold", vmin, vmax) - set values outside [vmin, vmax] to NaN;
+                                        either bound may be None
+    out: ndarray, optional, array (e.g. np.memmap) to write the result into
+    tilesize: int, optional, number of rows to filter at a time
+    nprocs: int, optional, number of row tiles to filter concurrently
+
+    The result is identical to applying the stages one after another to the
+    whole grid. Each tile carries a halo as deep as the combined reach of
+    all stages. If *img* is a dask array, a lazy dask array is returned.
+    """
+    funcs = []
+    halo = 0
+    for stage in stages:
+        func, reach = _pipeline_stage(stage)
+        funcs.append(func)
+        halo += reach
+
+    def kernel(tile):
+        for func in funcs:
+            tile = func(tile)
+        return tile
+
+    if is_dask_array(img):
+        return map_overlap_dask(kernel, [img], halo=max(halo, 1),
+                                dtype=_float_type(img.dtype))
+    return apply_row_tiled(kernel, [img], halo=max(halo, 1), out=out,
+                           tilesize=tilesize, nprocs=nprocs)
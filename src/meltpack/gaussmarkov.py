@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 """ Implementation of Gauss-Markov estimators """
 
+import logging
+
 import numpy as np
-import scipy.spatial
-from scipy import linalg, sparse
-import scipy.sparse.linalg as splinalg
+
+from . import instrument
+
+logger = logging.getLogger(__name__)
+
+# scipy.spatial and scipy.sparse are imported inside the functions that use them
 
 def _model_covariance_matrix(model, x1, x2):
     """ Build a covariance matrix given two KD-trees and a structure function """
+    import scipy.spatial
     D = scipy.spatial.distance_matrix(x1, x2)
     return model(D)
 
@@ -17,11 +23,24 @@ def _model_covariance_matrix_kd(model, kd1, kd2, maxdist=1e3):
     D.data = model(D.data)
     return D
 
-def _uncertainty(Ryy, Rxy, Rxx_inv):
-    """ Return the diagonal of the prediction uncertainty matrix.
-    (DISEP Eqn 2.398) """
-    P = Ryy - Rxy*Rxx_inv*Rxy.T
-    return P.diagonal()
+def _variance(ryy, Rxy, RxxinvRxy):
+    """ Return the diagonal of the prediction uncertainty matrix
+    Ryy - Rxy^T Rxx^-1 Rxy, given its diagonal *ryy*, as a column-wise sum,
+    without forming the matrix. (DISEP Eqn 2.398) """
+    return ryy - np.einsum("ij,ij->j", Rxy, RxxinvRxy)
+
+def _factorize(Rxx):
+    """ Return a function solving Rxx * a = b for dense or sparse *Rxx* """
+    from scipy import linalg, sparse
+    if sparse.issparse(Rxx):
+        import scipy.sparse.linalg as splinalg
+        return splinalg.splu(Rxx.tocsc()).solve
+    try:
+        c = linalg.cho_factor(Rxx)
+        return lambda b: linalg.cho_solve(c, b)
+    except linalg.LinAlgError:
+        lu = linalg.lu_factor(Rxx)
+        return lambda b: linalg.lu_solve(lu, b)
 
 # def _error_variance(model, Rxy, Rxx_inv):
 #     """ Compute the error variance (Brink version - slow) """
@@ -31,7 +50,7 @@ def _uncertainty(Ryy, Rxy, Rxx_inv):
 #     return eps
 
 def predict(model, Xi, X, Y, eps0=1e-1, maxdist=1e3, compute_uncertainty=False,
-        use_kd_trees=True, demean=True):
+        use_kd_trees=True, demean=True, chunksize=4096, nprocs=1, stats=None):
     """ Return the Gauss-Markov minimum variance estimate for points *Xi* given
     data *Y* observed at *X*.
     (DISEP Eqn 2.397)
@@ -44,6 +63,10 @@ def predict(model, Xi, X, Y, eps0=1e-1, maxdist=1e3, compute_uncertainty=False,
     Y: np.ndarray, (n)
     eps0: zero lag variance, or measurement error
     compute_uncertainty: boolean, optional
+    chunksize: int, optional, number of prediction points evaluated at a time
+    nprocs: int, optional, number of chunks evaluated concurrently
+    stats: instrument.Stats, optional recorder for stage timings
+           ("covariance", "factorize", "predict", "uncertainty")
 
     Returns:
     --------
@@ -52,52 +75,70 @@ def predict(model, Xi, X, Y, eps0=1e-1, maxdist=1e3, compute_uncertainty=False,
 
     Notes:
     ------
+    The data covariance matrix is factorized once. Predictions and the
+    diagonal of the uncertainty matrix are then computed for *chunksize*
+    prediction points at a time, so memory use is independent of the number
+    of prediction points.
+
     Oceanographers call this optimal interpolation, or objective analysis.
     Geologists call this simple kriging.
     """
-    # Matrix inversion and multiplication are somewhat slow
-    # Error variance is extremely slow with the current algorithm
+    from .utilities import imap_bounded
+
+    stats = instrument.get_stats(stats)
+    stats.count("observations", len(Y))
+    stats.count("predictions", len(Xi))
     if demean:
         Ym = Y.mean()
     else:
         Ym = 0.0
     Yd = Y-Ym
-    
+
     if use_kd_trees:
-        kdx = scipy.spatial.cKDTree(X)
-        kdxi = scipy.spatial.cKDTree(Xi)
-        Rxx = _model_covariance_matrix_kd(model, kdx, kdx, maxdist=maxdist) \
-                + sparse.diags(eps0*np.ones_like(Y), 0)
-        Rxy = _model_covariance_matrix_kd(model, kdx, kdxi, maxdist=maxdist)
+        import scipy.spatial
+        from scipy import sparse
 
-        Rxx_inv = splinalg.inv(Rxx)
-        alpha = Rxx_inv*Rxy
-        # all matrices are CSC
-        Yi = alpha.T*Yd + Ym
+        with stats.timer("covariance"):
+            kdx = scipy.spatial.cKDTree(X)
+            Rxx = _model_covariance_matrix_kd(model, kdx, kdx, maxdist=maxdist) \
+                    + sparse.diags(eps0*np.ones_like(Y), 0)
 
-        if compute_uncertainty:
-            Ryy = _model_covariance_matrix_kd(model, kdxi, kdxi, maxdist=maxdist)
-            epsi = _uncertainty(Ryy, Rxy, Rxx_inv)
-        else:
-            epsi = np.nan*np.empty_like(Yi)
+        def covariance(Xc):
+            Rxy = _model_covariance_matrix_kd(model, kdx, scipy.spatial.cKDTree(Xc),
+                                              maxdist=maxdist)
+            return Rxy, Rxy.toarray() if compute_uncertainty else None
 
     else:
-        if hasattr(eps0, "__iter__"):
-            Rxx = _model_covariance_matrix(model, X, X) + np.diag(eps0)
-        else:
-            Rxx = _model_covariance_matrix(model, X, X) + np.diag(eps0*np.ones_like(Y))
-        Rxy = _model_covariance_matrix(model, X, Xi)
-
-        Rxx_inv = np.linalg.inv(Rxx)
-        alpha = np.dot(Rxx_inv, Rxy)
-        Yi = np.dot(alpha.T, Yd) + Ym
-
+        with stats.timer("covariance"):
+            if hasattr(eps0, "__iter__"):
+                Rxx = _model_covariance_matrix(model, X, X) + np.diag(eps0)
+            else:
+                Rxx = _model_covariance_matrix(model, X, X) + np.diag(eps0*np.ones_like(Y))
+
+        def covariance(Xc):
+            Rxy = _model_covariance_matrix(model, X, Xc)
+            return Rxy, Rxy
+
+    with stats.timer("factorize"):
+        solve = _factorize(Rxx)
+        beta = solve(Yd)
+
+    Yi = np.empty(len(Xi))
+    epsi = np.full(len(Xi), np.nan)
+
+    def evaluate(bounds):
+        i0, i1 = bounds
+        with stats.timer("predict"):
+            Rxy, Rxy_dense = covariance(Xi[i0:i1])
+            Yi[i0:i1] = Rxy.T.dot(beta) + Ym
         if compute_uncertainty:
-            Ryy = _model_covariance_matrix(model, Xi, Xi)
-            epsi = _uncertainty(Ryy, Rxy, Rxx_inv)
-        else:
-            epsi = np.nan*np.empty_like(Yi)
+            with stats.timer("uncertainty"):
+                ryy = model(np.zeros(i1-i0))
+                epsi[i0:i1] = _variance(ryy, Rxy_dense, solve(Rxy_dense))
 
+    chunks = [(i, min(len(Xi), i+chunksize)) for i in range(0, len(Xi), chunksize)]
+    for _ in imap_bounded(evaluate, chunks, nprocs=nprocs):
+        pass
     return Yi, epsi
 
 def _subset_data(X, Y, n):
@@ -109,6 +150,7 @@ def _subset_data(X, Y, n):
 def data_covariance(X, Y, n=500, maxdist=1e3):
     """ Estimate a structure function for data *Y* at positions *X*.
     """
+    from scipy.spatial import cKDTree as KDTree
     x_, y_ = _subset_data(X, Y, n)
     kd = KDTree(x_)
     d = kd.sparse_distance_matrix(kd, maxdist)
@@ -121,6 +163,7 @@ def data_variogram(X, Y, n=500, maxdist=1e3):
 
         2γ(h) = 1/N(h) * Σ(z(x)-z(x+h))²
     """
+    from scipy.spatial import cKDTree as KDTree
     x_, y_ = _subset_data(X, Y, n)
 
     # Compute differences between data
@@ -132,8 +175,10 @@ def data_variogram(X, Y, n=500, maxdist=1e3):
     d = kd.sparse_distance_matrix(kd, maxdist)
     return np.asarray(d.todense()).ravel(), np.abs(G.ravel())
 
-def fill_holes(grid, mask=None, eps0=1e-1, maxdist=1e3, use_kd_trees=True):
-    """ Use GM to fill holes in a grid """
+def fill_holes(grid, mask=None, eps0=1e-1, maxdist=1e3, use_kd_trees=True,
+        compute_uncertainty=False, chunksize=4096, nprocs=1):
+    """ Use GM to fill holes in a grid. If *compute_uncertainty* is True,
+    also return a grid of prediction variance at the filled pixels. """
 
     interp_mask = np.isnan(grid.values)
     data_mask = ~interp_mask
@@ -151,17 +196,22 @@ def fill_holes(grid, mask=None, eps0=1e-1, maxdist=1e3, use_kd_trees=True):
     yo = y[data_mask]
     del x, y
 
-    print(len(xo))
-    print(len(xi))
+    logger.debug("filling %d cells from %d data points", len(xi), len(xo))
 
     def model(x):
         return 10*np.exp(-x**2/200**2)
 
-    zi, _ = predict(model, np.c_[xi, yi], np.c_[xo, yo], grid.values[data_mask],
+    zi, epsi = predict(model, np.c_[xi, yi], np.c_[xo, yo], grid.values[data_mask],
                     eps0=eps0, maxdist=maxdist, use_kd_trees=use_kd_trees,
-                    compute_uncertainty=False)
+                    compute_uncertainty=compute_uncertainty,
+                    chunksize=chunksize, nprocs=nprocs)
 
     newgrid = grid.copy()
     newgrid.values[interp_mask] = zi
+    if compute_uncertainty:
+        vargrid = grid.copy()
+        vargrid.values[:,:] = np.nan
+        vargrid.values[interp_mask] = epsi
+        return newgrid, vargrid
     return newgrid
 
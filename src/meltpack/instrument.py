@@ -0,0 +1,127 @@
+""" Opt-in timers and counters for profiling processing pipelines.
+
+Functions that support instrumentation take a `stats` argument. Passing a
+`Stats` instance collects per-stage wall times and event counts; passing None
+(the default) uses a no-op recorder so that the hooks cost almost nothing.
+
+Example
+-------
+
+    stats = Stats()
+    correlate_scenes(scene1, scene2, uguess, vguess, dt, stats=stats)
+    print(stats.report())
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+class Stats(object):
+    """ Thread-safe accumulator of named stage timers, counters, and gauges.
+
+    timers : total seconds spent in each named stage
+    counts : number of events of each name
+    gauges : most recent (or maximum, for `gauge(..., peak=True)`) value of
+             each named quantity
+
+    If *callback* is given, it is called as *callback(kind, name, value)*
+    whenever a timer stops ("timer", seconds), a counter is incremented
+    ("count", increment), or a gauge is set ("gauge", value).
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.timers = {}
+        self.counts = {}
+        self.gauges = {}
+        self.callback = callback
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Stats(timers={0}, counts={1}, gauges={2})".format(
+                self.timers, self.counts, self.gauges)
+
+    @contextmanager
+    def timer(self, name):
+        """ Context manager adding the wall time of its body to timer *name* """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter()-t0)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+        if self.callback is not None:
+            self.callback("timer", name, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+        if self.callback is not None:
+            self.callback("count", name, n)
+
+    def gauge(self, name, value, peak=False):
+        with self._lock:
+            if peak:
+                value = max(value, self.gauges.get(name, value))
+            self.gauges[name] = value
+        if self.callback is not None:
+            self.callback("gauge", name, value)
+
+    def as_dict(self):
+        with self._lock:
+            return {"timers": dict(self.timers),
+                    "counts": dict(self.counts),
+                    "gauges": dict(self.gauges)}
+
+    def report(self):
+        """ Return a human-readable summary """
+        d = self.as_dict()
+        lines = []
+        for name, seconds in sorted(d["timers"].items(), key=lambda a: -a[1]):
+            lines.append("{0:<28s} {1:12.4f} s".format(name, seconds))
+        for name, n in sorted(d["counts"].items()):
+            lines.append("{0:<28s} {1:12d}".format(name, n))
+        for name, value in sorted(d["gauges"].items()):
+            lines.append("{0:<28s} {1:12.4g}".format(name, value))
+        return "\n".join(lines)
+
+def logging_callback(logger, level=10):
+    """ Return a `Stats` callback that writes each event to *logger* (at
+    DEBUG level by default) """
+    def callback(kind, name, value):
+        logger.log(level, "%s %s %s", kind, name, value)
+    return callback
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+class NullStats(object):
+    """ No-op stand-in for `Stats`, used when instrumentation is disabled """
+
+    enabled = False
+    _context = _NullContext()
+
+    def timer(self, name):
+        return self._context
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def gauge(self, name, value, peak=False):
+        pass
+
+NULL_STATS = NullStats()
+
+def get_stats(stats):
+    """ Return *stats*, or the shared no-op recorder if *stats* is None """
+    return NULL_STATS if stats is None else stats
@@ -1,11 +1,32 @@
-""" Notification helpers """
+""" Notification helpers
+
+`send_mail` sends a single message synchronously. Long-running pipelines
+should instead use a `Notifier`, which reads the mail configuration once,
+keeps one SMTP connection open, and delivers messages from a background
+thread so that callers never wait on the mail server. Messages to the same
+recipient that arrive in a burst are combined into a single digest, and each
+recipient receives at most one email per *min_interval* seconds.
+
+Example
+-------
+
+    with Notifier("mail.conf", "pipeline@example.com") as notifier:
+        for pair in pairs:
+            process(pair)
+            notifier.send("me@example.com", "finished %s" % pair, subject="done")
+"""
 
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.utils import COMMASPACE, formatdate
+import atexit
+import logging
 import os
+import queue
 import smtplib
+import threading
+import time
 
 SMS_ADDRS = {
         "TELUS": "{0}@msg.telus.com",
@@ -17,23 +38,19 @@ SMS_ADDRS = {
         "SPRINT": "{0}@messaging.sprintpcs.com",
         }
 
-def send_sms(mailconf, from_addr, number, provider, msg, subject=""):
-    if provider not in SMS_ADDRS:
-        raise KeyError("provider must be one of:", list(SMS_ADDRS.keys()))
-    raise NotImplementedError
-
+logger = logging.getLogger(__name__)
 
-def send_mail(mailconf, from_addr, to_addr, msg, subject="", attachment=None):
-    """ reads login information from a text file containing:
+def read_mailconf(mailconf):
+    """ Read login information from a text file containing:
 
         smtp.server
         port
         username
         password
 
-    and sends an email containing *msg*
+    and return it as a dictionary. The username and password may be blank
+    for servers that do not require a login.
     """
-
     if not os.path.isfile(mailconf):
         raise IOError("no file %s containing mail login info" % mailconf)
 
@@ -42,11 +59,15 @@ def send_mail(mailconf, from_addr, to_addr, msg, subject="", attachment=None):
         port = f.readline().strip()
         user = f.readline().strip()
         passwd = f.readline().strip()
+    return {"host": host, "port": int(port), "user": user, "passwd": passwd}
 
-    print("%s:%s" % (host, port))
-    print(user)
-    print("--------------------")
+def sms_address(number, provider):
+    """ Return the email-to-SMS gateway address for a phone *number* """
+    if provider not in SMS_ADDRS:
+        raise KeyError("provider must be one of:", list(SMS_ADDRS.keys()))
+    return SMS_ADDRS[provider].format(number)
 
+def _build_message(from_addr, to_addr, msg, subject="", attachments=()):
     mime_msg = MIMEMultipart()
     mime_msg["From"] = from_addr
     mime_msg["To"] = to_addr
@@ -54,18 +75,41 @@ def send_mail(mailconf, from_addr, to_addr, msg, subject="", attachment=None):
     mime_msg["Date"] = formatdate(localtime=True)
     mime_msg.attach(MIMEText(msg))
 
-    if attachment is not None:
+    for attachment in attachments:
         with open(attachment, "rb") as f:
             mime_msg.attach(MIMEApplication(
                 f.read(),
                 Content_Disposition='attachment; filename="%s"' % os.path.basename(attachment),
                 Name=os.path.basename(attachment)))
+    return mime_msg
+
+def _connect(conf, use_ssl=True, timeout=30.0):
+    if use_ssl:
+        smtp = smtplib.SMTP_SSL(conf["host"], conf["port"], timeout=timeout)
+    else:
+        smtp = smtplib.SMTP(conf["host"], conf["port"], timeout=timeout)
+    if conf["user"]:
+        smtp.login(conf["user"], conf["passwd"])
+    return smtp
+
+def send_sms(mailconf, from_addr, number, provider, msg, subject=""):
+    """ Send a text message through an email-to-SMS gateway. The message is
+    queued on the shared `Notifier` for *mailconf* and *from_addr* (see
+    `get_notifier`) and delivered in the background. """
+    address = sms_address(number, provider)
+    get_notifier(mailconf, from_addr).send(address, msg, subject=subject)
+
+def send_mail(mailconf, from_addr, to_addr, msg, subject="", attachment=None,
+        use_ssl=True):
+    """ Read login information from *mailconf* (see `read_mailconf`) and send
+    an email containing *msg*, waiting for the server to accept it.
+    """
+    conf = read_mailconf(mailconf)
+    attachments = () if attachment is None else (attachment,)
+    mime_msg = _build_message(from_addr, to_addr, msg, subject, attachments)
 
     try:
-        smtp = smtplib.SMTP_SSL(host, int(port))
-        _, s = smtp.login(user, passwd)
-        print(s)
-        msg_str = "From: {0}\r\nTo: {1}\r\nSubject: {2}\r\n\r\n{3}".format(from_addr, to_addr, subject, msg)
+        smtp = _connect(conf, use_ssl=use_ssl)
         d = smtp.sendmail(from_addr, to_addr, mime_msg.as_string())
         if len(d) != 0:
             print(d)
@@ -75,9 +119,191 @@ def send_mail(mailconf, from_addr, to_addr, msg, subject="", attachment=None):
         print("Server error:", str(e))
     return
 
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+_STOP = object()
+
+class Notifier(object):
+    """ Background email sender with a persistent SMTP connection.
+
+    Parameters
+    ----------
+    mailconf : str
+        File with the SMTP server, port, username, and password (see
+        `read_mailconf`). Read once, when the Notifier is created.
+    from_addr : str
+        Sender address
+    min_interval : float, optional
+        Minimum number of seconds between emails to one recipient. Messages
+        queued in the meantime are combined into a digest. (default 60)
+    digest_delay : float, optional
+        Number of seconds to wait after a message is queued for others to
+        join it in the same email. (default 5)
+    use_ssl : bool, optional
+        Connect with SMTP over SSL (default True) or plain SMTP.
+    timeout : float, optional
+        Socket timeout for the SMTP connection, in seconds. (default 30)
+
+    Messages that cannot be delivered are logged and kept, with the error, in
+    the `failed` list.
+    """
+
+    def __init__(self, mailconf, from_addr, min_interval=60.0, digest_delay=5.0,
+            use_ssl=True, timeout=30.0):
+        self.conf = read_mailconf(mailconf)
+        self.from_addr = from_addr
+        self.min_interval = min_interval
+        self.digest_delay = digest_delay
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.failed = []
+        self.sent = 0
+        self._smtp = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="meltpack-notifier",
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def send(self, to_addr, msg, subject="", attachment=None):
+        """ Queue an email containing *msg* and return immediately """
+        if not self._thread.is_alive():
+            raise RuntimeError("notifier has been closed")
+        self._queue.put((to_addr, subject, msg, attachment, time.monotonic()))
+
+    def send_sms(self, number, provider, msg, subject=""):
+        """ Queue a text message to be sent through an email-to-SMS gateway """
+        self.send(sms_address(number, provider), msg, subject=subject)
+
+    def flush(self, timeout=None):
+        """ Deliver all queued messages now, ignoring the rate limit, and wait
+        until they have been sent. Returns False if *timeout* expires first. """
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout=None):
+        """ Deliver queued messages, close the SMTP connection, and stop the
+        background thread """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        pending = {}        # recipient -> list of queued messages
+        last_sent = {}      # recipient -> time of last delivery
+        while True:
+            now = time.monotonic()
+            due = [self._due_time(messages, last_sent.get(to_addr))
+                   for to_addr, messages in pending.items()]
+            timeout = max(0.0, min(due)-now) if due else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            # an unexpected error must not stop the thread, or later calls to
+            # flush() would wait forever
+            try:
+                force = (item is _STOP) or isinstance(item, _Flush)
+                if isinstance(item, tuple):
+                    pending.setdefault(item[0], []).append(item[1:])
+
+                now = time.monotonic()
+                for to_addr in list(pending):
+                    if force or now >= self._due_time(pending[to_addr], last_sent.get(to_addr)):
+                        self._deliver(to_addr, pending.pop(to_addr))
+                        last_sent[to_addr] = time.monotonic()
+            except Exception:
+                logger.exception("notifier error")
+            finally:
+                if isinstance(item, _Flush):
+                    item.done.set()
+            if item is _STOP:
+                break
+        self._disconnect()
+
+    def _due_time(self, messages, last_sent):
+        due = messages[0][3] + self.digest_delay
+        if last_sent is not None:
+            due = max(due, last_sent + self.min_interval)
+        return due
+
+    def _deliver(self, to_addr, messages):
+        if len(messages) == 1:
+            subject, body, attachment, _ = messages[0]
+        else:
+            subject = "[{0} notifications] {1}".format(len(messages), messages[0][0])
+            body = "\n\n".join("{0}\n{1}".format(s, m) if s else m
+                               for s, m, _, _ in messages)
+        attachments = [a for _, _, a, _ in messages if a is not None]
+
+        try:
+            mime_msg = _build_message(self.from_addr, to_addr, body, subject,
+                                      attachments)
+            self._sendmail(to_addr, mime_msg.as_string())
+            self.sent += 1
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning("failed to send notification to %s: %s", to_addr, e)
+            self.failed.append((to_addr, messages, e))
+        except Exception as e:
+            # e.g. a message body that is not a string
+            logger.exception("failed to build notification to %s", to_addr)
+            self.failed.append((to_addr, messages, e))
+
+    def _sendmail(self, to_addr, msg_str):
+        # reuse the open connection, reconnecting once if the server has
+        # dropped it
+        for attempt in range(2):
+            if self._smtp is None:
+                self._smtp = _connect(self.conf, use_ssl=self.use_ssl,
+                                      timeout=self.timeout)
+            try:
+                return self._smtp.sendmail(self.from_addr, to_addr, msg_str)
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if attempt == 1:
+                    raise
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+_NOTIFIERS = {}
+_NOTIFIERS_LOCK = threading.Lock()
+
+def get_notifier(mailconf, from_addr, **kw):
+    """ Return a shared `Notifier` for *mailconf* and *from_addr*, creating
+    it on first use with keyword arguments *kw* """
+    key = (os.path.abspath(mailconf), from_addr)
+    with _NOTIFIERS_LOCK:
+        notifier = _NOTIFIERS.get(key)
+        if notifier is None or not notifier._thread.is_alive():
+            notifier = Notifier(mailconf, from_addr, **kw)
+            _NOTIFIERS[key] = notifier
+    return notifier
+
+@atexit.register
+def _close_notifiers():
+    with _NOTIFIERS_LOCK:
+        for notifier in _NOTIFIERS.values():
+            notifier.close()
+        _NOTIFIERS.clear()
+
 if __name__ == "__main__":
 
     # Send a test message, containing the module as an attachment
     send_mail("mail.conf", "cedar@ironicmtn.com", "njwilson23@gmail.com",
               "testing auto mailer", subject="test", attachment="aspmail.py")
-
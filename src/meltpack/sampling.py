@@ -0,0 +1,119 @@
+""" Precomputed bilinear sampling of grids that share a geometry.
+
+Sampling several grids at the same points with `RegularGrid.sample` repeats
+the index and weight computation for every grid. A `SamplingPlan` does that
+work once for a point set and applies it to any number of grids (or bare
+arrays) with the same transform and size.
+
+Values are treated as pixel-centre registered, so that a grid with transform
+(x0, y0, dx, dy, 0, 0) has its value [i,j] located at
+(x0 + (j+0.5)*dx, y0 + (i+0.5)*dy). This is the convention of
+`RegularGrid.sample` in karta, which the plans reproduce, including NaN
+results outside the span of pixel centres.
+"""
+
+import numpy as np
+
+class SamplingPlan(object):
+    """ Bilinear interpolation indices and weights for points *(x, y)* on a
+    grid with *transform* and *size* (ny, nx). Points outside the span of the
+    pixel centres sample as NaN.
+
+    Example
+    -------
+
+        plan = SamplingPlan.from_grid(uvel, x, y)
+        u, v = plan.sample(uvel, vvel)
+    """
+
+    def __init__(self, transform, size, x, y):
+        if any(a != 0 for a in transform[4:6]):
+            raise ValueError("SamplingPlan does not support skewed grids")
+        self.transform = tuple(transform)
+        self.size = tuple(size)
+
+        x0, y0, dx, dy = self.transform[:4]
+        ny, nx = self.size
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.shape = x.shape
+
+        fj = ((x-x0)/dx - 0.5).ravel()
+        fi = ((y-y0)/dy - 0.5).ravel()
+        inside = (fj >= 0) & (fj <= nx-1) & (fi >= 0) & (fi <= ny-1)
+        fj = fj[inside]
+        fi = fi[inside]
+
+        # as in karta's bilinear sampler, a point exactly on a pixel centre
+        # is interpolated between that pixel and the one before it
+        j0 = np.clip(np.ceil(fj).astype(np.intp)-1, 0, max(nx-2, 0))
+        i0 = np.clip(np.ceil(fi).astype(np.intp)-1, 0, max(ny-2, 0))
+        a = fj - j0
+        b = fi - i0
+
+        self.inside = inside
+        self.i0 = i0
+        self.j0 = j0
+        self.i1 = np.minimum(i0+1, ny-1)
+        self.j1 = np.minimum(j0+1, nx-1)
+        self.weights = np.vstack([(1-a)*(1-b), a*(1-b), (1-a)*b, a*b])
+
+    @classmethod
+    def from_grid(cls, grid, x, y):
+        """ Construct a plan for sampling grids like *grid* at *(x, y)* """
+        return cls(grid.transform, grid.size, x, y)
+
+    def __len__(self):
+        return self.inside.size
+
+    def compatible(self, grid):
+        """ Return whether *grid* has the geometry this plan was built for """
+        return (tuple(grid.transform) == self.transform) and \
+               (tuple(grid.size) == self.size)
+
+    def sample_array(self, values, out=None):
+        """ Sample a 2D array with the plan's size. Returns an array with the
+        shape of the input points, with the result type of *values*. """
+        if values.shape[:2] != self.size:
+            raise ValueError("array shape {0} does not match plan size "
+                             "{1}".format(values.shape[:2], self.size))
+        dtype = np.result_type(values.dtype, np.float32)
+        if out is None:
+            out = np.empty(self.inside.size, dtype=dtype)
+        else:
+            out = out.reshape(-1)
+        w = self.weights
+        out[~self.inside] = np.nan
+        out[self.inside] = w[0]*values[self.i0,self.j0] + w[1]*values[self.i0,self.j1] \
+                         + w[2]*values[self.i1,self.j0] + w[3]*values[self.i1,self.j1]
+        return out.reshape(self.shape)
+
+    def sample(self, *grids):
+        """ Sample one or more grids sharing the plan's geometry. Returns a
+        single array for one grid, or a list of arrays otherwise. """
+        for grid in grids:
+            if not self.compatible(grid):
+                raise ValueError("grid geometry does not match sampling plan")
+        results = [self.sample_array(grid.values) for grid in grids]
+        if len(results) == 1:
+            return results[0]
+        return results
+
+def sample_grids(grids, x, y):
+    """ Sample each grid in *grids* at *(x, y)*, sharing one `SamplingPlan`
+    between grids with a common geometry and falling back to
+    `RegularGrid.sample` for skewed grids. Returns a list of arrays. """
+    plans = []
+    results = []
+    for grid in grids:
+        if any(a != 0 for a in grid.transform[4:6]):
+            results.append(grid.sample(x, y))
+            continue
+        for plan in plans:
+            if plan.compatible(grid):
+                break
+        else:
+            plan = SamplingPlan.from_grid(grid, x, y)
+            plans.append(plan)
+        results.append(plan.sample_array(grid.values))
+    return results
@@ -0,0 +1,122 @@
+""" Row-tiled application of stencil kernels to large or memory-mapped grids.
+
+A kernel that computes each output row from a neighbourhood of *halo* input
+rows can be applied to a grid one band of rows at a time, reading *halo*
+extra rows above and below each band. Only the bands in flight are held in
+memory, so inputs and outputs may be `np.memmap`s larger than RAM and the
+operating system's page cache streams them from disk.
+
+The same kernels can be applied lazily to `dask.array` inputs with
+`map_overlap_dask`, which exchanges *halo* cells between neighbouring blocks
+in both dimensions. Dask is optional, and is only imported when a dask array
+is passed in.
+"""
+
+import numpy as np
+
+from .utilities import imap_bounded, is_dask_array
+
+# Default number of bytes of input to read per tile
+TILE_BYTES = 64*1024**2
+
+def default_tilesize(arrays, halo=0, tile_bytes=TILE_BYTES):
+    """ Return a number of rows per tile such that one tile of all *arrays*
+    occupies about *tile_bytes* """
+    rowbytes = sum(a.shape[1]*a.dtype.itemsize for a in arrays)
+    return max(1, int(tile_bytes // max(1, rowbytes)) - 2*halo)
+
+def row_tiles(nyout, ny, tilesize, halo, shrink=0):
+    """ Yield *(o0, o1, a, b)* for bands of output rows [o0:o1), where input
+    rows [a:b) are required to compute them. *shrink* is the number of rows
+    a kernel drops from each edge, so that output row k corresponds to input
+    row k+shrink. """
+    for o0 in range(0, nyout, tilesize):
+        o1 = min(nyout, o0+tilesize)
+        a = max(0, o0+shrink-halo)
+        b = min(ny, o1+shrink+halo)
+        yield o0, o1, a, b
+
+def apply_row_tiled(kernel, arrays, halo, shrink=0, out=None, tilesize=None,
+        nprocs=1):
+    """ Apply *kernel(*tiles) -> ndarray* to row bands of 2D *arrays*.
+
+    Arguments:
+    ----------
+    kernel: function of one or more 2D arrays with equal shapes, returning an
+            array that loses *shrink* rows and columns on each edge
+    arrays: list of 2D ndarrays or np.memmaps with equal shapes
+    halo: int, number of input rows on each side that influence an output row,
+          including rows that the kernel treats as edges
+    shrink: int, number of rows and columns the kernel drops from each edge
+    out: ndarray or np.memmap, optional, output array
+    tilesize: int, optional, number of output rows per tile
+    nprocs: int, optional, number of tiles to process concurrently
+
+    Returns:
+    --------
+    out, or a newly allocated array with the kernel's result type
+    """
+    ny, nx = arrays[0].shape
+    for a in arrays[1:]:
+        if a.shape != (ny, nx):
+            raise ValueError("arrays must have equal shapes")
+    if tilesize is None:
+        tilesize = default_tilesize(arrays, halo)
+    nyout = ny - 2*shrink
+    nxout = nx - 2*shrink
+
+    def func(bounds):
+        o0, o1, a, b = bounds
+        result = kernel(*[arr[a:b,:] for arr in arrays])
+        return o0, o1, result[o0-a:o1-a,:]
+
+    for o0, o1, result in imap_bounded(func, row_tiles(nyout, ny, tilesize, halo, shrink),
+                                       nprocs=nprocs):
+        if out is None:
+            out = np.empty([nyout, nxout], dtype=result.dtype)
+        out[o0:o1,:] = result
+    return out
+
+def map_overlap_dask(kernel, arrays, halo, shrink=0, dtype=None):
+    """ Lazily apply *kernel(*blocks) -> ndarray* to 2D dask *arrays* with
+    overlapping blocks.
+
+    Arguments are as for `apply_row_tiled`. Blocks are extended by *halo*
+    cells on each side facing another block, but not at the edges of the
+    grid, so the kernel sees the true grid edges and the result is identical
+    to applying it to the whole grid. *dtype* is the type of the result.
+
+    Returns a dask array with shape (ny-2*shrink, nx-2*shrink).
+    """
+    import dask.array as da
+
+    arrays = [da.asarray(a) for a in arrays]
+    shape = arrays[0].shape
+    for a in arrays[1:]:
+        if a.shape != shape:
+            raise ValueError("arrays must have equal shapes")
+    arrays = [a.rechunk(arrays[0].chunks) for a in arrays]
+
+    def func(*blocks):
+        result = kernel(*blocks)
+        if shrink == 0:
+            return result
+        # restore the block shape so that dask can trim the overlap
+        padded = np.full(blocks[0].shape, np.nan, dtype=result.dtype)
+        padded[shrink:-shrink,shrink:-shrink] = result
+        return padded
+
+    out = da.map_overlap(func, *arrays, depth=halo, boundary="none",
+                         trim=True, align_arrays=False, dtype=dtype)
+    if shrink != 0:
+        out = out[shrink:-shrink,shrink:-shrink]
+    return out
+
+def open_gtiff_memmap(path, mode="r"):
+    """ Return an `np.memmap` of the first band of an uncompressed GeoTIFF.
+    Requires the optional `tifffile` package. """
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError("memory mapping GeoTIFFs requires the tifffile package")
+    return tifffile.memmap(path, mode=mode)
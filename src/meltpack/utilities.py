@@ -1,6 +1,30 @@
-import karta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import warnings
 import numpy as np
 
+def imap_bounded(func, items, nprocs=1):
+    """ Yield *func(item)* for each of *items* in order, computing up to
+    *nprocs* items concurrently in a thread pool. At most 2*nprocs results are
+    held in memory at once. """
+    if nprocs is None or nprocs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(nprocs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2*nprocs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def is_dask_array(a):
+    """ Return whether *a* is a `dask.array.Array`, without importing dask """
+    return type(a).__module__.split(".")[0] == "dask" and hasattr(a, "chunks")
+
 def overlap_bbox(bbox1, bbox2):
     bbox = [max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]),
             min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])]
@@ -8,13 +32,11 @@ def overlap_bbox(bbox1, bbox2):
         raise ValueError("input bounding boxes not overlapping")
     return bbox
 
-def apply_shared_pixels(func, scene1, scene2, nodata=None):
-    """ Apply a function *f(a,b) -> c* to pixels shared between two scenes. """
-    extent = scene1.get_data_extent()
-    bbox1 = (extent[0], extent[2], extent[1], extent[3])
-    extent = scene2.get_data_extent()
-    bbox2 = (extent[0], extent[2], extent[1], extent[3])
+# Default number of bytes of swath data to hold in memory at once when
+# iterating over the pixels shared by two scenes
+MEMORY_BUDGET = 256*1024**2
 
+def _nodata_test(scene1, scene2, nodata):
     if nodata is None:
         nodata = scene1.nodata
 
@@ -25,119 +47,336 @@ def apply_shared_pixels(func, scene1, scene2, nodata=None):
             return a == nodata
 
     assert(isnodata(scene2.nodata))         # require scenes to use same nodata
+    return isnodata
+
+def centre_bbox(grid):
+    """ Return the bounding box *(xmin, ymin, xmax, ymax)* of the pixel
+    centres of an unskewed grid """
+    x0, y0, dx, dy = grid.transform[:4]
+    ny, nx = grid.size
+    xa, xb = x0+0.5*dx, x0+(nx-0.5)*dx
+    ya, yb = y0+0.5*dy, y0+(ny-0.5)*dy
+    return (min(xa, xb), min(ya, yb), max(xa, xb), max(ya, yb))
+
+def _index_range(lo, hi, origin, step, n):
+    """ Return the range [k0, k1) of pixels with centres in [lo, hi] """
+    a = (lo-origin)/step - 0.5
+    b = (hi-origin)/step - 0.5
+    a, b = min(a, b), max(a, b)
+    return max(0, int(np.ceil(a-1e-6))), min(n, int(np.floor(b+1e-6))+1)
+
+def _shared_window(scene1, scene2, bbox1=None, bbox2=None):
+    """ Return the index bounds of the pixels shared by two scenes as
+    *(idx_bounds1, idx_bounds2, ny, nx)*, where idx_bounds are
+    ((row0, col0), (row1, col1)) with exclusive upper bounds, or None if the
+    scenes' data regions do not overlap.
+
+    *bbox1* and *bbox2* are (xmin, ymin, xmax, ymax) bounds on the pixel
+    centres to consider in each scene, by default their data extents. The
+    scenes must share a resolution, with either sign of dy. Raises
+    ValueError otherwise.
+    """
+    if tuple(scene1.transform[2:4]) != tuple(scene2.transform[2:4]) or \
+            any(a != 0 for a in tuple(scene1.transform[4:6])+tuple(scene2.transform[4:6])):
+        raise ValueError("scenes must have equal resolutions and no skew")
+    if bbox1 is None:
+        extent = scene1.get_data_extent()
+        bbox1 = (extent[0], extent[2], extent[1], extent[3])
+    if bbox2 is None:
+        extent = scene2.get_data_extent()
+        bbox2 = (extent[0], extent[2], extent[1], extent[3])
 
-    bbox = overlap_bbox(bbox1, bbox2)
-    dx, dy = scene1.transform[2:4]
-    bbox = (bbox[0]+dx/2, bbox[1]+dy/2, bbox[2]-dx/2, bbox[3]-dy/2)
-
-    # Calculate the bounds of data pixels for each image
-    idx_bounds1 = (scene1.get_indices(bbox[0], bbox[1]),
-                   scene1.get_indices(bbox[2], bbox[3]))
-    idx_bounds2 = (scene2.get_indices(bbox[0], bbox[1]),
-                   scene2.get_indices(bbox[2], bbox[3]))
+    bbox = [max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]),
+            min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])]
+    if (bbox[0] > bbox[2]) or (bbox[1] > bbox[3]):
+        return None
+
+    windows = []
+    for scene in (scene1, scene2):
+        x0, y0, dx, dy = scene.transform[:4]
+        ny, nx = scene.size
+        i0, i1 = _index_range(bbox[1], bbox[3], y0, dy, ny)
+        j0, j1 = _index_range(bbox[0], bbox[2], x0, dx, nx)
+        windows.append((i0, i1, j0, j1))
+
+    ny = min(w[1]-w[0] for w in windows)
+    nx = min(w[3]-w[2] for w in windows)
+    if (ny <= 0) or (nx <= 0):
+        return None
+    if any((w[1]-w[0], w[3]-w[2]) != (ny, nx) for w in windows):
+        warnings.warn("scene pixel grids are not aligned; trimming the shared window")
+    idx_bounds1, idx_bounds2 = [((w[0], w[2]), (w[0]+ny, w[2]+nx)) for w in windows]
+    return idx_bounds1, idx_bounds2, ny, nx
+
+def swath_bandwidth(nx, dtype, memory_budget=MEMORY_BUDGET, nbuffers=4, nprocs=1):
+    """ Return the number of rows of width *nx* and type *dtype* to read at a
+    time so that *nbuffers* row swaths for each of up to 2*nprocs swaths in
+    flight fit within *memory_budget* bytes. """
+    rowbytes = max(1, nx) * np.dtype(dtype).itemsize * nbuffers * 2*max(1, nprocs or 1)
+    return max(1, int(memory_budget // rowbytes))
+
+def map_shared_swaths(swathfunc, scene1, scene2, nodata=None, bbox1=None,
+        bbox2=None, memory_budget=MEMORY_BUDGET, nprocs=1, window=None):
+    """ Yield *swathfunc(swath1, swath2, valid)* for row swaths of the window
+    shared by two scenes, where *valid* is a boolean array marking pixels with
+    data in both swaths. Swaths are sized to fit within *memory_budget* bytes
+    and evaluated concurrently when *nprocs* > 1. Results are yielded in row
+    order. Raises ValueError if the scenes do not overlap.
+
+    *window* is a shared window previously returned by `_shared_window`,
+    which saves recomputing the scenes' data extents.
+    """
+    isnodata = _nodata_test(scene1, scene2, nodata)
+    if window is None:
+        window = _shared_window(scene1, scene2, bbox1, bbox2)
+    if window is None:
+        raise ValueError("input bounding boxes not overlapping")
+    idx_bounds1, idx_bounds2, ny, nx = window
 
     # Choose an appropriate number of rows to read as a time
-    nx = idx_bounds1[1][1] - idx_bounds1[0][1]
-    ny = idx_bounds1[1][0] - idx_bounds1[0][0]
-
-    if nx != (idx_bounds2[1][1] - idx_bounds2[0][1]):
-        print("WARNING: incompatible swath sizes in count_shared_pixels")
-
-    bandwidth = 1000000 // nx      # assuming 4-byte numbers and 400 mb memory use (conservative)
-    output = np.nan*np.zeros([ny, nx], dtype=scene1.values.dtype)
-
-    i = 0
-    while i != ny:
-        inext = min(ny, i+bandwidth)
+    bandwidth = swath_bandwidth(nx, scene1.values.dtype,
+                                memory_budget=memory_budget, nprocs=nprocs)
+    swaths = [(i, min(ny, i+bandwidth)) for i in range(0, ny, bandwidth)]
 
+    def func(bounds):
+        i, inext = bounds
         swath1 = scene1.values[idx_bounds1[0][0]+i:idx_bounds1[0][0]+inext,
                                idx_bounds1[0][1]:idx_bounds1[1][1]]
 
         swath2 = scene2.values[idx_bounds2[0][0]+i:idx_bounds2[0][0]+inext,
                                idx_bounds2[0][1]:idx_bounds2[1][1]]
 
-        output[i:inext,:] = func(swath1, swath2)
-        i = inext
-
-    return output[~np.isnan(output)]
-
-def difference_shared_pixels(scene1, scene2, nodata=None):
+        valid = ~isnodata(swath1)
+        valid &= ~isnodata(swath2)
+        return swathfunc(swath1, swath2, valid)
+
+    for result in imap_bounded(func, swaths, nprocs=nprocs):
+        yield result
+
+def iter_shared_pixels(func, scene1, scene2, nodata=None,
+        memory_budget=MEMORY_BUDGET, nprocs=1):
+    """ Apply a function *f(a,b) -> c* to pixels shared between two scenes,
+    yielding a 1D array of the valid (non-NaN) results for each row swath. """
+    def swathfunc(swath1, swath2, valid):
+        c = np.asarray(func(swath1, swath2))
+        if c.dtype.kind == "f":
+            valid &= ~np.isnan(c)
+        return c[valid]
+
+    return map_shared_swaths(swathfunc, scene1, scene2, nodata=nodata,
+                             memory_budget=memory_budget, nprocs=nprocs)
+
+def apply_shared_pixels(func, scene1, scene2, nodata=None,
+        memory_budget=MEMORY_BUDGET, nprocs=1):
+    """ Apply a function *f(a,b) -> c* to pixels shared between two scenes.
+
+    Returns a 1D array containing the valid (non-NaN) results. Row swaths are
+    read *memory_budget* bytes at a time, and up to *nprocs* swaths are
+    processed concurrently, so scenes whose values are `np.memmap`s are
+    streamed from disk rather than loaded whole.
+
+    If either scene's values are a `dask.array`, the result is a lazy 1D dask
+    array (of unknown length until computed) and *memory_budget* and
+    *nprocs* are ignored.
+    """
+    if any(is_dask_array(s.values) for s in (scene1, scene2)):
+        return _apply_shared_pixels_dask(func, scene1, scene2, nodata)
+    parts = list(iter_shared_pixels(func, scene1, scene2, nodata=nodata,
+                                    memory_budget=memory_budget, nprocs=nprocs))
+    if len(parts) == 0:
+        return np.array([], dtype=scene1.values.dtype)
+    return np.concatenate(parts)
+
+def _apply_shared_pixels_dask(func, scene1, scene2, nodata=None):
+    import dask.array as da
+
+    isnodata = _nodata_test(scene1, scene2, nodata)
+    window = _shared_window(scene1, scene2)
+    if window is None:
+        raise ValueError("input bounding boxes not overlapping")
+    idx_bounds1, idx_bounds2, ny, nx = window
+
+    a = da.asarray(scene1.values)[idx_bounds1[0][0]:idx_bounds1[0][0]+ny,
+                                  idx_bounds1[0][1]:idx_bounds1[1][1]]
+    b = da.asarray(scene2.values)[idx_bounds2[0][0]:idx_bounds2[0][0]+ny,
+                                  idx_bounds2[0][1]:idx_bounds2[1][1]]
+    b = b.rechunk(a.chunks)
+    valid = ~isnodata(a) & ~isnodata(b)
+    c = da.asarray(func(a, b))
+    if c.dtype.kind == "f":
+        valid &= ~da.isnan(c)
+    return c[valid]
+
+def difference_shared_pixels(scene1, scene2, nodata=None, **kw):
     """ Convenience function to return differences between pixels shared
     between two grids. """
-    return apply_shared_pixels(lambda a, b: a-b, scene1, scene2, nodata=nodata)
+    return apply_shared_pixels(lambda a, b: a-b, scene1, scene2, nodata=nodata, **kw)
 
-def count_shared_pixels(scene1, scene2, bbox1=None, bbox2=None, nodata=None):
+def count_shared_pixels(scene1, scene2, bbox1=None, bbox2=None, nodata=None,
+        memory_budget=MEMORY_BUDGET, nprocs=1):
     """ Count the valid data pixels shared between two scenes.
 
     Arguments:
     ----------
     scene1: RegularGrid
     scene2: RegularGrid
-    bbox1: tuple, optional
-    bbox2: tuple, optional
+    bbox1: tuple, optional, (xmin, ymin, xmax, ymax) bounds on the pixel
+           centres of scene1 to compare (default: its data extent)
+    bbox2: tuple, optional, as *bbox1* for scene2
     nodata: nodata value, optional
+    memory_budget: int, optional, bytes of swath data to read at a time
+    nprocs: int, optional, number of swaths to process concurrently
 
     Returns:
     --------
     int
     """
-    if bbox1 is None:
-        extent = scene1.get_data_extent()
-        bbox1 = (extent[0], extent[2], extent[1], extent[3])
-    if bbox2 is None:
-        extent = scene2.get_data_extent()
-        bbox2 = (extent[0], extent[2], extent[1], extent[3])
-    if nodata is None:
-        nodata = scene1.nodata
-
-    if np.isnan(nodata):
-        isnodata = np.isnan
-    else:
-        def isnodata(a):
-            return a == nodata
-
-    assert(isnodata(scene2.nodata))         # require scenes to use same nodata
-
-    try:
-        bbox = overlap_bbox(bbox1, bbox2)
-        dx, dy = scene1.transform[2:4]
-        bbox = (bbox[0]+dx/2, bbox[1]+dy/2, bbox[2]-dx/2, bbox[3]-dy/2)
-    except ValueError:
-        return 0
-
-    if (bbox[2]-bbox[0] <= 0) or (bbox[3]-bbox[1] <= 0):
-        return 0
-
-    # Calculate the bounds of data pixels for each image
-    idx_bounds1 = (scene1.get_indices(bbox[0], bbox[1]),
-                   scene1.get_indices(bbox[2], bbox[3]))
-    idx_bounds2 = (scene2.get_indices(bbox[0], bbox[1]),
-                   scene2.get_indices(bbox[2], bbox[3]))
-
-    # Choose an appropriate number of rows to read as a time
-    nx = idx_bounds1[1][1] - idx_bounds1[0][1]
-    ny = idx_bounds1[1][0] - idx_bounds1[0][0]
-
-    if nx != (idx_bounds2[1][1] - idx_bounds2[0][1]):
-        print("WARNING: incompatible swath sizes in count_shared_pixels")
-
-    if (nx == 0) or (ny == 0):
+    window = _shared_window(scene1, scene2, bbox1, bbox2)
+    if window is None:
         return 0
+    counts = map_shared_swaths(lambda a, b, valid: np.count_nonzero(valid),
+                               scene1, scene2, nodata=nodata, window=window,
+                               memory_budget=memory_budget, nprocs=nprocs)
+    return sum(counts)
+
+class SharedPixelStats(object):
+    """ Streaming summary statistics of differences *a-b*, accumulated one
+    swath at a time. Swath summaries are merged with the pairwise update of
+    Chan et al. (1979) so the variance stays accurate for large offsets.
+
+    If *bins* (an array of histogram edges) is given, a histogram of the
+    differences is accumulated as well, from which approximate percentiles can
+    be read. Values outside the bins are tallied in `underflow` and
+    `overflow`.
+    """
 
-    bandwidth = 2000000 // nx      # assuming 4-byte numbers and 800 mb memory use (conservative)
-    pixel_count = 0
-    i = 0
-    while i != ny:
-        inext = min(ny, i+bandwidth)
-
-        swath1 = scene1.values[idx_bounds1[0][0]+i:idx_bounds1[0][0]+inext,
-                               idx_bounds1[0][1]:idx_bounds1[1][1]]
-
-        swath2 = scene2.values[idx_bounds2[0][0]+i:idx_bounds2[0][0]+inext,
-                               idx_bounds2[0][1]:idx_bounds2[1][1]]
-        i = inext
-
-        pixel_count += np.sum((~isnodata(swath1)) & (~isnodata(swath2)))
+    def __init__(self, bins=None):
+        self.count = 0
+        self.sum = 0.0
+        self._m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self.bins = None if bins is None else np.asarray(bins, dtype=np.float64)
+        self.histogram = None if bins is None else np.zeros(len(bins)-1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def __repr__(self):
+        return "SharedPixelStats(count={0}, mean={1}, std={2})".format(
+                self.count, self.mean, self.std)
+
+    @property
+    def mean(self):
+        return self.sum/self.count if self.count != 0 else np.nan
+
+    @property
+    def var(self):
+        return self._m2/self.count if self.count != 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def sumsq(self):
+        if self.count == 0:
+            return 0.0
+        return self._m2 + self.sum**2/self.count
+
+    def add(self, d):
+        """ Accumulate a 1D array of differences """
+        d = np.asarray(d, dtype=np.float64)
+        d = d[~np.isnan(d)]
+        n = d.size
+        if n == 0:
+            return self
+        s = float(d.sum(dtype=np.float64))
+        m2 = float(((d-s/n)**2).sum(dtype=np.float64))
+
+        if self.count == 0:
+            self.sum, self._m2 = s, m2
+            self.min, self.max = float(d.min()), float(d.max())
+        else:
+            delta = s/n - self.mean
+            self._m2 += m2 + delta**2*self.count*n/(self.count+n)
+            self.sum += s
+            self.min = min(self.min, float(d.min()))
+            self.max = max(self.max, float(d.max()))
+        self.count += n
+
+        if self.bins is not None:
+            h, _ = np.histogram(d, bins=self.bins)
+            self.histogram += h
+            self.underflow += np.count_nonzero(d < self.bins[0])
+            self.overflow += np.count_nonzero(d > self.bins[-1])
+        return self
+
+    def merge(self, other):
+        """ Combine with the statistics accumulated by *other* """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.sum, self._m2 = other.count, other.sum, other._m2
+            self.min, self.max = other.min, other.max
+        else:
+            n = self.count + other.count
+            delta = other.mean - self.mean
+            self._m2 += other._m2 + delta**2*self.count*other.count/n
+            self.sum += other.sum
+            self.count = n
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        if self.bins is not None:
+            self.histogram += other.histogram
+            self.underflow += other.underflow
+            self.overflow += other.overflow
+        return self
+
+    def percentile(self, q):
+        """ Approximate the *q*th percentile (0-100) by linear interpolation
+        within the accumulated histogram. Requires *bins*. """
+        if self.bins is None:
+            raise ValueError("percentiles require histogram bins")
+        if self.count == 0:
+            return np.nan
+        cdf = self.underflow + np.r_[0, np.cumsum(self.histogram)]
+        return float(np.interp(q/100.0*self.count, cdf, self.bins))
+
+    def median(self):
+        return self.percentile(50.0)
+
+def shared_pixel_stats(scene1, scene2, bins=None, nodata=None, bbox1=None,
+        bbox2=None, memory_budget=MEMORY_BUDGET, nprocs=1):
+    """ Compute count, mean, variance, min/max and (optionally) a histogram of
+    the differences *scene1-scene2* over shared data pixels in a single pass,
+    without materializing the differences.
 
-    return pixel_count
+    Arguments:
+    ----------
+    scene1: RegularGrid
+    scene2: RegularGrid
+    bins: array of histogram edges, optional
+    nodata: nodata value, optional
+    bbox1: tuple, optional, (xmin, ymin, xmax, ymax) bounds on the pixel
+           centres of scene1 to compare (default: its data extent)
+    bbox2: tuple, optional, as *bbox1* for scene2
+    memory_budget: int, optional, bytes of swath data to read at a time
+    nprocs: int, optional, number of swaths to process concurrently
 
+    Returns:
+    --------
+    SharedPixelStats
+    """
+    def swathfunc(swath1, swath2, valid):
+        return SharedPixelStats(bins=bins).add(swath1[valid]-swath2[valid])
+
+    stats = SharedPixelStats(bins=bins)
+    window = _shared_window(scene1, scene2, bbox1, bbox2)
+    if window is None:
+        return stats
+    for swathstats in map_shared_swaths(swathfunc, scene1, scene2,
+                                        nodata=nodata, window=window,
+                                        memory_budget=memory_budget,
+                                        nprocs=nprocs):
+        stats.merge(swathstats)
+    return stats
@@ -0,0 +1,140 @@
+""" Post-processing of displacement fields from feature tracking.
+
+Displacements computed by `correlate.correlate_scenes` are placed on the
+regular lattice of reference chip centres, and blunders are removed with
+vectorized whole-field tests:
+
+- a minimum correlation strength
+- the normalized median test (Westerweel and Scarano, 2005), which compares
+  each vector with the median of its eight neighbours, scaled by the median
+  residual of those neighbours
+
+Rejected vectors are set to NaN, so the resulting arrays can be passed to
+`divergence.divergence` directly.
+"""
+
+import warnings
+
+import numpy as np
+
+from .filt import smooth5
+
+def grid_displacements(points, displs, strengths, transform, size):
+    """ Place unordered correlation results onto a regular grid.
+
+    Arguments:
+    ----------
+    points: (n, 2) array of reference chip centres
+    displs: (n, 2) array of x and y displacements
+    strengths: (n,) array of correlation strengths
+    transform: grid transform, as returned by `correlate.reference_lattice`
+    size: (ny, nx) grid size
+
+    Returns:
+    --------
+    u, v, strength: (ny, nx) arrays, NaN where there is no result
+    """
+    ny, nx = size
+    u = np.full(size, np.nan)
+    v = np.full(size, np.nan)
+    s = np.full(size, np.nan)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return u, v, s
+    displs = np.asarray(displs, dtype=np.float64).reshape(-1, 2)
+    j = np.floor((points[:,0]-transform[0])/transform[2]).astype(np.int64)
+    i = np.floor((points[:,1]-transform[1])/transform[3]).astype(np.int64)
+    inside = (i >= 0) & (i < ny) & (j >= 0) & (j < nx)
+    i = i[inside]
+    j = j[inside]
+    u[i,j] = displs[inside,0]
+    v[i,j] = displs[inside,1]
+    s[i,j] = np.asarray(strengths, dtype=np.float64)[inside]
+    return u, v, s
+
+def _neighbours(a):
+    """ Return an (8, ny-2, nx-2) array of the eight neighbours of each
+    interior element of *a* """
+    ny, nx = a.shape
+    return np.stack([a[1+di:ny-1+di, 1+dj:nx-1+dj]
+                     for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj])
+
+def normalized_median_residual(u, v, epsilon=0.1):
+    """ Return the normalized median residual of each vector in the field
+    (*u*, *v*) with respect to its eight neighbours.
+
+    For each component, the residual of a vector is its distance from the
+    median of its neighbours, divided by the median distance of the
+    neighbours themselves from that median. The vector under test is
+    excluded from both medians, and missing (NaN) neighbours are ignored.
+
+    *epsilon* is the expected measurement noise in the units of *u* and *v*
+    (typically about 0.1 pixel), and keeps the residual bounded in uniform
+    regions. Vectors in the outer rows and columns are given a residual of
+    zero.
+    """
+    res2 = np.zeros(np.shape(u))
+    if min(res2.shape) < 3:
+        return res2
+    for c in (u, v):
+        c = np.asarray(c, dtype=np.float64)
+        nb = _neighbours(c)
+        with warnings.catch_warnings():
+            # neighbourhoods that are entirely NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med = np.nanmedian(nb, axis=0)
+            rm = np.nanmedian(np.abs(nb - med), axis=0)
+        r = np.abs(c[1:-1,1:-1] - med)
+        res2[1:-1,1:-1] += (r/(rm+epsilon))**2
+    return np.sqrt(res2)
+
+def filter_displacements(u, v, strength=None, min_strength=None,
+        median_threshold=2.0, epsilon=0.1, smooth=0):
+    """ Remove outliers from a gridded displacement field.
+
+    Arguments:
+    ----------
+    u, v: 2D arrays of displacement components, NaN where missing
+    strength: 2D array of correlation strengths, optional
+    min_strength: float, optional, vectors weaker than this are rejected
+    median_threshold: float, vectors with a normalized median residual
+            greater than this are rejected; None disables the test
+            (default 2.0)
+    epsilon: float, expected noise level for the median test (default 0.1)
+    smooth: int, number of five-point smoothing passes applied to the
+            filtered field (default 0)
+
+    Returns:
+    --------
+    u, v: filtered arrays, with rejected vectors set to NaN
+    """
+    u = np.array(u, dtype=np.float64)
+    v = np.array(v, dtype=np.float64)
+    reject = np.isnan(u) | np.isnan(v)
+    if min_strength is not None and strength is not None:
+        reject |= ~(np.asarray(strength) >= min_strength)
+    u[reject] = np.nan
+    v[reject] = np.nan
+
+    if median_threshold is not None:
+        with np.errstate(invalid="ignore"):
+            reject = normalized_median_residual(u, v, epsilon) > median_threshold
+        u[reject] = np.nan
+        v[reject] = np.nan
+
+    if smooth > 0:
+        u = smooth5(u, smooth)
+        v = smooth5(v, smooth)
+    return u, v
+
+def displacement_grids(points, displs, strengths, transform, size, **kw):
+    """ Grid and filter correlation results (see `grid_displacements` and
+    `filter_displacements`), returning *u*, *v*, and *strength* as
+    karta.RegularGrids. Keyword arguments are passed to
+    `filter_displacements`. """
+    import karta
+    u, v, s = grid_displacements(points, displs, strengths, transform, size)
+    u, v = filter_displacements(u, v, s, **kw)
+    s[np.isnan(u)] = np.nan
+    return tuple(karta.RegularGrid(transform, values=a, nodata_value=np.nan)
+                 for a in (u, v, s))
@@ -0,0 +1,104 @@
+import unittest
+import numpy as np
+from meltpack import accel
+from meltpack import alphashapes, correlate    # register NumPy implementations
+
+def circumradius_loop(coords, simplices):
+    out = []
+    for ia, ib, ic in simplices:
+        pa, pb, pc = coords[ia], coords[ib], coords[ic]
+        a = np.hypot(*(pa-pb))
+        b = np.hypot(*(pb-pc))
+        c = np.hypot(*(pc-pa))
+        s = 0.5*(a+b+c)
+        area = np.sqrt(s*(s-a)*(s-b)*(s-c))
+        out.append(a*b*c/(4.0*area) if area > 0 else np.inf)
+    return np.array(out)
+
+class BackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = accel.get_backend()
+
+    def tearDown(self):
+        accel.set_backend(self.backend)
+
+    def test_numpy_backend(self):
+        accel.set_backend("numpy")
+        self.assertEqual(accel.get_backend(), "numpy")
+        self.assertIs(accel.implementation("findpeak_subpixel"),
+                      accel.implementation("findpeak_subpixel", "numpy"))
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            accel.set_backend("fortran")
+
+    def test_circumradii(self):
+        coords = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [2.0, 0.0]])
+        simplices = np.array([[0, 1, 2], [0, 1, 3]])
+        r = accel.implementation("circumradii", "numpy")(coords, simplices)
+        self.assertAlmostEqual(r[0], np.sqrt(0.5))
+        self.assertEqual(r[1], np.inf)
+
+        coords = np.random.rand(50, 2)
+        simplices = np.random.randint(0, 50, (40, 3))
+        simplices = simplices[(simplices[:,0] != simplices[:,1]) &
+                              (simplices[:,1] != simplices[:,2]) &
+                              (simplices[:,0] != simplices[:,2])]
+        r = accel.implementation("circumradii", "numpy")(coords, simplices)
+        self.assertTrue(np.allclose(r, circumradius_loop(coords, simplices)))
+
+@unittest.skipUnless(accel.numba_available(), "numba not installed")
+class NumbaParityTests(unittest.TestCase):
+
+    def test_findpeak_subpixel(self):
+        y, x = np.mgrid[:21,:21]
+        for yc, xc in ((10.3, 9.6), (4.9, 15.2), (0.0, 10.0)):
+            c = np.exp(-((x-xc)**2 + (y-yc)**2)/8.0)
+            expected = accel.implementation("findpeak_subpixel", "numpy")(c)
+            result = accel.implementation("findpeak_subpixel", "numba")(c)
+            self.assertTrue(np.allclose(result, expected))
+
+    def test_normalize_chip(self):
+        chip = np.random.rand(32, 32)
+        chip[np.random.rand(32, 32) < 0.1] = np.nan
+        for c in (chip, np.full((8, 8), 3.0), np.full((8, 8), np.nan)):
+            expected = accel.implementation("normalize_chip", "numpy")(c)
+            result = accel.implementation("normalize_chip", "numba")(c)
+            self.assertTrue(np.allclose(result, expected))
+
+    def test_normalize_integer_chip(self):
+        chip = np.random.randint(0, 4000, (16, 16)).astype(np.uint16)
+        for c in (chip, chip.astype(np.int32), chip.astype(np.float32)):
+            expected = accel.implementation("normalize_chip", "numpy")(c)
+            result = accel.implementation("normalize_chip", "numba")(c)
+            self.assertEqual(result.dtype, expected.dtype)
+            self.assertTrue(np.allclose(result, expected))
+
+    def test_correlate_integer_chips(self):
+        from scipy.ndimage import gaussian_filter
+        img = gaussian_filter(np.random.rand(80, 80), 2)
+        img = (60000*(img-img.min())/np.ptp(img)).astype(np.uint16)
+        search = img[10:74,10:74]
+        ref = img[29:61,33:65]
+        backend = accel.get_backend()
+        try:
+            accel.set_backend("numpy")
+            expected = correlate.correlate_chips(search, ref, mode="same")
+            accel.set_backend("numba")
+            result = correlate.correlate_chips(search, ref, mode="same")
+        finally:
+            accel.set_backend(backend)
+        self.assertTrue(np.allclose(result[0], expected[0]))
+        self.assertAlmostEqual(result[1], expected[1])
+
+    def test_circumradii(self):
+        import scipy.spatial
+        coords = np.random.rand(200, 2)
+        simplices = scipy.spatial.Delaunay(coords).simplices
+        expected = accel.implementation("circumradii", "numpy")(coords, simplices)
+        result = accel.implementation("circumradii", "numba")(coords, simplices)
+        self.assertTrue(np.allclose(result, expected))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from meltpack import batch, instrument
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for fnm in ("a.tif", "b.tif"):
+            with open(os.path.join(self.tmpdir, fnm), "wb") as f:
+                f.write(b"\0"*100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_manifest(self, manifest):
+        path = os.path.join(self.tmpdir, "manifest.json")
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        return path
+
+    def test_defaults_and_overrides(self):
+        path = self.write_manifest({
+            "defaults": {"uguess": "vx.tif", "vguess": "vy.tif",
+                         "searchsize": [64, 64]},
+            "pairs": [{"scene1": "a.tif", "scene2": "b.tif", "dt": 1},
+                      {"name": "ba", "scene1": "b.tif", "scene2": "a.tif",
+                       "dt": 2, "searchsize": [128, 128], "memory": "1K"}]})
+        jobs = batch.load_manifest(path)
+        self.assertEqual([j["name"] for j in jobs], ["a_b", "ba"])
+        self.assertEqual(jobs[0]["scene1"], os.path.join(self.tmpdir, "a.tif"))
+        self.assertEqual(jobs[0]["params"], {"searchsize": [64, 64]})
+        self.assertEqual(jobs[1]["params"], {"searchsize": [128, 128]})
+        self.assertEqual(jobs[0]["memory"], batch.MEMORY_FACTOR*200)
+        self.assertEqual(jobs[1]["memory"], 1024)
+
+    def test_invalid_manifests(self):
+        pair = {"scene1": "a.tif", "scene2": "b.tif", "uguess": "u", "vguess": "v", "dt": 1}
+        with self.assertRaises(ValueError):
+            batch.load_manifest(self.write_manifest({"pairs": [pair, pair]}))
+        with self.assertRaises(ValueError):
+            batch.load_manifest(self.write_manifest({"pairs": [dict(pair, serchsize=1)]}))
+        del pair["dt"]
+        with self.assertRaises(ValueError):
+            batch.load_manifest(self.write_manifest({"pairs": [pair]}))
+
+    def test_parse_bytes(self):
+        self.assertEqual(batch.parse_bytes("16G"), 16*1024**3)
+        self.assertEqual(batch.parse_bytes("1.5kb"), 1536)
+        self.assertEqual(batch.parse_bytes(1000), 1000)
+
+class RunManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.jobs = [{"name": n, "memory": 10} for n in "abcd"]
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_resume_skips_completed(self):
+        calls = []
+
+        def func(job, outdir, nprocs):
+            calls.append(job["name"])
+            if job["name"] == "c" and calls.count("c") == 1:
+                raise RuntimeError("preempted")
+            open(batch.output_path(outdir, job["name"]), "w").close()
+            return instrument.Stats()
+
+        status = batch.run_manifest(self.jobs, self.outdir, func=func)
+        self.assertEqual(status["c"], "failed")
+        self.assertEqual(status["a"], "done")
+
+        status = batch.run_manifest(self.jobs, self.outdir, func=func)
+        self.assertEqual(status, {"a": "skipped", "b": "skipped",
+                                  "c": "done", "d": "skipped"})
+        self.assertEqual(sorted(calls), ["a", "b", "c", "c", "d"])
+        with open(os.path.join(self.outdir, "c.json")) as f:
+            self.assertIn("elapsed", json.load(f))
+
+    def test_memory_budget_limits_concurrency(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def func(job, outdir, nprocs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            self.assertEqual(nprocs, 2)
+
+        batch.run_manifest(self.jobs, self.outdir, workers=8, pairs=4,
+                           memory_budget=25, func=func)
+        self.assertEqual(running[1], 2)
+
+if __name__ == "__main__":
+    unittest.main()
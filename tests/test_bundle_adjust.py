@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+from meltpack.bundle_adjust import compute_vertical_corrections
+
+try:
+    import karta
+except ImportError:
+    karta = None
+
+@unittest.skipIf(karta is None, "karta not installed")
+class VerticalCorrectionTests(unittest.TestCase):
+
+    def test_matches_full_grid_mean(self):
+        for dy in (10.0, -10.0):
+            a = 100 + np.random.randn(30, 25)
+            b = 97 + np.random.randn(30, 25)
+            a[np.random.rand(30, 25) < 0.2] = np.nan
+            b[np.random.rand(30, 25) < 0.2] = np.nan
+            T = (0.0, 0.0 if dy > 0 else 300.0, 10.0, dy, 0.0, 0.0)
+            dem0 = karta.RegularGrid(T, values=a, nodata_value=np.nan)
+            dem1 = karta.RegularGrid(T, values=b, nodata_value=np.nan)
+
+            msk = dem0.data_mask & dem1.data_mask
+            mean = np.mean(a[msk] - b[msk])
+            dz = compute_vertical_corrections([dem0, dem1])
+            self.assertAlmostEqual(dz[0], -0.5*mean)
+            self.assertAlmostEqual(dz[1], 0.5*mean)
+
+if __name__ == "__main__":
+    unittest.main()
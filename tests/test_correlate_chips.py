@@ -0,0 +1,142 @@
+import unittest
+import numpy as np
+from meltpack import correlate
+
+class NanIntegralTests(unittest.TestCase):
+
+    def test_window_counts(self):
+        a = np.random.rand(50, 40)
+        a[a<0.3] = np.nan
+        sat = correlate.nan_integral(a, bandwidth=7)
+        i0 = np.array([3, 0, 10])
+        i1 = np.array([20, 50, 10])
+        j0 = np.array([5, 0, 2])
+        j1 = np.array([30, 40, 9])
+        counts = correlate.window_nan_counts(sat, i0, i1, j0, j1)
+        expected = [np.isnan(a[p:q,r:s]).sum() for p, q, r, s in zip(i0, i1, j0, j1)]
+        self.assertEqual(list(counts), expected)
+
+    def test_normalize_chip_with_gaps(self):
+        chip = np.random.rand(16, 16)
+        chip[3:5,3:5] = np.nan
+        out = correlate._normalize_chip(chip)
+        self.assertFalse(np.any(np.isnan(out)))
+        self.assertTrue(np.all(out[3:5,3:5] == 0.0))
+
+class FastNCCTests(unittest.TestCase):
+
+    def test_matches_direct_ncc(self):
+        search = np.random.rand(30, 36)
+        ref = 3*search[10:18,12:22] + 5
+        c = correlate.fast_ncc(search, ref, mode="valid")
+        self.assertEqual(c.shape, (23, 27))
+        b = ref - ref.mean()
+        for i, j in [(0, 0), (10, 12), (22, 26), (5, 17)]:
+            a = search[i:i+8,j:j+10]
+            a = a - a.mean()
+            expected = (a*b).sum() / np.sqrt((a**2).sum()*(b**2).sum())
+            self.assertAlmostEqual(c[i,j], expected)
+        self.assertEqual(np.unravel_index(c.argmax(), c.shape), (10, 12))
+        self.assertAlmostEqual(c.max(), 1.0)
+
+    def test_batch_matches_single(self):
+        search = np.random.rand(3, 32, 32)
+        ref = search[:,8:24,8:24] + 0.1*np.random.rand(3, 16, 16)
+        offsets, strengths = correlate.correlate_chip_batch(search, ref, mode="same")
+        for k in range(3):
+            offset, strength = correlate.correlate_chips(search[k], ref[k],
+                                                         mode="same",
+                                                         method="fast_ncc")
+            self.assertTrue(np.allclose(offsets[k], offset))
+            self.assertAlmostEqual(strengths[k], strength)
+
+class PhaseCorrelationTests(unittest.TestCase):
+
+    def test_recovers_subpixel_shift(self):
+        # band-limited texture, shifted by (0.5, -0.25) pixels
+        rng = np.random.RandomState(0)
+        ky = np.fft.fftfreq(128)[:,np.newaxis]
+        kx = np.fft.fftfreq(128)[np.newaxis,:]
+        spectrum = np.fft.fft2(rng.randn(128, 128)) * np.exp(-2*(3*np.pi)**2*(kx**2+ky**2))
+        img = np.real(np.fft.ifft2(spectrum))
+        shifted = np.real(np.fft.ifft2(spectrum*np.exp(-2j*np.pi*(0.5*kx-0.25*ky))))
+        (dx, dy), strength = correlate.correlate_chips(shifted[32:96,32:96],
+                                                       img[32:96,32:96],
+                                                       mode="same", method="phase")
+        self.assertTrue(abs(dx-0.5) < 0.1)
+        self.assertTrue(abs(dy+0.25) < 0.1)
+
+    def test_window_cached(self):
+        w1 = correlate.apodization_window((32, 32), "tukey")
+        w2 = correlate.apodization_window((32, 32), "tukey")
+        self.assertIs(w1, w2)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            correlate.get_correlator("nonexistent")
+
+class AdaptiveSearchSizeTests(unittest.TestCase):
+
+    def test_levels_fft_friendly(self):
+        from scipy import fft
+        levels = correlate.search_size_levels(32, 128)
+        self.assertEqual(levels[0], 64)
+        self.assertEqual(levels[-1], 128)
+        for n in levels:
+            self.assertEqual(n % 2, 0)
+            self.assertEqual(fft.next_fast_len(int(n)), n)
+
+    def test_size_grows_with_uncertainty(self):
+        u = np.array([0.0, 10.0, 100.0, 10000.0, np.nan])
+        v = np.zeros(5)
+        sx, sy = correlate.adaptive_searchsize(u, v, 1.0, 10.0, 10.0,
+                                               (32, 32), (128, 128))
+        self.assertTrue(np.all(np.diff(sx[:4]) >= 0))
+        self.assertEqual(sx[0], 64)
+        self.assertEqual(sx[3], 128)
+        self.assertEqual(sx[4], 128)
+        self.assertTrue(np.array_equal(sx, sy))
+
+    def test_gradient_widens_search(self):
+        u = np.zeros(2)
+        sx, sy = correlate.adaptive_searchsize(u, u, 1.0, 10.0, 10.0,
+                                               (32, 32), (128, 128),
+                                               ugrad=np.array([0.0, 300.0]))
+        self.assertLess(sx[0], sx[1])
+
+    def test_sizes_follow_argument_order(self):
+        u = np.zeros(3)
+        sx, sy = correlate.adaptive_searchsize(u, u, 1.0, 10.0, 10.0,
+                                               (16, 32), (256, 128))
+        self.assertTrue(np.all(sx <= 256) and np.all(sy <= 128))
+        self.assertEqual(sx[0], correlate.search_size_levels(16, 256)[0])
+        self.assertEqual(sy[0], correlate.search_size_levels(32, 128)[0])
+
+class ChipWindowTests(unittest.TestCase):
+
+    def test_non_square_chip(self):
+        # size is (columns, rows)
+        i0, i1, j0, j1 = correlate._chip_windows([10], [20], 0, 0, (8, 4), 50, 50)
+        self.assertEqual(i1[0]-i0[0], 4)
+        self.assertEqual(j1[0]-j0[0], 8)
+        chip = np.zeros((50, 50))[i0[0]:i1[0], j0[0]:j1[0]]
+        self.assertEqual(chip.shape, (4, 8))
+        self.assertEqual((i0[0], j0[0]), (8, 16))
+
+    def test_offset_and_truncation(self):
+        i0, i1, j0, j1 = correlate._chip_windows([10, 1], [20, 48], [2, 0],
+                                                 [-3, 0], (8, 4), 50, 50)
+        self.assertEqual((i0[0], i1[0], j0[0], j1[0]), (10, 14, 13, 21))
+        self.assertEqual((i0[1], j1[1]), (0, 49))
+
+class BaselinePairsTests(unittest.TestCase):
+
+    def test_pairs_within_baseline(self):
+        times = [30.0, 0.0, 10.0, 12.0, 45.0]
+        pairs = correlate.baseline_pairs(times, min_baseline=1.0, max_baseline=15.0)
+        self.assertEqual(pairs, [(1, 2), (1, 3), (2, 3), (0, 4)])
+        for i, j in pairs:
+            self.assertTrue(1.0 <= times[j]-times[i] <= 15.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+from meltpack.filt import smooth5, medianfilt, filter_pipeline
+from meltpack.divergence import divergence
+from meltpack.utilities import apply_shared_pixels
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+try:
+    import karta
+except ImportError:
+    karta = None
+
+@unittest.skipIf(da is None, "dask not installed")
+class DaskFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.random.rand(97, 83)
+        self.img[np.random.rand(97, 83) < 0.1] = np.nan
+        self.img[:5,:7] = np.nan
+
+    def assertLazyEqual(self, result, expected):
+        self.assertTrue(hasattr(result, "dask"))
+        result = result.compute()
+        self.assertEqual(result.dtype, expected.dtype)
+        self.assertTrue(np.array_equal(result, expected, equal_nan=True))
+
+    def test_smooth5(self):
+        for niter in (1, 3):
+            for chunks in (10, (30, 17), 200):
+                d = da.from_array(self.img, chunks=chunks)
+                self.assertLazyEqual(smooth5(d, niter), smooth5(self.img, niter))
+
+    def test_smooth5_float32(self):
+        img = self.img.astype(np.float32)
+        d = da.from_array(img, chunks=20)
+        self.assertLazyEqual(smooth5(d, 2), smooth5(img, 2))
+
+    def test_medianfilt(self):
+        for chunks in (4, (25, 40)):
+            d = da.from_array(self.img, chunks=chunks)
+            self.assertLazyEqual(medianfilt(d), medianfilt(self.img))
+
+    def test_filter_pipeline(self):
+        stages = ["median", ("smooth", 2), ("threshold", 0.2, 0.8)]
+        d = da.from_array(self.img, chunks=(20, 30))
+        self.assertLazyEqual(filter_pipeline(d, stages),
+                             filter_pipeline(self.img, stages))
+
+    def test_divergence(self):
+        h = 100 + np.random.rand(97, 83)
+        u = np.random.randn(97, 83)
+        v = np.random.randn(97, 83)
+        u[40:45,10:12] = np.nan
+        expected = divergence(1.0, 2.0, h, u, v)
+        for chunks in (5, (30, 20)):
+            result = divergence(1.0, 2.0, da.from_array(h, chunks=chunks),
+                                da.from_array(u, chunks=chunks), v)
+            self.assertEqual(result.shape, expected.shape)
+            self.assertLazyEqual(result, expected)
+
+@unittest.skipIf(da is None or karta is None, "dask or karta not installed")
+class DaskSharedPixelTests(unittest.TestCase):
+
+    def test_apply_shared_pixels(self):
+        a = np.random.rand(60, 50)
+        b = np.random.rand(50, 50)
+        a[a < 0.1] = np.nan
+        b[b < 0.1] = np.nan
+        g1 = karta.RegularGrid((0, 0, 1, 1, 0, 0), values=a, nodata_value=np.nan)
+        g2 = karta.RegularGrid((5, 10, 1, 1, 0, 0), values=b, nodata_value=np.nan)
+        expected = apply_shared_pixels(lambda x, y: x-y, g1, g2)
+        g1 = karta.RegularGrid((0, 0, 1, 1, 0, 0), values=da.from_array(a, chunks=13),
+                               nodata_value=np.nan)
+        result = apply_shared_pixels(lambda x, y: x-y, g1, g2)
+        self.assertTrue(hasattr(result, "dask"))
+        self.assertTrue(np.array_equal(result.compute(), expected))
+
+if __name__ == "__main__":
+    unittest.main()
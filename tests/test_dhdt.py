@@ -0,0 +1,111 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from meltpack import dhdt, sampling
+
+try:
+    import karta
+except ImportError:
+    karta = None
+
+class AdvectionTests(unittest.TestCase):
+
+    def rotation_error(self, sampler, method, nsteps, omega=2.0, years=1.0):
+        theta = np.linspace(0, 2*np.pi, 12, endpoint=False)
+        x = 400.0*np.cos(theta)
+        y = 400.0*np.sin(theta)
+        dx, dy = dhdt._advect(x, y, sampler, years, nsteps=nsteps, method=method)
+        c, s = np.cos(omega*years), np.sin(omega*years)
+        return np.max(np.hypot(x+dx - (c*x - s*y), y+dy - (s*x + c*y)))
+
+    def test_solid_body_rotation(self):
+        omega = 2.0
+        sampler = lambda x, y: (-omega*y, omega*x)
+        err = {m: self.rotation_error(sampler, m, 20) for m in ("euler", "rk2", "rk4")}
+        self.assertGreater(err["euler"], 10.0)
+        self.assertLess(err["rk2"], err["euler"]/10)
+        self.assertLess(err["rk4"], 1e-3)
+        self.assertLess(self.rotation_error(sampler, "rk4", 40),
+                        err["rk4"]/10)
+
+    def test_gridded_rotation(self):
+        # bilinear interpolation of a linear field is exact, so sampling the
+        # velocity grids gives the analytical trajectories
+        class Grid(object):
+            def __init__(self, transform, values):
+                self.transform = transform
+                self.values = values
+                self.size = values.shape
+        omega = 2.0
+        T = (-1000.0, -1000.0, 20.0, 20.0, 0.0, 0.0)
+        y, x = np.mgrid[-990:1000:20,-990:1000:20].astype(np.float64)
+        uvel = Grid(T, -omega*y)
+        vvel = Grid(T, omega*x)
+        sampler = lambda x, y: sampling.sample_grids([uvel, vvel], x, y)
+        self.assertLess(self.rotation_error(sampler, "rk4", 20), 1e-3)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            dhdt._advect(np.zeros(1), np.zeros(1), None, 1.0, method="rk3")
+
+@unittest.skipIf(karta is None, "karta not installed")
+class LagrangianDhdtTests(unittest.TestCase):
+
+    def setUp(self):
+        y, x = np.mgrid[0:60,0:50]
+        z1 = 100.0 + 0.5*x + 0.2*y + np.sin(x/5.0)
+        z1[np.random.rand(60, 50) < 0.1] = np.nan
+        z2 = z1 - 1.0
+        T = (0.0, 0.0, 10.0, 10.0, 0.0, 0.0)
+        self.g1 = karta.RegularGrid(T, values=z1, nodata_value=np.nan)
+        self.g2 = karta.RegularGrid(T, values=z2, nodata_value=np.nan)
+        self.u = karta.RegularGrid(T, values=np.full((60, 50), 300.0), nodata_value=np.nan)
+        self.v = karta.RegularGrid(T, values=20.0*np.ones((60, 50)) + y,
+                                   nodata_value=np.nan)
+        self.timespan = datetime.timedelta(days=73)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chunked_matches_single_block(self):
+        kw = dict(timespan=self.timespan, nsteps=2, method="rk2")
+        expected = dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                        chunksize=60, **kw)
+        self.assertEqual(expected.shape[0], 6)
+        self.assertGreater(expected.shape[1], 500)
+        for chunksize, nprocs in ((1, 1), (7, 1), (13, 3)):
+            result = dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                          chunksize=chunksize, nprocs=nprocs, **kw)
+            self.assertTrue(np.array_equal(result, expected))
+
+    def test_outputs(self):
+        expected = dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                        timespan=self.timespan, chunksize=60)
+        n = expected.shape[1]
+
+        out = np.zeros([6, n+5])
+        result = dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                      timespan=self.timespan, chunksize=9, out=out)
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertTrue(np.all(np.isnan(out[:,n:])))
+        with self.assertRaises(ValueError):
+            dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                 timespan=self.timespan, chunksize=9,
+                                 out=np.zeros([6, n-1]))
+
+        path = os.path.join(self.tmpdir, "dhdt.npy")
+        result = dhdt.lagrangian_dhdt(self.g1, self.g2, self.u, self.v,
+                                      timespan=self.timespan, chunksize=9,
+                                      dtype=np.float32, out=path)
+        self.assertEqual(result.dtype, np.float32)
+        del result
+        loaded = np.load(path)
+        self.assertEqual(loaded.shape, (6, n))
+        self.assertTrue(np.array_equal(loaded, expected.astype(np.float32)))
+
+if __name__ == "__main__":
+    unittest.main()
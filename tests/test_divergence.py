@@ -1,4 +1,6 @@
 import unittest
+import warnings
+from unittest import mock
 import numpy as np
 import meltpack.divergence
 import matplotlib.pyplot as plt
@@ -26,5 +28,110 @@ class DivergenceTests(unittest.TestCase):
         div = meltpack.divergence.divergence(1/200, 1/200, htest, utest, vtest)
         self.assertTrue(np.mean(np.abs(ans[2:-1,2:-1]-div[1:,1:])) < 0.12)
 
+    def test_float32(self):
+        x, y = np.meshgrid(np.linspace(0, 1, 200), np.linspace(0, 1, 200))
+        utest = x**2
+        vtest = x*y
+        htest = np.ones_like(x)
+        div64 = meltpack.divergence.divergence(1/200, 1/200, htest, utest, vtest)
+        div32 = meltpack.divergence.divergence(1/200, 1/200, htest.astype(np.float32),
+                                               utest.astype(np.float32),
+                                               vtest.astype(np.float32))
+        self.assertEqual(div32.dtype, np.float32)
+        self.assertTrue(np.allclose(div32, div64, atol=1e-3, equal_nan=True))
+
+class DivergenceStackTests(unittest.TestCase):
+
+    def setUp(self):
+        nt, ny, nx = 7, 41, 33
+        self.h = 100 + np.random.rand(nt, ny, nx)
+        self.u = np.random.randn(nt, ny, nx)
+        self.v = np.random.randn(nt, ny, nx)
+        self.u[2,10:14,5:9] = np.nan
+        self.expected = np.array([meltpack.divergence.divergence(1.0, 2.0, h, u, v)
+                                  for h, u, v in zip(self.h, self.u, self.v)])
+
+    def test_matches_per_epoch(self):
+        for tilesize in (None, 1, 9):
+            div = meltpack.divergence.divergence_stack(1.0, 2.0, self.h, self.u,
+                    self.v, tilesize=tilesize, nprocs=2)
+            self.assertTrue(np.array_equal(div, self.expected, equal_nan=True))
+
+    def test_constant_thickness_and_out(self):
+        out = np.zeros((7, 39, 31))
+        div = meltpack.divergence.divergence_stack(1.0, 2.0, self.h[0], self.u,
+                self.v, out=out)
+        self.assertIs(div, out)
+        expected = meltpack.divergence.divergence(1.0, 2.0, self.h[0], self.u[4], self.v[4])
+        self.assertTrue(np.array_equal(div[4], expected, equal_nan=True))
+
+    def test_reductions(self):
+        mean = meltpack.divergence.divergence_stack(1.0, 2.0, self.h, self.u,
+                self.v, reduce="mean", tilesize=10)
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            self.assertTrue(np.allclose(mean, np.nanmean(self.expected, axis=0),
+                                        equal_nan=True))
+
+        times = 2000 + 0.25*np.arange(7)
+        trend = meltpack.divergence.divergence_stack(1.0, 2.0, self.h, self.u,
+                self.v, reduce="trend", times=times)
+        self.assertTrue(np.allclose(trend[5,3:8],
+                                    np.polyfit(times, self.expected[:,5,3:8], 1)[0]))
+        with self.assertRaises(ValueError):
+            meltpack.divergence.divergence_stack(1.0, 2.0, self.h, self.u,
+                    self.v, reduce="trend")
+
+    def test_tiles_wide_stack(self):
+        nt, ny, nx = 6, 41, 400
+        h = 100 + np.random.rand(nt, ny, nx)
+        u = np.random.randn(nt, ny, nx)
+        v = np.random.randn(nt, ny, nx)
+        expected = np.array([meltpack.divergence.divergence(1.0, 2.0, h_, u_, v_)
+                             for h_, u_, v_ in zip(h, u, v)])
+
+        blocks = []
+        compute = meltpack.divergence._divergence_stack
+        def record(dx, dy, h, u, v, out):
+            blocks.append(u.shape[:2])
+            return compute(dx, dy, h, u, v, out)
+
+        with mock.patch.object(meltpack.divergence, "TILE_BYTES", 100000), \
+                mock.patch.object(meltpack.divergence, "_divergence_stack", record):
+            div = meltpack.divergence.divergence_stack(1.0, 2.0, h, u, v)
+        self.assertTrue(np.array_equal(div, expected, equal_nan=True))
+        # several bands of rows, each split into several blocks of epochs
+        self.assertLess(max(nrows for _, nrows in blocks), ny)
+        self.assertLess(max(nepochs for nepochs, _ in blocks), nt)
+
+class RegularizedSolverTests(unittest.TestCase):
+
+    def test_functional_gradient(self):
+        from scipy.optimize import check_grad
+        ny, nx = 9, 11
+        domain = np.ones((ny, nx), dtype=bool)
+        domain[:2,:3] = False
+        domain = domain.ravel()
+        Dx, Dy, L, _ = meltpack.divergence._operators(ny, nx, 2.0, 3.0, domain)
+        n = np.count_nonzero(domain)
+        h0, u0, v0 = 100+np.random.rand(n), np.random.rand(n), np.random.rand(n)
+        func = meltpack.divergence._fluxdiv_functional(Dx, Dy, L, h0, u0, v0,
+                    0.04, 1.0, 1.0, 10.0)
+        x = np.concatenate([h0, u0, v0]) + 0.1*np.random.randn(3*n)
+        err = check_grad(lambda a: func(a)[0], lambda a: func(a)[1], x)
+        self.assertLess(err/np.linalg.norm(func(x)[1]), 1e-5)
+
+    def test_operators_drop_stencils_outside_domain(self):
+        ny, nx = 6, 7
+        domain = np.ones((ny, nx), dtype=bool)
+        domain[3,3] = False
+        Dx, Dy, L, qcells = meltpack.divergence._operators(ny, nx, 1.0, 1.0,
+                                                            domain.ravel())
+        self.assertEqual(Dx.shape, (len(qcells), np.count_nonzero(domain)))
+        # cells whose centred stencil touches (3,3), and (3,3) itself
+        for cell in [3*nx+2, 3*nx+4, 2*nx+3, 4*nx+3, 3*nx+3]:
+            self.assertNotIn(cell, qcells)
+        self.assertEqual(len(qcells), (ny-2)*(nx-2)-5)
+
 if __name__ == "__main__":
     unittest.main()
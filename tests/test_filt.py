@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from meltpack.filt import smooth5, medianfilt
+
+class FloatTypeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.random.rand(60, 50)
+        self.img[np.random.rand(60, 50) < 0.1] = np.nan
+
+    def test_smooth5_float32(self):
+        out32 = smooth5(self.img.astype(np.float32), 3)
+        out64 = smooth5(self.img, 3)
+        self.assertEqual(out32.dtype, np.float32)
+        self.assertEqual(out64.dtype, np.float64)
+        self.assertTrue(np.allclose(out32, out64, atol=1e-6, equal_nan=True))
+
+    def test_medianfilt_float32(self):
+        out32 = medianfilt(self.img.astype(np.float32))
+        out64 = medianfilt(self.img)
+        self.assertEqual(out32.dtype, np.float32)
+        self.assertTrue(np.allclose(out32, out64, atol=1e-6, equal_nan=True))
+
+    def test_medianfilt_matches_numpy(self):
+        out = medianfilt(self.img)
+        for i, j in [(1, 1), (10, 20), (58, 48), (30, 7)]:
+            window = self.img[i-1:i+2,j-1:j+2]
+            if np.isnan(self.img[i,j]):
+                self.assertTrue(np.isnan(out[i,j]))
+            else:
+                self.assertEqual(out[i,j], np.median(window[~np.isnan(window)]))
+
+if __name__ == "__main__":
+    unittest.main()
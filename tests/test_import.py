@@ -0,0 +1,44 @@
+import subprocess
+import sys
+import unittest
+
+# Wall-clock budget for `import meltpack` followed by `meltpack.filt`, which is
+# all that short-lived filtering tasks need
+IMPORT_BUDGET = 1.0
+
+SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+import meltpack
+meltpack.filt.smooth5
+print(time.perf_counter() - t0)
+heavy = ["karta", "shapely", "scipy.signal", "scipy.spatial",
+         "scipy.sparse.linalg", "smtplib"]
+print(" ".join(m for m in heavy if m in sys.modules))
+"""
+
+class ImportTests(unittest.TestCase):
+
+    def run_fresh(self):
+        out = subprocess.check_output([sys.executable, "-c", SCRIPT],
+                                      universal_newlines=True)
+        lines = out.splitlines()
+        return float(lines[0]), lines[1].split() if len(lines) > 1 else []
+
+    def test_heavy_dependencies_deferred(self):
+        _, loaded = self.run_fresh()
+        self.assertEqual(loaded, [])
+
+    def test_import_time_budget(self):
+        elapsed = min(self.run_fresh()[0] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_BUDGET)
+
+    def test_submodules_load_on_access(self):
+        import meltpack
+        self.assertIn("correlate", dir(meltpack))
+        self.assertTrue(hasattr(meltpack.correlate, "correlate_scenes"))
+        with self.assertRaises(AttributeError):
+            meltpack.nonexistent
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+from meltpack.instrument import Stats, get_stats, NULL_STATS
+
+class StatsTests(unittest.TestCase):
+
+    def test_timers_and_counts(self):
+        events = []
+        stats = Stats(callback=lambda kind, name, value: events.append((kind, name)))
+        with stats.timer("stage"):
+            stats.count("items", 3)
+        with stats.timer("stage"):
+            stats.count("items")
+        stats.gauge("depth", 5, peak=True)
+        stats.gauge("depth", 2, peak=True)
+        d = stats.as_dict()
+        self.assertEqual(d["counts"]["items"], 4)
+        self.assertEqual(d["gauges"]["depth"], 5)
+        self.assertTrue(d["timers"]["stage"] >= 0.0)
+        self.assertEqual(events.count(("timer", "stage")), 2)
+
+    def test_null_stats(self):
+        stats = get_stats(None)
+        self.assertIs(stats, NULL_STATS)
+        self.assertFalse(stats.enabled)
+        with stats.timer("stage"):
+            stats.count("items")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+from meltpack import notify
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """ Minimal SMTP server that records received messages """
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 localhost stand-in")
+        rcpt = []
+        while True:
+            line = self.rfile.readline().decode("utf-8")
+            if not line:
+                return
+            cmd = line.strip().upper()
+            if cmd.startswith("EHLO") or cmd.startswith("HELO"):
+                self.reply("250 localhost")
+            elif cmd.startswith("MAIL FROM"):
+                rcpt = []
+                self.reply("250 OK")
+            elif cmd.startswith("RCPT TO"):
+                rcpt.append(line.strip()[8:].strip("<> "))
+                self.reply("250 OK")
+            elif cmd == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    l = self.rfile.readline().decode("utf-8")
+                    if l.rstrip("\r\n") == ".":
+                        break
+                    data.append(l)
+                with server.lock:
+                    server.messages.append((rcpt, "".join(data)))
+                self.reply("250 OK")
+            elif cmd in ("NOOP", "RSET"):
+                self.reply("250 OK")
+            elif cmd == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+class NotifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.messages = []
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        fd, self.mailconf = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("127.0.0.1\n{0}\n\n\n".format(self.server.server_address[1]))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.mailconf)
+
+    def notifier(self, **kw):
+        return notify.Notifier(self.mailconf, "meltpack@localhost",
+                               use_ssl=False, **kw)
+
+    def test_burst_coalesced_into_digest(self):
+        with self.notifier(min_interval=60.0, digest_delay=60.0) as notifier:
+            for i in range(5):
+                notifier.send("me@localhost", "pair %d finished" % i, subject="done")
+        self.assertEqual(len(self.server.messages), 1)
+        rcpt, data = self.server.messages[0]
+        self.assertEqual(rcpt, ["me@localhost"])
+        self.assertIn("[5 notifications]", data)
+        for i in range(5):
+            self.assertIn("pair %d finished" % i, data)
+
+    def test_connection_reused(self):
+        with self.notifier(min_interval=0.0, digest_delay=0.0) as notifier:
+            for i in range(3):
+                notifier.send("me@localhost", "message %d" % i)
+                self.assertTrue(notifier.flush(timeout=10))
+            self.assertEqual(notifier.sent, 3)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_sms_uses_queue(self):
+        with self.notifier(digest_delay=0.0) as notifier:
+            notifier.send_sms("5551234567", "TELUS", "hello")
+        self.assertEqual(self.server.messages[0][0], ["5551234567@msg.telus.com"])
+        with self.assertRaises(KeyError):
+            notify.sms_address("5551234567", "NOWHERE")
+
+    def test_undeliverable_recorded(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.notifier(digest_delay=0.0) as notifier:
+            notifier.send("me@localhost", "lost")
+        self.assertEqual(notifier.sent, 0)
+        self.assertEqual(len(notifier.failed), 1)
+
+    def test_bad_message_does_not_stop_thread(self):
+        with self.notifier(min_interval=0.0, digest_delay=0.0) as notifier:
+            notifier.send("me@localhost", 12345)
+            self.assertTrue(notifier.flush(timeout=10))
+            self.assertEqual(len(notifier.failed), 1)
+            notifier.send("me@localhost", "still running")
+            self.assertTrue(notifier.flush(timeout=10))
+        self.assertEqual(notifier.sent, 1)
+        self.assertIn("still running", self.server.messages[0][1])
+
+if __name__ == "__main__":
+    unittest.main()
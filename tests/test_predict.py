@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from scipy.spatial import distance_matrix
+from meltpack.gaussmarkov import predict
+
+class PredictTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.X = 1000*rng.rand(200, 2)
+        self.Y = np.sin(self.X[:,0]/200) + 0.1*rng.randn(200)
+        self.Xi = 1000*rng.rand(500, 2)
+        self.model = lambda d: np.exp(-d**2/200.0**2)
+
+    def reference(self):
+        Rxx = self.model(distance_matrix(self.X, self.X)) + 0.1*np.eye(len(self.X))
+        Rxy = self.model(distance_matrix(self.X, self.Xi))
+        A = np.linalg.solve(Rxx, Rxy)
+        Ym = self.Y.mean()
+        return np.dot(A.T, self.Y-Ym) + Ym, 1.0 - np.sum(Rxy*A, axis=0)
+
+    def test_chunked_matches_dense(self):
+        Yref, varref = self.reference()
+        for use_kd_trees in (True, False):
+            Yi, var = predict(self.model, self.Xi, self.X, self.Y, eps0=0.1,
+                              maxdist=1e4, compute_uncertainty=True,
+                              use_kd_trees=use_kd_trees, chunksize=64, nprocs=2)
+            self.assertTrue(np.allclose(Yi, Yref))
+            self.assertTrue(np.allclose(var, varref))
+
+    def test_uncertainty_optional(self):
+        Yi, var = predict(self.model, self.Xi, self.X, self.Y, use_kd_trees=False)
+        self.assertEqual(Yi.shape, (500,))
+        self.assertTrue(np.all(np.isnan(var)))
+
+if __name__ == "__main__":
+    unittest.main()
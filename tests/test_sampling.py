@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+from meltpack.sampling import SamplingPlan
+
+def karta_bilinear(transform, values, x, y):
+    """ Reference bilinear sampler following karta's get_positions_vec and
+    sample_bilinear_double (unskewed grids) """
+    x0, y0, dx, dy = transform[:4]
+    m, n = values.shape
+    out = np.empty(len(x))
+    for k in range(len(x)):
+        i = (y[k]-y0)/dy - 0.5
+        j = (x[k]-x0)/dx - 0.5
+        if i % 1 != 0:
+            i0 = int(i // 1.0); i1 = i0 + 1
+        elif i != 0:
+            i0 = int(i-1.0); i1 = int(i)
+        else:
+            i0 = int(i); i1 = int(i+1.0)
+        if j % 1 != 0:
+            j0 = int(j // 1.0); j1 = j0 + 1
+        elif j != 0:
+            j0 = int(j-1.0); j1 = int(j)
+        else:
+            j0 = int(j); j1 = int(j+1.0)
+        if i0 >= 0 and i1 < m and j0 >= 0 and j1 < n:
+            out[k] = values[i0,j0]*(i1-i)*(j1-j) + values[i1,j0]*(i-i0)*(j1-j) \
+                   + values[i0,j1]*(i1-i)*(j-j0) + values[i1,j1]*(i-i0)*(j-j0)
+        else:
+            out[k] = np.nan
+    return out
+
+class SamplingPlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.transform = (100.0, 200.0, 10.0, 5.0, 0.0, 0.0)
+        y, x = np.mgrid[0:20,0:30]
+        self.linear = 2.0*x + 3.0*y
+        self.other = np.cos(x) + np.sin(y)
+
+    def test_linear_field_is_exact(self):
+        xp = np.array([105.0, 152.5, 337.0])
+        yp = np.array([202.5, 231.0, 290.0])
+        plan = SamplingPlan(self.transform, (20, 30), xp, yp)
+        z = plan.sample_array(self.linear)
+        expected = 2.0*((xp-100.0)/10.0-0.5) + 3.0*((yp-200.0)/5.0-0.5)
+        self.assertTrue(np.allclose(z, expected))
+
+    def test_outside_is_nan(self):
+        plan = SamplingPlan(self.transform, (20, 30),
+                            np.array([101.0, 150.0, 1000.0]),
+                            np.array([250.0, 201.0, 250.0]))
+        z = plan.sample_array(self.linear)
+        self.assertTrue(np.all(np.isnan(z)))
+
+    def test_plan_reused_across_arrays(self):
+        xp = 100.0 + 300.0*np.random.rand(50)
+        yp = 200.0 + 100.0*np.random.rand(50)
+        plan = SamplingPlan(self.transform, (20, 30), xp, yp)
+        a = plan.sample_array(self.linear)
+        b = plan.sample_array(self.other)
+        c = SamplingPlan(self.transform, (20, 30), xp, yp).sample_array(self.other)
+        self.assertTrue(np.allclose(b, c, equal_nan=True))
+        self.assertEqual(a.shape, (50,))
+
+    def test_matches_karta_sampling(self):
+        values = np.random.rand(20, 30)
+        values[8,12] = np.nan
+        for transform in (self.transform, (100.0, 300.0, 10.0, -5.0, 0.0, 0.0)):
+            x0, y0, dx, dy = transform[:4]
+            # pixel centres and corners, including the outermost ones, points
+            # just inside and outside the span of centres, and random points
+            jc = np.r_[0.5, 1.0, 11.5, 12.0, 29.5, 30.0, 0.4, 29.6, 0.0,
+                       30*np.random.rand(40)]
+            ic = np.r_[0.5, 1.0, 7.5, 8.0, 19.5, 20.0, 19.6, 0.4, 0.0,
+                       20*np.random.rand(40)]
+            for xp, yp in ((x0+jc*dx, y0+np.roll(ic, 3)*dy),
+                           (x0+jc*dx, y0+ic*dy)):
+                plan = SamplingPlan(transform, (20, 30), xp, yp)
+                expected = karta_bilinear(transform, values, xp, yp)
+                self.assertTrue(np.allclose(plan.sample_array(values), expected,
+                                            equal_nan=True))
+
+if __name__ == "__main__":
+    unittest.main()
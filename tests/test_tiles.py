@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from meltpack.filt import smooth5, medianfilt, filter_pipeline
+from meltpack.divergence import divergence
+
+class RowTiledTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.random.rand(97, 40)
+        self.img[np.random.rand(97, 40) < 0.1] = np.nan
+
+    def test_smooth5_tiled_matches(self):
+        expected = smooth5(self.img, 3)
+        for tilesize in (1, 7, 50, 200):
+            out = smooth5(self.img, 3, tilesize=tilesize)
+            self.assertTrue(np.array_equal(out, expected, equal_nan=True))
+
+    def test_medianfilt_tiled_matches(self):
+        expected = medianfilt(self.img)
+        for tilesize in (1, 10, 96):
+            out = medianfilt(self.img, tilesize=tilesize, nprocs=2)
+            self.assertTrue(np.array_equal(out, expected, equal_nan=True))
+
+    def test_divergence_tiled_matches(self):
+        h = 100 + np.random.rand(97, 40)
+        u = np.random.randn(97, 40)
+        v = np.random.randn(97, 40)
+        expected = divergence(1.0, 2.0, h, u, v)
+        for tilesize in (1, 3, 16, 95):
+            out = divergence(1.0, 2.0, h, u, v, tilesize=tilesize)
+            self.assertEqual(out.shape, expected.shape)
+            self.assertTrue(np.array_equal(out, expected, equal_nan=True))
+
+    def test_memmap_input_and_output(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = np.memmap(os.path.join(d, "in.dat"), dtype=np.float32,
+                            mode="w+", shape=self.img.shape)
+            src[:] = self.img
+            dst = np.memmap(os.path.join(d, "out.dat"), dtype=np.float32,
+                            mode="w+", shape=self.img.shape)
+            ret = smooth5(src, 2, out=dst, tilesize=8)
+            self.assertIs(ret, dst)
+            expected = smooth5(self.img.astype(np.float32), 2)
+            self.assertTrue(np.array_equal(np.asarray(dst), expected, equal_nan=True))
+            del src, dst, ret
+
+class FilterPipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.random.rand(83, 37)
+        self.img[np.random.rand(83, 37) < 0.1] = np.nan
+
+    def test_matches_sequential_filters(self):
+        stages = ["median", ("smooth", 2), ("threshold", 0.2, 0.8), "median"]
+        expected = smooth5(medianfilt(self.img), 2)
+        with np.errstate(invalid="ignore"):
+            expected[expected < 0.2] = np.nan
+            expected[expected > 0.8] = np.nan
+        expected = medianfilt(expected)
+        for tilesize in (1, 9, 100):
+            out = filter_pipeline(self.img, stages, tilesize=tilesize, nprocs=2)
+            self.assertTrue(np.array_equal(out, expected, equal_nan=True))
+
+    def test_float32_preserved(self):
+        out = filter_pipeline(self.img.astype(np.float32), [("smooth", 1)])
+        self.assertEqual(out.dtype, np.float32)
+
+    def test_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            filter_pipeline(self.img, ["gaussian"])
+
+if __name__ == "__main__":
+    unittest.main()
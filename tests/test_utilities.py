@@ -0,0 +1,113 @@
+import unittest
+import numpy as np
+from meltpack import utilities
+from meltpack.utilities import SharedPixelStats
+
+class Grid(object):
+    """ Minimal unskewed grid with the attributes used by the shared-pixel
+    functions, following karta's conventions """
+
+    def __init__(self, transform, values, nodata=np.nan):
+        self.transform = transform
+        self.values = values
+        self.nodata = nodata
+
+    @property
+    def size(self):
+        return self.values.shape
+
+    def get_data_extent(self):
+        x0, y0, dx, dy = self.transform[:4]
+        I, J = np.nonzero(~np.isnan(self.values))
+        x = x0 + (J+0.5)*dx
+        y = y0 + (I+0.5)*dy
+        return x.min(), x.max(), y.min(), y.max()
+
+def overlapping_grids(dy):
+    """ Two grids offset by (3, 5) pixels, with gaps, and the arrays of their
+    values over the overlap """
+    a = np.random.rand(23, 17)
+    b = np.random.rand(21, 19)
+    a[np.random.rand(23, 17) < 0.2] = np.nan
+    b[np.random.rand(21, 19) < 0.2] = np.nan
+    y0 = 0.0 if dy > 0 else -dy*23
+    g1 = Grid((0.0, y0, 2.0, dy, 0.0, 0.0), a)
+    g2 = Grid((10.0, y0+3*dy, 2.0, dy, 0.0, 0.0), b)
+    return g1, g2, a[3:,5:], b[:20,:12]
+
+
+class SharedPixelStatsTests(unittest.TestCase):
+
+    def test_merged_swaths_match_numpy(self):
+        d = 500.0 + np.random.randn(10000)
+        stats = SharedPixelStats(bins=np.linspace(490, 510, 2001))
+        for part in np.array_split(d, 7):
+            stats.merge(SharedPixelStats(bins=stats.bins).add(part))
+        self.assertEqual(stats.count, d.size)
+        self.assertAlmostEqual(stats.mean, d.mean())
+        self.assertAlmostEqual(stats.std, d.std())
+        self.assertAlmostEqual(stats.sumsq/d.size, (d**2).mean())
+        self.assertEqual(stats.min, d.min())
+        self.assertEqual(stats.max, d.max())
+        self.assertTrue(abs(stats.median() - np.median(d)) < 0.01)
+
+    def test_nan_ignored(self):
+        stats = SharedPixelStats().add(np.array([1.0, np.nan, 3.0]))
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.mean, 2.0)
+
+class SharedPixelTests(unittest.TestCase):
+
+    def test_swaths_match_single_pass(self):
+        for dy in (1.5, -1.5):
+            g1, g2, a, b = overlapping_grids(dy)
+            valid = ~np.isnan(a) & ~np.isnan(b)
+            expected = (a-b)[valid]
+            # 3 rows per swath does not divide the 20 shared rows
+            budget = 3*12*8*4*2
+            self.assertEqual(utilities.swath_bandwidth(12, np.float64, budget), 3)
+            for memory_budget, nprocs in ((budget, 1), (budget, 3), (10**9, 1)):
+                result = utilities.apply_shared_pixels(lambda x, y: x-y, g1, g2,
+                        memory_budget=memory_budget, nprocs=nprocs)
+                self.assertTrue(np.array_equal(result, expected))
+            parts = list(utilities.iter_shared_pixels(lambda x, y: x-y, g1, g2,
+                                                      memory_budget=budget))
+            self.assertEqual(len(parts), 7)
+            self.assertTrue(np.array_equal(np.concatenate(parts), expected))
+            self.assertEqual(utilities.count_shared_pixels(g1, g2, memory_budget=budget),
+                             np.count_nonzero(valid))
+
+    def test_no_overlap(self):
+        g1 = Grid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), np.ones((5, 5)))
+        g2 = Grid((10.0, 0.0, 1.0, 1.0, 0.0, 0.0), np.ones((5, 5)))
+        self.assertEqual(utilities.count_shared_pixels(g1, g2), 0)
+        self.assertEqual(utilities.shared_pixel_stats(g1, g2).count, 0)
+        with self.assertRaises(ValueError):
+            utilities.apply_shared_pixels(lambda x, y: x-y, g1, g2)
+
+    def test_incompatible_grids_raise(self):
+        g1 = Grid((0.0, 0.0, 1.0, 1.0, 0.0, 0.0), np.ones((5, 5)))
+        g2 = Grid((0.0, 0.0, 2.0, 1.0, 0.0, 0.0), np.ones((5, 5)))
+        with self.assertRaises(ValueError):
+            utilities.count_shared_pixels(g1, g2)
+        with self.assertRaises(ValueError):
+            utilities.shared_pixel_stats(g1, g2)
+
+    def test_stats_match_full_grid_mean(self):
+        for dy in (1.0, -1.0):
+            a = np.random.rand(12, 9)
+            b = np.random.rand(12, 9)
+            a[np.random.rand(12, 9) < 0.3] = np.nan
+            b[np.random.rand(12, 9) < 0.3] = np.nan
+            a[0,:] = b[0,:] = a[:,-1] = b[:,-1] = 5.0
+            g1 = Grid((0.0, 0.0, 1.0, dy, 0.0, 0.0), a)
+            g2 = Grid((0.0, 0.0, 1.0, dy, 0.0, 0.0), b)
+            msk = ~np.isnan(a) & ~np.isnan(b)
+            for kw in ({}, {"bbox1": utilities.centre_bbox(g1),
+                            "bbox2": utilities.centre_bbox(g2)}):
+                stats = utilities.shared_pixel_stats(g1, g2, memory_budget=500, **kw)
+                self.assertEqual(stats.count, msk.sum())
+                self.assertAlmostEqual(stats.mean, np.mean(a[msk]-b[msk]))
+
+if __name__ == "__main__":
+    unittest.main()
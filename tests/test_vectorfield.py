@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+from meltpack.vectorfield import grid_displacements, filter_displacements, \
+                                 normalized_median_residual
+
+class VectorFieldTests(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(7)
+        y, x = np.mgrid[:40,:50]
+        self.u = 5.0 + 0.05*x + 0.01*np.random.randn(40, 50)
+        self.v = -2.0 + 0.02*y + 0.01*np.random.randn(40, 50)
+
+    def test_grid_displacements(self):
+        T = (100.0, 200.0, 10.0, 10.0, 0.0, 0.0)
+        points = [(105.0, 205.0), (134.0, 221.0), (5000.0, 205.0)]
+        displs = [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)]
+        u, v, s = grid_displacements(points, displs, [0.9, 0.8, 0.7], T, (4, 5))
+        self.assertEqual(u[0,0], 1.0)
+        self.assertEqual(v[2,3], 4.0)
+        self.assertEqual(s[2,3], 0.8)
+        self.assertEqual(np.count_nonzero(~np.isnan(u)), 2)
+
+    def test_median_test_rejects_blunders(self):
+        u = self.u.copy()
+        v = self.v.copy()
+        blunders = [(5, 5), (20, 30), (33, 12)]
+        for i, j in blunders:
+            u[i,j] += 8.0
+        v[10,10] -= 5.0
+        u[25,25] = np.nan
+        uf, vf = filter_displacements(u, v)
+        for i, j in blunders + [(10, 10), (25, 25)]:
+            self.assertTrue(np.isnan(uf[i,j]))
+            self.assertTrue(np.isnan(vf[i,j]))
+        self.assertEqual(np.count_nonzero(np.isnan(uf[1:-1,1:-1])), 5)
+
+    def test_median_residual_excludes_centre(self):
+        u = self.u.copy()
+        v = self.v.copy()
+        u[5,5] += 8.0
+        u[12,7] = np.nan
+        v[20,20] = np.nan
+        res = normalized_median_residual(u, v, epsilon=0.1)
+        expected = np.zeros(u.shape)
+        for i in range(1, u.shape[0]-1):
+            for j in range(1, u.shape[1]-1):
+                for c in (u, v):
+                    nb = np.delete(c[i-1:i+2,j-1:j+2].ravel(), 4)
+                    nb = nb[~np.isnan(nb)]
+                    med = np.median(nb)
+                    rm = np.median(np.abs(nb-med))
+                    expected[i,j] += (abs(c[i,j]-med)/(rm+0.1))**2
+        expected = np.sqrt(expected)
+        self.assertTrue(np.allclose(res, expected, equal_nan=True))
+        self.assertTrue(np.all(res[0] == 0) and np.all(res[:,-1] == 0))
+
+    def test_strength_threshold(self):
+        s = np.full(self.u.shape, 0.9)
+        s[3,4] = 0.1
+        uf, vf = filter_displacements(self.u, self.v, s, min_strength=0.5,
+                                      median_threshold=None)
+        self.assertTrue(np.isnan(uf[3,4]))
+        self.assertEqual(np.count_nonzero(np.isnan(uf)), 1)
+
+if __name__ == "__main__":
+    unittest.main()